@@ -318,6 +318,128 @@ contains
 
   end subroutine atom_dist
 
+  subroutine center_of_mass(mol, masses, com, natom)
+    ! Compute the mass weighted center of the molecule
+    implicit none
+    real*8, dimension(3*natom), intent(in) :: mol
+    real*8, dimension(natom), intent(in) :: masses
+    real*8, dimension(3), intent(out) :: com
+    integer, intent(in) :: natom
+!f2py real*8, dimension(3*natom), intent(in) :: mol
+!f2py real*8, dimension(natom), check(len(masses)==len(mol)/3), depend(natom), intent(in) :: masses
+!f2py real*8, dimension(3), intent(out) :: com
+!f2py integer optional,depend(mol) :: natom=(len(mol))/3
+
+    com = matmul(reshape(mol, (/3,natom/)), masses) / sum(masses)
+
+  end subroutine center_of_mass
+
+  subroutine weighted_rmsd_rotation(mol1, mol2, masses, rot, natom)
+    !     Compute the rotation matrix which rotates molecule1 to molecule2
+    !     to optimize the mass weighted RMSD beween the two structures.
+    implicit none
+    real*8, dimension(3*natom), intent(in) :: mol1, mol2
+    real*8, dimension(natom), intent(in) :: masses
+    real*8, dimension(3,3),intent(out) :: rot
+    integer, intent(in) :: natom
+!f2py real*8, dimension(3*natom),check(len(mol1)==len(mol2)), intent(in) :: mol2
+!f2py real*8, dimension(natom), check(len(masses)==len(mol1)/3), depend(natom), intent(in) :: masses
+!f2py integer optional,depend(mol1) :: natom=(len(mol1))/3
+
+    real*8, dimension(3,3) :: cov, vt, u
+    real*8, dimension(201) :: work !Optimal lwork previously calculated by dgesvd
+    real*8, dimension(3) :: s
+
+    integer :: lwork, three, info
+
+    lwork = 201
+    three = 3
+
+    cov = matmul(reshape(mol1, (/3,natom/)) * spread(masses, 1, 3), transpose(reshape(mol2, (/3,natom/))))
+
+    call dgesvd('All of u is returned','All of v is returned', three, three, cov, three, s, u, three, vt, three, work, lwork, info)
+
+    if (info /= 0) then
+       ! The SVD did not converge; leave the molecule unrotated
+       ! rather than return an undefined matrix.
+       rot = reshape((/1., 0., 0., 0., 1., 0., 0., 0., 1./), (/3,3/))
+       return
+    end if
+
+    if (det(u) * det(vt) < 0.) then
+       vt(3,:) = -vt(3,:)
+    end if
+
+    rot = transpose(matmul(u, vt))
+
+  end subroutine weighted_rmsd_rotation
+
+  subroutine weighted_rmsd(mol1, mol2, masses, rmsd_result, natom)
+    ! Compute the rotation optimized mass weighted rmsd between the two molecules
+    implicit none
+    real*8, dimension(3*natom), intent(in) :: mol1, mol2
+    real*8, dimension(natom), intent(in) :: masses
+    real*8, intent(out) :: rmsd_result
+    integer, intent(in) :: natom
+!f2py real*8, dimension(3*natom),check(len(mol1)==len(mol2)), intent(in) :: mol2
+!f2py real*8, dimension(natom), check(len(masses)==len(mol1)/3), depend(natom), intent(in) :: masses
+!f2py integer optional,depend(mol1) :: natom=(len(mol1))/3
+
+    real*8, dimension(3) :: com
+    real*8, dimension(3,natom) :: u, v
+
+    real*8, dimension(3,3) :: cov, vt, w
+    real*8, dimension(201) :: work !Optimal lwork previously calculated by dgesvd
+    real*8, dimension(3) :: s
+
+    integer :: lwork, three, info
+
+    lwork = 201
+    three = 3
+
+    call center_of_mass(mol1, masses, com, natom)
+    u = reshape(mol1, (/3,natom/)) - spread(com, 2, natom)
+
+    call center_of_mass(mol2, masses, com, natom)
+    v = reshape(mol2, (/3,natom/)) - spread(com, 2, natom)
+
+    cov = matmul(u * spread(masses, 1, 3), transpose(v))
+
+    call dgesvd('All of u is returned','All of v is returned', three, three, cov, three, s, w, three, vt, three, work, lwork, info)
+
+    if (det(w) * det(vt) < 0.) then
+       s(3) = -s(3)
+    end if
+
+    rmsd_result = abs((sum(spread(masses, 1, 3) * (u * u + v * v)) - 2. * sum(s)) / sum(masses))
+
+    rmsd_result = sqrt(rmsd_result)
+
+  end subroutine weighted_rmsd
+
+  subroutine weighted_rmsd_frames(mols, mol2, masses, rmsds, nframe, natom)
+    ! Compute the mass weighted rmsd of each of the frames in mols to mol2
+    implicit none
+    real*8, dimension(nframe,3*natom), intent(in) :: mols
+    real*8, dimension(3*natom), intent(in) :: mol2
+    real*8, dimension(natom), intent(in) :: masses
+    real*8, dimension(nframe), intent(out) :: rmsds
+    integer, intent(in) :: nframe, natom
+!f2py real*8, dimension(nframe,3*natom), intent(in) :: mols
+!f2py real*8, dimension(3*natom),check(shape(mols,1)==len(mol2)), depend(natom), intent(in) :: mol2
+!f2py real*8, dimension(natom), check(len(masses)==len(mol2)/3), depend(natom), intent(in) :: masses
+!f2py real*8, dimension(nframe), depend(nframe), intent(out) :: rmsds
+!f2py integer optional,depend(mols) :: nframe=shape(mols,0)
+!f2py integer optional,depend(mols) :: natom=shape(mols,1)/3
+
+    integer :: idx
+
+    do idx=1,nframe
+       call weighted_rmsd(mols(idx,:), mol2, masses, rmsds(idx), natom)
+    end do
+
+  end subroutine weighted_rmsd_frames
+
 end module coord_math_mod
 
 
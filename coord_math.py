@@ -198,6 +198,310 @@ def subalign(top, x, y):
     
 
 
+
+def center_of_mass(coordinates, masses):
+    """Return the mass weighted center of the molecule."""
+    coords = coordinates.reshape((-1, 3))
+    return np.dot(masses, coords) / np.sum(masses)
+
+
+def weighted_rmsd_rotation(coordinates1, coordinates2, masses):
+    """Compute the rotation matrix to optimally align mol2 to mol1 weighted by the masses."""
+
+    u = coordinates1.reshape((-1, 3))
+    v = coordinates2.reshape((-1, 3))
+
+    cov = np.dot(u.transpose() * masses, v)
+    [U, S, Vt] = np.linalg.svd(cov)
+
+    if np.linalg.det(U) * np.linalg.det(Vt) < 0:
+        Vt[2] = -Vt[2]
+
+    return np.dot(Vt.transpose(), U.transpose())
+
+
+def weighted_rmsd(coordinates1, coordinates2, masses):
+    """Compute the mass weighted RMSD distance between the two molecules."""
+    masses = np.asarray(masses, dtype=float)
+    u = coordinates1.reshape((-1, 3)) - center_of_mass(coordinates1, masses)
+    v = coordinates2.reshape((-1, 3)) - center_of_mass(coordinates2, masses)
+
+    cov = np.dot(u.transpose() * masses, v)
+    s = np.linalg.svd(cov, compute_uv=0)
+
+    if np.linalg.det(cov) < 0.:
+        s[2] = -s[2]
+
+    msd = abs(np.dot(masses, (u * u + v * v).sum(axis=1)) - 2. * np.sum(s)) / np.sum(masses)
+    return np.sqrt(msd)
+
+
+def weighted_rmsd_frames(mols, mol2, masses):
+    """Return the mass weighted RMSD of each of the (M, 3n) geometries in mols to mol2."""
+    masses = np.asarray(masses, dtype=float)
+    us = centered_frames(mols, masses)
+    v = mol2.reshape((-1, 3)) - center_of_mass(mol2, masses)
+
+    cov = np.einsum('mni,n,nj->mij', us, masses, v)
+    s = np.linalg.svd(cov, compute_uv=0)
+    s[np.linalg.det(cov) < 0., 2] *= -1.
+
+    msd = np.abs(np.dot((us * us).sum(axis=-1), masses)
+                 + np.dot(masses, (v * v).sum(axis=-1))
+                 - 2. * s.sum(axis=-1)) / np.sum(masses)
+    return np.sqrt(msd)
+
+
+def centers_of_mass(xs, masses):
+    """Return the (..., 3) mass weighted centers of a block of geometries."""
+    xs = np.asarray(xs, dtype=float)
+    return np.einsum('...ni,n->...i', xs.reshape(xs.shape[:-1] + (-1, 3)), masses) / np.sum(masses)
+
+
+def centered_frames(xs, masses):
+    """Return the (M, n, 3) block of geometries xs with their centers of mass at the origin."""
+    xs = np.asarray(xs, dtype=float).reshape((len(xs), -1, 3))
+    return xs - centers_of_mass(xs.reshape((len(xs), -1)), masses)[:, np.newaxis, :]
+
+
+def weighted_rmsd_align_transform(x, y, masses):
+    """Return the t1, r, t2 (translation, rotation, translation) for y to minimize the mass weighted rmsd to x.
+
+    See rmsd_align_transform.
+
+    """
+    t1 = -center_of_mass(y, masses)
+    t2 = center_of_mass(x, masses)
+    r = weighted_rmsd_rotation(translate(x, -t2), translate(y, t1), masses)
+
+    return t1, r, t2
+
+
+def weighted_align(x, y, masses):
+    """Return y transformed to minimize the mass weighted rmsd to x."""
+    t1, r, t2 = weighted_rmsd_align_transform(x, y, masses)
+    return translate(transform(translate(y, t1), r), t2)
+
+
+def weighted_align_frames(x, ys, masses):
+    """Return each of the (M, 3n) geometries ys transformed to minimize the mass weighted rmsd to x."""
+    masses = np.asarray(masses, dtype=float)
+    t2 = center_of_mass(x, masses)
+    u = x.reshape((-1, 3)) - t2
+    vs = centered_frames(ys, masses)
+
+    cov = np.einsum('ni,n,mnj->mij', u, masses, vs)
+    U, S, Vt = np.linalg.svd(cov)
+    inverted = np.linalg.det(U) * np.linalg.det(Vt) < 0
+    Vt[inverted, 2] *= -1.
+    rs = np.matmul(Vt.transpose((0, 2, 1)), U.transpose((0, 2, 1)))
+
+    return (np.matmul(vs, rs) + t2).reshape((len(vs), -1))
+
+
+def mass_subalign(top, x, y):
+    """Align y to x according to the masses of the atoms of the subtopology top."""
+    t1, r, t2 = weighted_rmsd_align_transform(top.get_coords(x), top.get_coords(y), top.masses)
+    return translate(transform(translate(y, t1), r), t2)
+
+
+def segment_sums(values, starts):
+    """Sum the (..., n, k) values over the segments of rows beginning at starts.
+
+    Returns the (..., num_segments, k) sums and the number of rows in
+    each segment.  Empty segments sum to zero, so the averages of the
+    segment functions below are nan for empty segments.
+
+    """
+    values = np.asarray(values)
+    starts = np.asarray(starts, dtype=int)
+    counts = np.diff(np.append(starts, values.shape[-2]))
+    sums = np.zeros(values.shape[:-2] + (len(starts),) + values.shape[-1:])
+    nonempty = counts > 0
+    if nonempty.any():
+        # reduceat does not skip empty segments, so only reduce over
+        # the nonempty ones.
+        sums[..., nonempty, :] = np.add.reduceat(values, starts[nonempty], axis=-2)
+    return sums, counts
+
+
+def segment_centers(x, starts):
+    """Return the center of geometry of each segment of atoms beginning at starts.
+
+    x is a flat geometry or an (M, 3n) block of geometries; the result
+    is a (..., num_segments, 3) array.
+
+    """
+    x = np.asarray(x, dtype=float)
+    sums, counts = segment_sums(x.reshape(x.shape[:-1] + (-1, 3)), starts)
+    with np.errstate(invalid='ignore'):
+        return sums / counts[:, np.newaxis]
+
+
+def segment_flat_rmsd(x, y, starts):
+    """Return the flat_rmsd between x and y of each segment of atoms beginning at starts.
+
+    x may be a flat geometry or a block of geometries, compared against
+    the reference y.  The geometries are not aligned, so this is the
+    per segment rmsd once the geometries have been aligned as a whole.
+
+    """
+    x = np.asarray(x, dtype=float)
+    d = (x - y).reshape(x.shape[:-1] + (-1, 3))
+    sums, counts = segment_sums((d * d).sum(axis=-1)[..., np.newaxis], starts)
+    with np.errstate(invalid='ignore'):
+        return np.sqrt(sums[..., 0] / counts)
+
+
+def segment_rmsf(xs, starts):
+    """Return the root mean square fluctuation of each segment of atoms beginning at starts.
+
+    xs is an (M, 3n) block of aligned geometries.  The fluctuation of
+    each atom about its mean position is averaged over the atoms of
+    the segment.
+
+    """
+    xs = np.asarray(xs, dtype=float)
+    d = (xs - xs.mean(axis=0)).reshape((len(xs), -1, 3))
+    msf = (d * d).sum(axis=-1).mean(axis=0)
+    sums, counts = segment_sums(msf[:, np.newaxis], starts)
+    with np.errstate(invalid='ignore'):
+        return np.sqrt(sums[:, 0] / counts)
+
+
+def residue_centers(top, x):
+    """Return the center of geometry of each residue of top in x."""
+    return segment_centers(top.get_coords(x), top.residue_starts)
+
+def residue_flat_rmsd(top, x, y):
+    """Return the flat_rmsd of each residue of top between x and y."""
+    return segment_flat_rmsd(top.get_coords(x), top.get_coords(y), top.residue_starts)
+
+def residue_rmsf(top, xs):
+    """Return the rmsf of each residue of top over the geometries xs."""
+    return segment_rmsf(top.get_coords(xs), top.residue_starts)
+
+
+class PBCError(Exception):
+    pass
+
+
+def box_lengths(box):
+    """Return the (..., 3) edge lengths of rectangular periodic boxes.
+
+    Accepts the box formats of the readers: three lengths (mdcrd, gro),
+    three lengths followed by three angles (rst), or the nine gro
+    triclinic components.  Only rectangular boxes are supported.
+
+    """
+    box = np.asarray(box, dtype=float)
+    num_values = box.shape[-1]
+    if num_values == 6:
+        rectangular = np.allclose(box[..., 3:], 90.)
+    elif num_values == 9:
+        rectangular = np.allclose(box[..., 3:], 0.)
+    elif num_values == 3:
+        rectangular = True
+    else:
+        raise PBCError("Unrecognized box with %d values." % num_values)
+
+    if not rectangular:
+        raise PBCError("Only rectangular boxes are supported: %s" % box)
+
+    return box[..., :3]
+
+
+def atom_rows(x):
+    """Return the (..., n, 3) atom coordinates of the flat geometry or block x."""
+    x = np.asarray(x, dtype=float)
+    return x.reshape(x.shape[:-1] + (-1, 3))
+
+
+def minimum_image(d, box):
+    """Return the displacements d (flat or (M, 3n)) replaced by their minimum images."""
+    lengths = box_lengths(box)[..., np.newaxis, :]
+    rows = atom_rows(d)
+    return (rows - lengths * np.round(rows / lengths)).reshape(np.shape(d))
+
+
+def pbc_pair_distances(x, pairs, box):
+    """Return the minimum image distances between the (P, 2) pairs of 0-based atom indices.
+
+    x is a flat geometry or an (M, 3n) block with one box per frame.
+
+    """
+    rows = atom_rows(x)
+    pairs = np.asarray(pairs, dtype=int).reshape((-1, 2))
+    d = rows[..., pairs[:, 1], :] - rows[..., pairs[:, 0], :]
+    lengths = box_lengths(box)[..., np.newaxis, :]
+    d -= lengths * np.round(d / lengths)
+    return np.sqrt((d * d).sum(axis=-1))
+
+
+def segment_owners(starts, num_atoms):
+    """Return the index of the segment of each atom and the number of atoms in each segment."""
+    starts = np.asarray(starts, dtype=int)
+    counts = np.diff(np.append(starts, num_atoms))
+    return np.repeat(np.arange(len(starts)), counts), counts
+
+
+def make_whole(x, starts, box):
+    """Return x with each segment of atoms beginning at starts made whole.
+
+    Each atom is placed at the minimum image of its displacement from
+    the previous atom of its segment, so segments are unwrapped along
+    the atom order even when they span more than half of the box.  The
+    first atom of each segment stays in place.
+
+    """
+    rows = atom_rows(x)
+    starts = np.asarray(starts, dtype=int)
+    owners, counts = segment_owners(starts, rows.shape[-2])
+    first_atoms = starts[owners]
+
+    steps = minimum_image(np.diff(rows, axis=-2).reshape(rows.shape[:-2] + (-1,)), box)
+    steps = steps.reshape(rows.shape[:-2] + (-1, 3))
+    paths = np.concatenate([np.zeros(rows.shape[:-2] + (1, 3)), np.cumsum(steps, axis=-2)], axis=-2)
+
+    whole = rows[..., first_atoms, :] + paths - paths[..., first_atoms, :]
+    return whole.reshape(np.shape(x))
+
+
+def wrap_segments(x, starts, box):
+    """Return x with each segment translated by box vectors so that its center is in the box."""
+    rows = atom_rows(x)
+    owners, counts = segment_owners(starts, rows.shape[-2])
+    lengths = box_lengths(box)[..., np.newaxis, :]
+    centers = segment_centers(x, starts)
+    shifts = -lengths * np.floor(centers / lengths)
+    return (rows + shifts[..., owners, :]).reshape(np.shape(x))
+
+
+def make_monomers_whole(top, x, box):
+    """Return a copy of x in which each of the monomers of top is whole."""
+    y = np.array(x, dtype=float)
+    top.set_coords(y, make_whole(top.get_coords(x), top.monomer_starts, box))
+    return y
+
+
+def image_monomers(top, x, box, center_top=None):
+    """Return a copy of x with the monomers of top made whole and imaged into the box.
+
+    If center_top is given, the system is first translated so that the
+    center of geometry of center_top is at the center of the box, as
+    when centering a protein in its solvent.
+
+    """
+    y = make_monomers_whole(top, x, box)
+    lengths = box_lengths(box)
+    if center_top is not None:
+        shift = 0.5 * lengths - segment_centers(center_top.get_coords(y), [0])[..., 0, :]
+        rows = atom_rows(y)
+        rows += shift[..., np.newaxis, :]
+        y = rows.reshape(np.shape(y))
+    top.set_coords(y, wrap_segments(top.get_coords(y), top.monomer_starts, box))
+    return y
+
 # Overwrite above definitions with a fast fortran implementation
 try:
     from _coord_math import *
@@ -0,0 +1,85 @@
+"""Element masses and the guessing of elements from atom names."""
+
+import numpy as np
+
+# Standard atomic weights.
+masses = {'H': 1.008, 'C': 12.011, 'N': 14.007, 'O': 15.999, 'P': 30.974, 'S': 32.06,
+          'F': 18.998, 'CL': 35.45, 'BR': 79.904, 'I': 126.904,
+          'NA': 22.990, 'K': 39.098, 'MG': 24.305, 'CA': 40.078, 'MN': 54.938,
+          'FE': 55.845, 'CO': 58.933, 'NI': 58.693, 'CU': 63.546, 'ZN': 65.38,
+          'LI': 6.94, 'CS': 132.905, 'RB': 85.468, 'SE': 78.971}
+
+# Force field names of ions, which are not spelled as their element.
+ions = {# Amber
+        'NA+': 'NA', 'K+': 'K', 'LI+': 'LI', 'RB+': 'RB', 'CS+': 'CS',
+        'CL-': 'CL', 'BR-': 'BR', 'F-': 'F', 'I-': 'I',
+        'MG2+': 'MG', 'CA2+': 'CA', 'ZN2+': 'ZN', 'C0': 'CA',
+        # CHARMM
+        'SOD': 'NA', 'POT': 'K', 'LIT': 'LI', 'RUB': 'RB', 'CES': 'CS',
+        'CLA': 'CL', 'CAL': 'CA', 'ZN2': 'ZN'}
+
+# Water virtual sites and lone pairs carry no mass.
+massless = set(['EP', 'LP', 'MW'])
+
+
+class ElementError(Exception):
+    pass
+
+
+def element(atom_name, resname=None):
+    """Return the element symbol guessed from a PDB style atom name.
+
+    Ions are recognized by an atom name equal to the residue name (as
+    in the NA residue holding the NA atom), so that calcium is not
+    confused with an alpha carbon; the Amber and CHARMM ion names in
+    ions (such as Na+ or SOD) are mapped to their elements.  Other
+    charged names raise ElementError.  Otherwise the element is the
+    first letter of the name after any leading digits.
+
+    """
+    name = atom_name.strip().upper()
+    if resname is not None and name == resname.strip().upper():
+        if name in ions:
+            return ions[name]
+        if name in masses:
+            return name
+    if name.endswith('+') or name.endswith('-'):
+        try:
+            return ions[name]
+        except KeyError:
+            raise ElementError("Can not guess the element of ion '%s'." % atom_name)
+
+    name = name.lstrip('0123456789')
+    if name[:2] in massless:
+        return name[:2]
+    if not name or name[0] not in masses:
+        raise ElementError("Can not guess the element of atom '%s'." % atom_name)
+    return name[0]
+
+
+def atom_mass(atom_name, resname=None):
+    """Return the mass of the atom guessed from its name."""
+    symbol = element(atom_name, resname)
+    if symbol in massless:
+        return 0.
+    return masses[symbol]
+
+
+def atom_masses(atom_names, resnames=None):
+    """Return an array of the masses of the atoms.
+
+    The masses are looked up once per distinct (atom name, residue
+    name) pair.
+
+    """
+    if resnames is None:
+        resnames = [None] * len(atom_names)
+
+    cache = {}
+    result = np.empty(len(atom_names))
+    for idx, key in enumerate(zip(atom_names, resnames)):
+        try:
+            result[idx] = cache[key]
+        except KeyError:
+            result[idx] = cache[key] = atom_mass(*key)
+    return result
@@ -1,4 +1,17 @@
+import numpy as np
 
+overflow_value = 9999.999
+
+def repair_floatx(x):
+    """Convert a malformed Fortran float, returning the value and whether it overflowed."""
+    x = x.strip()
+    if x[0] == '*':
+        return overflow_value, True
+    elif x[1:].find('-') > 0 or x[1:].find('+') > 0:
+        mantissa_start = x[1:].find('-') + x[1:].find('+') + 2
+        return float(x[:mantissa_start] + 'E' + x[mantissa_start:]), False
+    else:
+        raise Exception("Can not convert '%s' to float." % x)
 
 def floatx(x):
     """Reads Fortran formatted floats."""
@@ -6,11 +19,63 @@ def floatx(x):
     try:
         return float(x)
     except ValueError:
-        if x[0] == '*':
+        value, overflowed = repair_floatx(x)
+        if overflowed:
             print 'WARNING: treating ******** as 9999.999 in mdcrd file.'
-            return 9999.999
-        elif x[1:].find('-') > 0 or x[1:].find('+') > 0:
-            mantissa_start = x[1:].find('-') + x[1:].find('+') + 2
-            return float(x[:mantissa_start] + 'E' + x[mantissa_start:])
-        else:
-            raise Exception("Can not convert '%s' to float." % x)
+        return value
+
+
+def fixed_width_fields(lines, field_len, fields_per_line, num_fields):
+    """Return the first num_fields fixed width fields on the lines as a numpy byte array."""
+    line_len = field_len * fields_per_line
+    text = ''.join(line.rstrip('\r\n')[:line_len].ljust(line_len) for line in lines)
+    return np.frombuffer(text[:num_fields * field_len], dtype='S%d' % field_len)
+
+
+def malformed_fields(fields):
+    """Return a mask of the overflowed or E-less exponent fields."""
+    fields = np.char.strip(fields)
+    overflowed = np.char.startswith(fields, '*')
+    signed = (np.char.find(fields, '-', 1) > 0) | (np.char.find(fields, '+', 1) > 0)
+    has_e = (np.char.find(fields, 'E') >= 0) | (np.char.find(fields, 'e') >= 0)
+    return overflowed | (signed & ~has_e)
+
+
+def convert_floatx_array(fields):
+    """Convert an array of Fortran formatted floats, returning the values and the number of overflows.
+
+    The well formed fields are converted in bulk; only the malformed
+    fields are repaired one at a time.
+
+    """
+    fields = np.asarray(fields)
+    try:
+        return fields.astype(float), 0
+    except ValueError:
+        pass
+
+    malformed = malformed_fields(fields)
+
+    values = np.empty(fields.shape)
+    try:
+        values[~malformed] = fields[~malformed].astype(float)
+    except ValueError:
+        # Something other than the usual Fortran quirks; let floatx
+        # report the offending field.
+        for idx in np.flatnonzero(~malformed):
+            values.flat[idx] = floatx(fields.flat[idx])
+
+    num_overflows = 0
+    for idx in np.flatnonzero(malformed):
+        values.flat[idx], overflowed = repair_floatx(fields.flat[idx])
+        num_overflows += overflowed
+
+    return values, num_overflows
+
+
+def floatx_array(fields):
+    """Vectorized floatx, warning once per call about overflowed fields."""
+    values, num_overflows = convert_floatx_array(fields)
+    if num_overflows > 0:
+        print 'WARNING: treating %d ******** fields as %s.' % (num_overflows, overflow_value)
+    return values
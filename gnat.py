@@ -586,7 +586,8 @@ def save_gnat(parent_node, name=default_gnat_name):
 
     db.new_table(gnatnodes, overwrite=True)
 
-    db.insert(gnatnodes, gnat_table_rows(parent_node))
+    with db.bulk_writer(session=False) as writer:
+        writer.insert(gnatnodes, gnat_table_rows(parent_node))
 
     db.set_var(name + '_metric', pickle.dumps(parent_node.metric))
 
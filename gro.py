@@ -155,12 +155,24 @@ def read_residues(gro_file_name):
             
         
 
-def read_topology(gro_file_name, name=None):
+def read_topology(gro_file_name, name=None, cache_dir=None):
+    """Return the topology of the file as a Polymer.
+
+    If cache_dir is given, the parsed topology is cached there and
+    reused until the file is modified.
+
+    """
     if name is None:
         name = os.path.splitext(gro_file_name)[0]
-
-    monomers = []
-    for resname, atom_names in read_residues(gro_file_name):
-        monomers.append(t.Molecule(resname, atom_names))
-    
-    return t.Polymer(name, monomers)
+    if cache_dir is not None:
+        return t.cached_topology(cache_dir, gro_file_name, name, read_topology)
+
+    atom_names = []
+    residue_names = []
+    residue_starts = []
+    for resname, atoms in read_residues(gro_file_name):
+        residue_names.append(resname)
+        residue_starts.append(len(atom_names))
+        atom_names.extend(atoms)
+
+    return t.build_topology(name, atom_names, residue_names, residue_starts)
@@ -2,7 +2,7 @@
 
 import numpy as np
 
-from floatx import floatx
+from floatx import floatx_array, fixed_width_fields
 
 STDOPEN=open
 
@@ -68,38 +68,26 @@ class MDCrdFile(object):
         return self
 
     def next(self):
-        num_crds_left = self.num_crds
+        num_crds = self.num_crds
         crd_per_line = self.crd_per_line        
         crd_len = self.crd_len
 
-        crds = []
-
         f = self.file
 
-        while num_crds_left > 0:
-            line = f.next()
-            num_on_line = min(num_crds_left, crd_per_line)
+        num_lines = (num_crds + crd_per_line - 1) // crd_per_line
+        lines = [f.next() for count in xrange(num_lines)]
 
-            last_idx = 0
-            for next_idx in xrange(crd_len, crd_len * (num_on_line+1), crd_len):
-                crds.append(floatx(line[last_idx:next_idx]))
-                last_idx = next_idx
-                
-            num_crds_left -= num_on_line
+        crds = floatx_array(fixed_width_fields(lines, crd_len, crd_per_line, num_crds))
 
         if not self.box:
-            return np.array(crds)
+            return crds
 
         line = f.next()
         num_on_line = len(line)/crd_len
 
-        box_crds = []
-        last_idx = 0
-        for next_idx in xrange(crd_len, crd_len * (num_on_line+1), crd_len):
-            box_crds.append(floatx(line[last_idx:next_idx]))
-            last_idx = next_idx
+        box_crds = floatx_array(fixed_width_fields([line], crd_len, num_on_line, num_on_line))
 
-        return np.array(crds), np.array(box_crds)
+        return crds, box_crds
 
 
     def read(self):
@@ -0,0 +1,160 @@
+"""Cell list neighbor search and contact maps over flat geometries.
+
+Atoms are binned into cells at least as wide as the cutoff, so only
+atoms in the same or adjacent cells need to be compared and the search
+scales linearly with the number of atoms.  Atom indices are 0-based
+positions in the flat geometry (or in the atoms of a topology).
+
+"""
+
+import numpy as np
+
+import coord_math as cm
+
+
+class NeighborError(Exception):
+    pass
+
+
+# Bound on the number of candidate pairs whose distances are computed
+# at once, to keep memory use flat for large systems.
+chunk_size = 2000000
+
+def cell_grid(rows, cutoff, box=None):
+    """Return the integer cell coordinates of each atom and the number of cells along each axis."""
+    if box is None:
+        origin = rows.min(axis=0) if len(rows) else np.zeros(3)
+        extent = (rows.max(axis=0) - origin) if len(rows) else np.zeros(3)
+        num_cells = np.maximum(1, np.floor(extent / cutoff).astype(int))
+        cell_size = np.where(extent > 0, extent / num_cells, 1.)
+        cells = np.floor((rows - origin) / cell_size).astype(int)
+    else:
+        lengths = cm.box_lengths(box)
+        if cutoff > 0.5 * lengths.min():
+            raise NeighborError("Cutoff %s is more than half of the box %s." % (cutoff, lengths))
+        num_cells = np.floor(lengths / cutoff).astype(int)
+        cells = np.floor((rows - lengths * np.floor(rows / lengths)) / (lengths / num_cells)).astype(int)
+
+    return np.minimum(cells, num_cells - 1), num_cells
+
+
+def neighbor_cell_pairs(occupied, num_cells, periodic):
+    """Return the unique unordered pairs of occupied cells which are adjacent."""
+    if len(occupied) == 0:
+        return np.zeros((0, 2), dtype=int)
+    offsets = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+    coords = np.array(np.unravel_index(occupied, num_cells)).T
+
+    others = coords[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+    first = np.repeat(occupied, len(offsets))
+    others = others.reshape((-1, 3))
+    if periodic:
+        others = others % num_cells
+        valid = np.ones(len(others), dtype=bool)
+    else:
+        valid = ((others >= 0) & (others < num_cells)).all(axis=1)
+    second = np.ravel_multi_index(others[valid].T, num_cells)
+    first = first[valid]
+
+    num_total = np.prod(num_cells)
+    keys = np.unique(np.minimum(first, second) * num_total + np.maximum(first, second))
+    cell_pairs = np.array([keys // num_total, keys % num_total]).T
+    is_occupied = np.in1d(cell_pairs, occupied).reshape(cell_pairs.shape).all(axis=1)
+    return cell_pairs[is_occupied]
+
+
+def candidate_pairs(starts, counts, cell_pairs):
+    """Return the sorted order positions of all the atom pairs in the cell pairs."""
+    first, second = cell_pairs[:, 0], cell_pairs[:, 1]
+    num_first, num_second = counts[first], counts[second]
+    sizes = num_first * num_second
+
+    owners = np.repeat(np.arange(len(cell_pairs)), sizes)
+    t = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    idx = starts[first][owners] + t // num_second[owners]
+    jdx = starts[second][owners] + t % num_second[owners]
+
+    # Within a single cell, keep each pair once.
+    keep = (first[owners] != second[owners]) | (idx < jdx)
+    return idx[keep], jdx[keep]
+
+
+def neighbor_pairs(x, cutoff, box=None):
+    """Return the (P, 2) pairs of atoms of x within cutoff of each other, and their distances.
+
+    If box is given, distances are minimum image distances in the
+    periodic box.  The pairs are sorted, with the smaller index first.
+
+    """
+    rows = cm.atom_rows(x)
+    cells, num_cells = cell_grid(rows, cutoff, box)
+    cell_ids = np.ravel_multi_index(cells.T, num_cells) if len(rows) else np.zeros(0, dtype=int)
+
+    order = np.argsort(cell_ids, kind='mergesort')
+    sorted_ids = cell_ids[order]
+    occupied, starts, counts = np.unique(sorted_ids, return_index=True, return_counts=True)
+
+    # Refer to the occupied cells by their position in occupied, so
+    # that sparse systems with many empty cells need no per cell arrays.
+    cell_pairs = np.searchsorted(occupied, neighbor_cell_pairs(occupied, num_cells, box is not None))
+    sizes = counts[cell_pairs[:, 0]] * counts[cell_pairs[:, 1]]
+    bounds = np.searchsorted(np.cumsum(sizes), np.arange(chunk_size, sizes.sum(), chunk_size))
+
+    sorted_rows = rows[order]
+    cutoff2 = cutoff * cutoff
+    pairs = []
+    distances = []
+    for chunk in np.split(cell_pairs, bounds):
+        idx, jdx = candidate_pairs(starts, counts, chunk)
+        d = sorted_rows[jdx] - sorted_rows[idx]
+        if box is not None:
+            d = cm.minimum_image(d.reshape((-1,)), box).reshape((-1, 3))
+        d2 = (d * d).sum(axis=1)
+        close = d2 <= cutoff2
+        pairs.append(np.array([order[idx[close]], order[jdx[close]]]).T)
+        distances.append(np.sqrt(d2[close]))
+
+    pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=int)
+    distances = np.concatenate(distances) if distances else np.zeros(0)
+
+    pairs = np.sort(pairs, axis=1)
+    sort = np.argsort(pairs[:, 0] * len(rows) + pairs[:, 1])
+    return pairs[sort], distances[sort]
+
+
+def iter_neighbor_pairs(xs, cutoff, boxes=None):
+    """Yield the neighbor_pairs of each geometry in the block xs."""
+    for fdx, x in enumerate(xs):
+        if boxes is None:
+            yield neighbor_pairs(x, cutoff)
+        else:
+            yield neighbor_pairs(x, cutoff, boxes[fdx] if np.ndim(boxes) > 1 else boxes)
+
+
+def residue_contacts(top, x, cutoff, box=None):
+    """Return the sorted (C, 2) pairs of distinct residues of top with atoms within cutoff in x."""
+    owners, counts = cm.segment_owners(top.residue_starts, top.num_atoms)
+    pairs, distances = neighbor_pairs(top.get_coords(x), cutoff, box)
+    residue_pairs = owners[pairs]
+    residue_pairs = residue_pairs[residue_pairs[:, 0] != residue_pairs[:, 1]]
+    if len(residue_pairs) == 0:
+        return np.zeros((0, 2), dtype=int)
+    return np.unique(residue_pairs, axis=0)
+
+
+def iter_contact_maps(top, xs, cutoff, boxes=None):
+    """Yield the residue_contacts of each geometry in the block xs."""
+    for fdx, x in enumerate(xs):
+        if boxes is None:
+            yield residue_contacts(top, x, cutoff)
+        else:
+            yield residue_contacts(top, x, cutoff, boxes[fdx] if np.ndim(boxes) > 1 else boxes)
+
+
+def contact_frequencies(top, xs, cutoff, boxes=None):
+    """Return the residue pairs in contact in any of the geometries xs, and the fraction of frames in contact."""
+    maps = list(iter_contact_maps(top, xs, cutoff, boxes))
+    if not maps or sum(len(contacts) for contacts in maps) == 0:
+        return np.zeros((0, 2), dtype=int), np.zeros(0)
+    pairs, counts = np.unique(np.concatenate(maps), axis=0, return_counts=True)
+    return pairs, counts / float(len(maps))
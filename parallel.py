@@ -0,0 +1,48 @@
+"""Ordered maps over process (or thread) pools."""
+
+import collections
+import multiprocessing as mp
+import multiprocessing.pool as mpp
+
+# Results are waited for with a timeout, as in Python 2 a wait without
+# one can not be interrupted by KeyboardInterrupt.
+result_timeout = 1e6
+
+def imap(func, work, processes=1, threads=False):
+    """Yield func of each of the work items, in order.
+
+    With processes other than 1, func is applied in a process pool, or
+    in a thread pool if threads is True; processes=None uses one
+    process per cpu.  The work items are drawn in the calling thread,
+    so a generator reading a database uses the caller's connections
+    and sees its uncommitted rows.  At most two items per process are
+    in flight, so only a few are in memory at once.
+
+    The pool is terminated as soon as an item fails or the iteration
+    is abandoned, rather than running the rest of the work first.
+
+    """
+    if processes == 1:
+        for item in work:
+            yield func(item)
+        return
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    if threads:
+        pool = mpp.ThreadPool(processes)
+    else:
+        pool = mp.Pool(processes)
+
+    try:
+        pending = collections.deque()
+        for item in work:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get(result_timeout)
+        while pending:
+            yield pending.popleft().get(result_timeout)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -70,29 +70,40 @@ def read_residues(pdb_file_name):
 
          
 
-def read_topology(pdb_file_name, name=None):
+def read_topology(pdb_file_name, name=None, cache_dir=None):
+    """Return the topology of the file as a Polymer.
+
+    If cache_dir is given, the parsed topology is cached there and
+    reused until the file is modified.
+
+    """
     if name is None:
         name = os.path.splitext(pdb_file_name)[0]
-    chain_idx = 0
-    chain_monomers = []
-    monomers = []
+    if cache_dir is not None:
+        return t.cached_topology(cache_dir, pdb_file_name, name, read_topology)
+
+    atom_names = []
+    residue_names = []
+    residue_starts = []
+    chain_starts = [0]
     for residue in read_residues(pdb_file_name):
         if residue is None:
-            chain_monomers.append(t.Polymer('%s_CHAIN%d' % (name, chain_idx), monomers))
-            chain_idx += 1
-            monomers = []
+            chain_starts.append(len(residue_names))
         else:
             resname, atoms = residue
-            monomers.append(t.Molecule(resname, atoms))
-            
-    if chain_monomers != []:
-        if monomers != []:
-            chain_monomers.append(t.Polymer('%s_CHAIN%d' % (name, chain_idx), monomers))
+            residue_names.append(resname)
+            residue_starts.append(len(atom_names))
+            atom_names.extend(atoms)
 
-        return t.Polymer(name, chain_monomers)
+    if len(chain_starts) > 1:
+        if chain_starts[-1] == len(residue_names):
+            chain_starts.pop()
+        chain_names = ['%s_CHAIN%d' % (name, chain_idx) for chain_idx in range(len(chain_starts))]
+        return t.build_topology(name, atom_names, residue_names, residue_starts,
+                                chain_names=chain_names, chain_starts=chain_starts)
 
     else:
-        return t.Polymer(name, monomers)
+        return t.build_topology(name, atom_names, residue_names, residue_starts)
 
 def read_coords(pdb_file_name):
     with PDBFile(pdb_file_name) as f:
@@ -102,7 +113,16 @@ def read_coords(pdb_file_name):
 class PDBError(Exception):
     pass
 
-def molecule_coords_to_pdb(monomer, coords, adx=1, mdx=1):
+crd_fmt = '%8.3f%8.3f%8.3f'
+
+def molecule_pdb_template(monomer, adx=1, mdx=1):
+    """Return a format string for the ATOM lines of monomer.
+
+    The static part of each line (serial, atom name, residue name and
+    residue number) is rendered once, leaving only the coordinate
+    columns to be filled in from a tuple of the monomer coordinates.
+
+    """
     resname = monomer.name[:3]
     pdb_lines = []
     for atom in monomer.atoms:
@@ -113,48 +133,89 @@ def molecule_coords_to_pdb(monomer, coords, adx=1, mdx=1):
         else:
             raise PDBError("Atom name too long: '%s'" % atom)
 
-        x, y, z = coords[3 * (adx - 1):3 * adx]
-        pdb_lines.append('ATOM  %(adx)5d %(atom_name)s %(resname)3s   %(mdx)3d   %(x)8.3f%(y)8.3f%(z)8.3f' % locals())
+        prefix = 'ATOM  %(adx)5d %(atom_name)s %(resname)3s   %(mdx)3d   ' % locals()
+        pdb_lines.append(prefix.replace('%', '%%') + crd_fmt)
 
         adx += 1
     return '\n'.join(pdb_lines)
-        
-    
 
-def single_chain_coords_to_pdb(top, coords):
-    if len(coords) != 3 * top.num_atoms:
-        raise PDBError("Wrong number of atoms in coords to match topology: %s != %s" % (len(coords), 3 * top.num_atoms))
-    
+
+def single_chain_pdb_template(top):
     adx = 1
     monomer_parts = []
     for mdx, monomer in enumerate(top.monomers, 1):
-        monomer_parts.append(molecule_coords_to_pdb(monomer, coords, adx=adx, mdx=mdx))
+        monomer_parts.append(molecule_pdb_template(monomer, adx=adx, mdx=mdx))
         adx += monomer.num_atoms
     return '\n'.join(monomer_parts)
 
-def multi_chain_coords_to_pdb(top, coords):
-    if len(coords) != 3 * top.num_atoms:
-        raise PDBError("Wrong number of atoms in coords to match topology: %s != %s" % (len(coords), 3 * top.num_atoms))
 
-    single_chain_parts = []
-    
-    for polymer in top.monomers:
-        chain_coords = polymer.get_coords(coords)
-        single_chain_parts.append(single_chain_coords_to_pdb(polymer, chain_coords))
+def multi_chain_pdb_template(top):
+    return '\nTER\n'.join(single_chain_pdb_template(polymer) for polymer in top.monomers)
 
-    return '\nTER\n'.join(single_chain_parts)
 
-def coords_to_pdb(top, coords):
+def pdb_template(top):
+    """Return a format string rendering a model of top from a tuple of its coordinates."""
     if isinstance(top, t.Molecule):
-        return molecule_coords_to_pdb(top, coords)
+        return molecule_pdb_template(top)
     elif isinstance(top, t.Polymer):
         if isinstance(top.monomers[0], t.Polymer):
-            return multi_chain_coords_to_pdb(top, coords)
+            return multi_chain_pdb_template(top)
         else:
-            return single_chain_coords_to_pdb(top, coords)
+            return single_chain_pdb_template(top)
     else:
         raise Exception("Unrecognized Topology type.")
 
+
+def template_coords(top, coords):
+    """Return the coordinates of top in the order its pdb template lists the atoms.
+
+    Each chain of a multi-chain topology takes its coordinates through
+    its own atom offsets, as a chain need not occupy the same span of
+    the geometry that it does in the template.
+
+    """
+    if isinstance(top, t.Polymer) and isinstance(top.monomers[0], t.Polymer):
+        return np.concatenate([np.asarray(polymer.get_coords(coords), dtype=float).reshape((-1,))
+                               for polymer in top.monomers])
+    return coords
+
+
+def render_pdb(template, coords):
+    """Fill in the pdb template with the coordinates in a single pass."""
+    return template % tuple(np.asarray(coords, dtype=float).reshape((-1,)).tolist())
+
+
+def molecule_coords_to_pdb(monomer, coords, adx=1, mdx=1):
+    start = 3 * (adx - 1)
+    return render_pdb(molecule_pdb_template(monomer, adx=adx, mdx=mdx),
+                      coords[start:start + 3 * monomer.num_atoms])
+
+
+def check_num_coords(top, coords):
+    if len(coords) != 3 * top.num_atoms:
+        raise PDBError("Wrong number of atoms in coords to match topology: %s != %s" % (len(coords), 3 * top.num_atoms))
+
+
+def single_chain_coords_to_pdb(top, coords):
+    check_num_coords(top, coords)
+    return render_pdb(single_chain_pdb_template(top), coords)
+
+def multi_chain_coords_to_pdb(top, coords):
+    check_num_coords(top, coords)
+    return render_pdb(multi_chain_pdb_template(top), template_coords(top, coords))
+
+def coords_to_pdb(top, coords, template=None):
+    """Return the ATOM records of a model of top with the given coordinates.
+
+    The template may be precomputed with pdb_template to avoid
+    rebuilding the static part of every line when writing many models.
+
+    """
+    check_num_coords(top, coords)
+    if template is None:
+        template = pdb_template(top)
+    return render_pdb(template, template_coords(top, coords))
+
 def write_coords(pdb_file_name, topology, coords_iter):
     with PDBFile(pdb_file_name, 'w', topology=topology) as f:
         for coord in coords_iter:
@@ -182,6 +243,7 @@ class PDBFile(object):
             self.file = STDOPEN(name, mode)
 
         self.name = name
+        self.__template = None
 
     def __enter__(self):
         return self
@@ -217,7 +279,13 @@ class PDBFile(object):
     def read(self):
         return list(self)
 
+    @property
+    def template(self):
+        if self.__template is None:
+            self.__template = pdb_template(self.topology)
+        return self.__template
+
     def write(self, x):
-        self.file.write(coords_to_pdb(self.topology, x) + '\nENDMDL\n')
+        self.file.write(coords_to_pdb(self.topology, x, template=self.template) + '\nENDMDL\n')
             
 open=PDBFile
@@ -2,13 +2,28 @@
 
 import numpy as np
 
-from floatx import floatx
+from floatx import floatx_array, fixed_width_fields
+import parallel
 
 STDOPEN=open
 
 class RSTError(Exception):
     pass
 
+def decode_fields(lines, num_fields, field_len, fields_per_line):
+    """Convert the fixed width fields on the lines to a numpy array in bulk."""
+    return floatx_array(fixed_width_fields(lines, field_len, fields_per_line, num_fields))
+
+
+def encode_template(num_fields, fmt, fields_per_line):
+    """Return a format string writing num_fields values, fields_per_line per line."""
+    num_lines, num_left = divmod(num_fields, fields_per_line)
+    template = (fmt * fields_per_line + '\n') * num_lines
+    if num_left != 0:
+        template += fmt * num_left + '\n'
+    return template
+
+
 class RSTFile(object):
 
     crd_per_line=6
@@ -43,7 +58,7 @@ class RSTFile(object):
 
     def __enter__(self):
         return self
-        
+
     def __exit__(self, *args):
         self.close()
         return all(arg is None for arg in args)
@@ -58,65 +73,39 @@ class RSTFile(object):
     def __iter__(self):
         return self
 
-    def next(self):
+    def read_crds(self, num_crds):
+        """Read the next num_crds fixed width coordinates."""
+        crd_per_line = self.crd_per_line
+        num_lines = (num_crds + crd_per_line - 1) // crd_per_line
         f = self.file
-        self.num_atoms = int(f.next())
-
-        crd_per_line = self.crd_per_line        
-        crd_len = self.crd_len
-
-        crds = []
-
-
+        lines = [f.next() for count in xrange(num_lines)]
+        return decode_fields(lines, num_crds, self.crd_len, crd_per_line)
 
-        num_crds_left = 3 * self.num_atoms
-        while num_crds_left > 0:
-            line = f.next()
-            num_on_line = min(num_crds_left, crd_per_line)
+    def next(self):
+        f = self.file
+        self.num_atoms = int(f.next().split()[0])
 
-            last_idx = 0
-            for next_idx in xrange(crd_len, crd_len * (num_on_line+1), crd_len):
-                crds.append(floatx(line[last_idx:next_idx]))
-                last_idx = next_idx
-                
-            num_crds_left -= num_on_line
+        crds = self.read_crds(3 * self.num_atoms)
 
         if not self.dynamics and not self.box:
-            return np.array(crds)
+            return crds
 
         if self.dynamics:
-            num_crds_left = self.num_crds
-            vel_crds = []
-            while num_crds_left > 0:
-                line = f.next()
-                num_on_line = min(num_crds_left, crd_per_line)
-
-                last_idx = 0
-                for next_idx in xrange(crd_len, crd_len * (num_on_line+1), crd_len):
-                    vel_crds.append(floatx(line[last_idx:next_idx]))
-                    last_idx = next_idx
-
-                num_crds_left -= num_on_line
+            vel_crds = self.read_crds(3 * self.num_atoms)
 
             if not self.box:
-                return np.array(crds), np.array(vel_crds)
-
+                return crds, vel_crds
 
         line = f.next()
-        num_on_line = len(line)/crd_len
-
-        box_crds = []
-        last_idx = 0
-        for next_idx in xrange(crd_len, crd_len * (num_on_line+1), crd_len):
-            box_crds.append(floatx(line[last_idx:next_idx]))
-            last_idx = next_idx
+        num_on_line = len(line)//self.crd_len
 
+        box_crds = decode_fields([line], num_on_line, self.crd_len, self.crd_per_line)
 
         if self.dynamics:
-            return np.array(crds), np.array(vel_crds), np.array(box_crds)
+            return crds, vel_crds, box_crds
+
+        return crds, box_crds
 
-        return np.array(crds), np.array(box_crds)
-        
 
     def read(self):
         return self.next()
@@ -125,38 +114,37 @@ class RSTFile(object):
         if self._written:
             raise RSTError("Attempt to write more than one geometry to RST file.")
 
-        f = self.file
-
-        f.write('%5d\n' % (len(x)//3))
-
-        if self.box:
+        vel = None
+        box = None
+        if self.dynamics and self.box:
+            x, vel, box = x
+        elif self.dynamics:
+            x, vel = x
+        elif self.box:
             x, box = x
-        else:
-            box=None
+
+        x = np.asarray(x, dtype=float).reshape((-1,))
 
         fmt = self.crd_fmt
         crd_per_line = self.crd_per_line
 
+        parts = [x]
+        template = '%5d\n' % (len(x)//3) + encode_template(len(x), fmt, crd_per_line)
+
+        if vel is not None:
+            vel = np.asarray(vel, dtype=float).reshape((-1,))
+            parts.append(vel)
+            template += encode_template(len(vel), fmt, crd_per_line)
+
+        if box is not None:
+            box = np.asarray(box, dtype=float).reshape((-1,))
+            parts.append(box)
+            template += fmt * len(box) + '\n'
+
+        self.file.write(template % tuple(np.concatenate(parts).tolist()))
+        self._written = True
+
 
-        crd_count = 0
-        for crd in x:
-            f.write(fmt % crd)
-            crd_count += 1
-            if crd_count == crd_per_line:
-                f.write('\n')
-                crd_count = 0
-
-        if crd_count != 0:
-            f.write('\n')
-            
-        if box:
-            for crd in box:
-                f.write(fmt % crd)
-                crd_count += 1
-
-            f.write('\n')
-            
-        
 open=RSTFile
 
 def write_rst(filename, coord, comment=None, dynamics=False, box=False):
@@ -169,4 +157,57 @@ def read_rst(filename, dynamics=False, box=False):
     with RSTFile(filename, 'r', dynamics=dynamics, box=box) as f:
         return f.read()
 
-        
+
+def _read_rst_work(work):
+    filename, dynamics, box = work
+    return read_rst(filename, dynamics=dynamics, box=box)
+
+def _write_rst_work(work):
+    filename, coord, comment, dynamics, box = work
+    write_rst(filename, coord, comment=comment, dynamics=dynamics, box=box)
+
+def stack_rows(rows, filenames):
+    try:
+        return np.vstack(rows)
+    except ValueError:
+        shapes = set(row.shape for row in rows)
+        raise RSTError("rst files do not have the same number of atoms: %s (%s...)" % (sorted(shapes), ', '.join(filenames[:3])))
+
+def read_rsts(filenames, dynamics=False, box=False, processes=None, threads=False):
+    """Return the geometries of many rst files as (num_files, 3N) arrays.
+
+    The result follows read_rst: coordinates alone, or a tuple of the
+    coordinate array followed by the velocity and/or box arrays.  The
+    files are read in a process pool, or a thread pool if threads is
+    True.
+
+    """
+    filenames = list(filenames)
+    results = list(parallel.imap(_read_rst_work, [(filename, dynamics, box) for filename in filenames],
+                                 processes=processes, threads=threads))
+
+    if not dynamics and not box:
+        return stack_rows(results, filenames)
+
+    return tuple(stack_rows(parts, filenames) for parts in zip(*results))
+
+
+def write_rsts(filenames, coords, comment=None, dynamics=False, box=False, processes=None, threads=False):
+    """Write one rst file per row of coords.
+
+    coords is laid out like the result of read_rsts with the same
+    dynamics and box options, so that rst sets can be round tripped.
+
+    """
+    filenames = list(filenames)
+
+    if dynamics or box:
+        rows = zip(*coords)
+    else:
+        rows = list(coords)
+
+    if len(rows) != len(filenames):
+        raise RSTError("Number of geometries does not match number of file names: %d != %d" % (len(rows), len(filenames)))
+
+    list(parallel.imap(_write_rst_work, [(filename, row, comment, dynamics, box) for filename, row in zip(filenames, rows)],
+                       processes=processes, threads=threads))
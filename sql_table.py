@@ -2,12 +2,15 @@
 import os
 import inspect
 import sqlite3
+import threading
 import time
 from datetime import datetime
 
 
 import contextlib as cl
 
+import numpy as np
+
 debug_sql = os.getenv('DEBUGSQL')
 
 class DatabaseError(sqlite3.DatabaseError):
@@ -34,6 +37,7 @@ class AbstractSQLColumn(object):
     """
 
     primary_key = False
+    indexes = tuple()
     column_type=''
     
     declaration_count = 0
@@ -120,6 +124,14 @@ def convert_to_sql_type(x):
         raise SQLDeclarationError("Unknown SQL type: %s (%s)" % (type(x), x))
         
 
+def key_select(item):
+    """Return the select of the keys of a single column table (such as a key set), or item itself."""
+    if isinstance(item, SQLTable):
+        if len(item.columns) != 1:
+            raise SQLDeclarationError('Table "%s" used as a set of keys has %d columns.' % (item.table_name, len(item.columns)))
+        return select(item.columns)
+    return item
+
 def sql_expr(expr):
     """Create an SQLExpr from the argument."""
     if isinstance(expr, SQLExpr):
@@ -184,10 +196,10 @@ class SQLExpr(object):
 
 
     def is_in(self, item):
-        return SQLIn(self, item)
+        return SQLIn(self, key_select(item))
 
     def not_in(self, item):
-        return SQLNotIn(self, item)
+        return SQLNotIn(self, key_select(item))
 
 
 class SQLNot(SQLExpr):
@@ -268,6 +280,71 @@ class SQLIn(SQLBinaryOp):
 class SQLNotIn(SQLBinaryOp):
     op = ' NOT IN '
 
+class SQLFunction(SQLExpr):
+    """Abstract base class of sql functions (such as aggregates) of an expression."""
+
+    def __init__(self, inner_expr):
+        self.inner_expr = sql_expr(inner_expr)
+
+    @property
+    def expr(self):
+        return '%s(%s)' % (self.function, self.inner_expr.expr)
+
+    @property
+    def columns(self):
+        return self.inner_expr.columns
+
+    @property
+    def args(self):
+        return self.inner_expr.args
+
+    def __str__(self):
+        return ' %s(%s) ' % (self.function, self.inner_expr)
+
+class SQLMax(SQLFunction):
+    function = 'MAX'
+
+class SQLMin(SQLFunction):
+    function = 'MIN'
+
+class SQLCount(SQLFunction):
+    function = 'COUNT'
+
+class SQLSum(SQLFunction):
+    function = 'SUM'
+
+class SQLAvg(SQLFunction):
+    function = 'AVG'
+
+
+class SQLOrdering(SQLExpr):
+    """Abstract base class of the direction of an ORDER BY term."""
+
+    def __init__(self, inner_expr):
+        self.inner_expr = sql_expr(inner_expr)
+
+    @property
+    def expr(self):
+        return '%s %s' % (self.inner_expr.expr, self.direction)
+
+    @property
+    def columns(self):
+        return self.inner_expr.columns
+
+    @property
+    def args(self):
+        return self.inner_expr.args
+
+    def __str__(self):
+        return ' %s %s ' % (self.inner_expr, self.direction)
+
+class SQLAsc(SQLOrdering):
+    direction = 'ASC'
+
+class SQLDesc(SQLOrdering):
+    direction = 'DESC'
+
+
 def sql_not(x):
     if isinstance(x, SQLIn):
         return SQLNotIn(x.left, x.right)
@@ -303,6 +380,27 @@ class ConcreteSQLColumn(SQLExpr):
     def is_join_key(self):
         return self.foreign_key and self.is_primary_key()
 
+    def max(self):
+        return SQLMax(self)
+
+    def min(self):
+        return SQLMin(self)
+
+    def count(self):
+        return SQLCount(self)
+
+    def sum(self):
+        return SQLSum(self)
+
+    def avg(self):
+        return SQLAvg(self)
+
+    def asc(self):
+        return SQLAsc(self)
+
+    def desc(self):
+        return SQLDesc(self)
+
     @property
     def foreign_key_clause(self):
         foreign_key = self.foreign_key
@@ -367,6 +465,42 @@ class PrimaryKey(object):
     def __init__(self, *columns):
         self.columns = columns
 
+def index(*columns):
+    """Declare an index on the columns of an SQLTable."""
+    if columns == tuple():
+        raise SQLDeclarationError('An index requires at least one column.')
+    declared_index = Index(*columns)
+    for column in columns:
+        assert isinstance(column, AbstractSQLColumn)
+        column.indexes = column.indexes + (declared_index,)
+    return declared_index
+
+class Index(object):
+
+    declaration_count = 0
+
+    def __init__(self, *columns):
+        self.declaration_order = Index.declaration_count
+        Index.declaration_count += 1
+        self.columns = columns
+
+class ConcreteIndex(object):
+
+    def __init__(self, *concrete_columns):
+        assert all(isinstance(column, ConcreteSQLColumn) for column in concrete_columns)
+        self.columns = tuple(concrete_columns)
+
+    @property
+    def index_name(self):
+        table_name = self.columns[0].table.table_name
+        return '_'.join(('idx', table_name) + tuple(column.unqualified_name for column in self.columns))
+
+    def sql_index(self):
+        index_name = self.index_name
+        table_name = self.columns[0].table.table_name
+        index_columns = ', '.join(column.unqualified_name for column in self.columns)
+        return 'CREATE INDEX IF NOT EXISTS %(index_name)s ON %(table_name)s (%(index_columns)s);' % locals()
+
 class ConcretePrimaryKey(object):
 
     def __init__(self, *concrete_columns):
@@ -429,6 +563,9 @@ class SQLTable(object):
 
     __metaclass__ = SQLTableMetaClass
 
+    # Temporary tables are private to the connection and dropped when it is closed.
+    temporary = False
+
     @property
     def table_name(self):
         try:
@@ -457,6 +594,7 @@ class SQLTable(object):
         table_name = self.table_name
         columns = []
         primary_keys = []
+        concrete_columns = {}
         table = self
 
         foreign_tables = {}
@@ -491,6 +629,7 @@ class SQLTable(object):
             concrete_column = ConcreteSQLColumn(table, member_name, abstract_column, **column_kwargs)
             setattr(self, member_name, concrete_column)
             columns.append(concrete_column)
+            concrete_columns[id(abstract_column)] = concrete_column
             if concrete_column.is_primary_key():
                 primary_keys.append(concrete_column)
         self.columns = columns
@@ -500,6 +639,15 @@ class SQLTable(object):
 
 
         self.primary_key = ConcretePrimaryKey(*primary_keys)
+
+        declared_indexes = dict((id(declared_index), declared_index)
+                                for column_name_in_declaration, abstract_column in self.abstract_columns()
+                                for declared_index in abstract_column.indexes)
+        self.indexes = []
+        for declared_index in sorted(declared_indexes.values(), key=lambda i: i.declaration_order):
+            if not all(id(column) in concrete_columns for column in declared_index.columns):
+                raise SQLDeclarationError('Index on columns not in table "%s"' % self.table_name)
+            self.indexes.append(ConcreteIndex(*[concrete_columns[id(column)] for column in declared_index.columns]))
             
 
     def sql_table(self):
@@ -515,9 +663,13 @@ class SQLTable(object):
 
         sql_lines = ',\n'.join(sql_lines)
 
-        return """CREATE TABLE IF NOT EXISTS %(table_name)s (
+        sql_indexes = ''.join('\n' + concrete_index.sql_index() for concrete_index in self.indexes)
+
+        temporary = 'TEMP ' if self.temporary else ''
+
+        return """CREATE %(temporary)sTABLE IF NOT EXISTS %(table_name)s (
 %(sql_lines)s
-);""" % locals()
+);%(sql_indexes)s""" % locals()
 
     def __str__(self):
         return self.sql_table() + '[%s]' % id(self)
@@ -627,6 +779,8 @@ def __parse_table_tokens(tokens, ref_tables):
     def acceptable_token(acceptable, leave=False):
         acceptable = [x.upper() for x in acceptable]
 
+        if tokens == []:
+            return False
         token = tokens.pop()
 
         if token.upper() in acceptable:
@@ -641,7 +795,7 @@ def __parse_table_tokens(tokens, ref_tables):
 
     expect_token('CREATE')
 
-    acceptable_token(['TEMP', 'TEMPORARY'])
+    temporary = bool(acceptable_token(['TEMP', 'TEMPORARY']))
 
     expect_token('TABLE')
 
@@ -736,8 +890,11 @@ def __parse_table_tokens(tokens, ref_tables):
             self.column_names = column_names
 
         def apply(self, clsdict):
-            assert self.constraint_type == 'PRIMARY'
-            primary_key(*[clsdict[column_name] for column_name in self.column_names])
+            if self.constraint_type == 'INDEX':
+                index(*[clsdict[column_name] for column_name in self.column_names])
+            else:
+                assert self.constraint_type == 'PRIMARY'
+                primary_key(*[clsdict[column_name] for column_name in self.column_names])
 
 
     def parse_table_constraint():
@@ -763,6 +920,26 @@ def __parse_table_tokens(tokens, ref_tables):
 
         return TableConstraint(constraint_type, primary_column_names)
 
+    def parse_index():
+        expect_token('CREATE')
+        expect_token('INDEX')
+        if acceptable_token(['IF']):
+            expect_tokens(['NOT', 'EXISTS'])
+        parse_name()
+        expect_token('ON')
+        if parse_name() != the_table_name:
+            raise SQLSyntaxError('Index is not on table "%s"' % the_table_name)
+        expect_token('(')
+
+        index_column_names = [parse_name()]
+        while acceptable_token([',']):
+            index_column_names.append(parse_name())
+
+        expect_token(')')
+        acceptable_token([';'])
+
+        return TableConstraint('INDEX', index_column_names)
+
     columns = []
     table_constraints = []
             
@@ -777,9 +954,14 @@ def __parse_table_tokens(tokens, ref_tables):
             columns.append(parse_column())
 
     expect_token(')')
+    acceptable_token([';'])
 
+    # Any indexes on the table follow its declaration.
+    while tokens != []:
+        table_constraints.append(parse_index())
 
-    clsdict = {'table_name': the_table_name}
+
+    clsdict = {'table_name': the_table_name, 'temporary': temporary}
 
     required_tables = []
 
@@ -870,8 +1052,56 @@ def join_pairs(tables):
     return join_pairs
         
 
-def select(columns, where=None):
-    all_columns = columns[:]
+# numpy dtypes of the values of each column type, for select_arrays.
+column_dtypes = {'INTEGER': int, 'REAL': float}
+
+def expr_dtype(expr):
+    """Return the numpy dtype of the values of a selected expression."""
+    if isinstance(expr, SQLCount):
+        return int
+    if isinstance(expr, SQLAvg):
+        return float
+    if isinstance(expr, SQLFunction):
+        return expr_dtype(expr.inner_expr)
+    if isinstance(expr, ConcreteSQLColumn):
+        return column_dtypes.get(expr.abstract_column_obj.column_type, object)
+    return object
+
+def rows_arrays(rows, dtypes):
+    """Return a tuple with an array of each column of the rows.
+
+    NULLs become nan in REAL columns, and make other columns object
+    arrays.
+
+    """
+    arrays = []
+    for values, dtype in zip(zip(*rows), dtypes):
+        try:
+            arrays.append(np.array(values, dtype=dtype))
+        except (TypeError, ValueError):
+            arrays.append(np.array(values, dtype=object))
+    return tuple(arrays)
+
+def as_list(exprs):
+    if exprs is None:
+        return []
+    if isinstance(exprs, SQLExpr):
+        return [exprs]
+    return list(exprs)
+
+def select(columns, where=None, order_by=None, group_by=None, limit=None, offset=None):
+    """Return the SQLExpr selecting the columns (or sql functions of them) from their joined tables.
+
+    order_by and group_by are an expression or a list of expressions;
+    columns are ordered in descending order with column.desc().
+
+    """
+    order_by = as_list(order_by)
+    group_by = as_list(group_by)
+
+    all_columns = []
+    for expr in columns + order_by + group_by:
+        all_columns.extend(expr.columns)
     if where:
         all_columns.extend(where.columns)
 
@@ -884,7 +1114,7 @@ def select(columns, where=None):
 
     # tables.sort(key=lambda t: sum(1 for c in t.columns if c.foreign_key in joinable_keys and  c.foreign_key in joinable_keys))
 
-    result_columns = ', '.join(column.qualified_name for column in columns)
+    result_columns = ', '.join(column.expr for column in columns)
 
     # Find a common foreign key, and inner join on that
 
@@ -903,24 +1133,182 @@ def select(columns, where=None):
     # join_source = ', '.join(table.table_name for table in tables)
 
     expr = ''
-    args = tuple()
     if where:
         expr = ' WHERE %s' % where.expr
-        args = where.args
+
+    if group_by:
+        expr += ' GROUP BY %s' % ', '.join(group_expr.expr for group_expr in group_by)
+
+    if order_by:
+        expr += ' ORDER BY %s' % ', '.join(order_expr.expr for order_expr in order_by)
+
+    if limit is not None or offset is not None:
+        expr += ' LIMIT ?'
+    if offset is not None:
+        expr += ' OFFSET ?'
 
     sql = 'SELECT %(result_columns)s FROM %(join_source)s%(expr)s' % locals()
 
-    return SQLExpr(sql, tuple(), args)
+    return SQLExpr(sql, tuple(), select_args(columns, where, order_by, group_by, limit, offset))
+
+def select_args(columns, where=None, order_by=None, group_by=None, limit=None, offset=None):
+    """Return the args of the select, in the order of their placeholders."""
+    args = tuple()
+    for expr in columns:
+        args += expr.args
+    if where:
+        args += where.args
+    for expr in as_list(group_by) + as_list(order_by):
+        args += expr.args
+
+    if limit is not None or offset is not None:
+        # sqlite requires a LIMIT for an OFFSET; -1 is no limit.
+        args += (-1 if limit is None else int(limit),)
+    if offset is not None:
+        args += (int(offset),)
+    return args
+
+class KeySet(SQLTable):
+    """Temporary table of integer keys, to filter selects with is_in and not_in."""
+    temporary = True
+    key = Integer()
+    primary_key(key)
 
 class Vars(SQLTable):
     name = Text(unique=True)
     value = Text()
 
+class Blobs(SQLTable):
+    name = Text(unique=True)
+    value = Blob()
+
+
+# PRAGMA settings of the connection profiles.  WAL journaling lets
+# readers proceed while a writer commits; bulk-load additionally skips
+# the fsync on each commit.  With synchronous=OFF a crash of the
+# process is safe, but an operating system crash or power loss can
+# corrupt the database, so it is only for data which can be reloaded.
+connection_profiles = {
+    'safe': [('journal_mode', 'DELETE'),
+             ('synchronous', 'FULL'),
+             ('cache_size', '-2000'),
+             ('mmap_size', '0'),
+             ('temp_store', 'DEFAULT')],
+    'read-mostly': [('journal_mode', 'WAL'),
+                    ('synchronous', 'NORMAL'),
+                    ('cache_size', '-65536'),
+                    ('mmap_size', '1073741824'),
+                    ('temp_store', 'MEMORY')],
+    'bulk-load': [('journal_mode', 'WAL'),
+                  ('synchronous', 'OFF'),
+                  ('cache_size', '-262144'),
+                  ('mmap_size', '268435456'),
+                  ('temp_store', 'MEMORY')],
+    }
+
+class ConnectionProfileError(DatabaseError):
+    pass
+
+
+class BulkWriter(object):
+    """Buffer of rows to insert into tables, written with executemany every batch_rows rows.
+
+    Rows of each table are inserted in the order they are given, but
+    the order of the inserts into different tables is not kept.
+
+    """
+
+    def __init__(self, db, batch_rows=50000):
+        self.db = db
+        self.batch_rows = batch_rows
+        self.buffers = {}
+        self.num_rows = 0
+        self.start_time = time.time()
+        self.elapsed = None
+
+    def insert(self, table, values):
+        """Add the rows in values to the buffer of table, flushing it when it is full."""
+        table_name = table.table_name
+        try:
+            buffer_table, rows = self.buffers[table_name]
+        except KeyError:
+            rows = []
+            self.buffers[table_name] = table, rows
+        else:
+            if buffer_table is not table:
+                raise TableError("Table '%s' was redefined while its rows are buffered." % table_name)
+
+        for row in values:
+            rows.append(row)
+            if len(rows) >= self.batch_rows:
+                self.flush_table(table)
+
+    def flush_table(self, table):
+        """Insert the buffered rows of table."""
+        table, rows = self.buffers.get(table.table_name, (table, []))
+        if rows:
+            self.db.insert(table, rows)
+            self.num_rows += len(rows)
+            del rows[:]
+            if table.table_name == 'vars':
+                self.db.invalidate_vars()
+
+    def flush(self):
+        """Insert all the buffered rows."""
+        for table, rows in self.buffers.values():
+            self.flush_table(table)
+
+    def finish(self):
+        self.flush()
+        self.elapsed = time.time() - self.start_time
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - self.start_time
+        if elapsed <= 0.:
+            return float('inf') if self.num_rows else 0.
+        return self.num_rows / elapsed
+
+    def report(self):
+        return 'Inserted %d rows (%.0f rows/s)' % (self.num_rows, self.rows_per_second)
+
+
+class PendingWriteError(DatabaseError):
+    pass
+
+
+# Authorizer actions which change the database (or temp) named in their
+# fourth argument.
+write_actions = set([sqlite3.SQLITE_CREATE_INDEX, sqlite3.SQLITE_CREATE_TABLE,
+                     sqlite3.SQLITE_CREATE_TEMP_INDEX, sqlite3.SQLITE_CREATE_TEMP_TABLE,
+                     sqlite3.SQLITE_CREATE_TEMP_TRIGGER, sqlite3.SQLITE_CREATE_TEMP_VIEW,
+                     sqlite3.SQLITE_CREATE_TRIGGER, sqlite3.SQLITE_CREATE_VIEW,
+                     sqlite3.SQLITE_DELETE, sqlite3.SQLITE_DROP_INDEX, sqlite3.SQLITE_DROP_TABLE,
+                     sqlite3.SQLITE_DROP_TEMP_INDEX, sqlite3.SQLITE_DROP_TEMP_TABLE,
+                     sqlite3.SQLITE_DROP_TEMP_TRIGGER, sqlite3.SQLITE_DROP_TEMP_VIEW,
+                     sqlite3.SQLITE_DROP_TRIGGER, sqlite3.SQLITE_DROP_VIEW,
+                     sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+                     sqlite3.SQLITE_REINDEX, sqlite3.SQLITE_ANALYZE])
+
+# Authorizer actions which are always denied.
+denied_actions = set([sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH, sqlite3.SQLITE_ALTER_TABLE])
+
+def temporary_writes_authorizer(action, arg1, arg2, database_name, trigger_name):
+    """sqlite3 authorizer which only allows changes to temporary tables."""
+    if action in denied_actions:
+        return sqlite3.SQLITE_DENY
+    if action in write_actions and database_name != 'temp':
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
 
 class DatabaseMixin(object):
 
     __tables = None
 
+    # Size of the sqlite3 cache of prepared statements on the connection.
+    cached_statements = 256
+
     @property
     def tables(self):
         if self.__tables is not None:
@@ -942,10 +1330,80 @@ class DatabaseMixin(object):
                     raise DatabaseError("Database does not exist: %s" % dbname)
         create = not os.path.exists(dbname)
 
-        self.sql_db = sqlite3.connect(dbname)
+        self.sql_db = sqlite3.connect(dbname, cached_statements=self.cached_statements)
+        self.owner_thread = threading.current_thread()
+        self.thread_local = threading.local()
+        self.__read_connections = []
+        self.__read_connections_lock = threading.Lock()
 
         return create
 
+    def is_owner_thread(self):
+        """True in the thread which opened the database, the only thread which may write to it."""
+        return threading.current_thread() is self.owner_thread
+
+    @property
+    def connection(self):
+        """The connection used by the current thread.
+
+        The thread which opened the database uses the writable
+        connection sql_db; other threads each get their own read only
+        connection.
+
+        """
+        if self.is_owner_thread():
+            return self.sql_db
+        if self.write_pending:
+            raise PendingWriteError("The thread which opened '%s' has uncommitted writes, which other threads can not see." % self.dbname)
+        return self.read_connection()
+
+    # Set while the writable connection has uncommitted changes.
+    write_pending = False
+
+    def track_transaction(self, sql):
+        """Follow whether sql leaves uncommitted changes on the writable connection.
+
+        The sqlite3 module begins a transaction before INSERT, UPDATE,
+        DELETE and REPLACE statements, and commits before any statement
+        other than these and SELECT.
+
+        """
+        words = sql.split(None, 1)
+        statement = words[0].upper() if words else ''
+        if statement in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+            self.write_pending = True
+        elif statement != 'SELECT':
+            self.write_pending = False
+
+    def read_connection(self):
+        """Return the read only connection of the current thread, opening it if needed.
+
+        The connection may only write to its own temporary tables.  It
+        is in autocommit mode, so that those writes leave no transaction
+        open to block the commits of the owner thread or keep the reader
+        on an old snapshot.
+
+        """
+        try:
+            return self.thread_local.sql_db
+        except AttributeError:
+            pass
+
+        # The connection is closed by the owner thread in close, but
+        # otherwise only used by the thread which opened it.
+        sql_db = sqlite3.connect(self.dbname, cached_statements=self.cached_statements, check_same_thread=False,
+                                 isolation_level=None)
+        sql_db.set_authorizer(temporary_writes_authorizer)
+        if self.connection_profile is not None:
+            for name, value in connection_profiles[self.connection_profile]:
+                if name not in ('journal_mode', 'synchronous'):
+                    sql_db.execute('PRAGMA %s=%s' % (name, value))
+
+        with self.__read_connections_lock:
+            self.__read_connections.append(sql_db)
+        self.thread_local.sql_db = sql_db
+        return sql_db
+
     def __create_tables(self, tables):
         sql = ';\n'.join(table.sql_table() for table in tables)
         self.executescript(sql)
@@ -963,9 +1421,19 @@ class DatabaseMixin(object):
 
     @property
     def __master_sql_table(self):
-        for sql, in self.execute("SELECT sql FROM sqlite_master"):
-            if sql:
-                yield sql
+        """Yield the sql of each table, followed by the sql of its indexes."""
+        table_sqls = []
+        index_sqls = {}
+        for sql_type, table_name, sql in list(self.execute("SELECT type, tbl_name, sql FROM sqlite_master")):
+            if not sql:
+                continue
+            if sql_type == 'index':
+                index_sqls.setdefault(table_name.lower(), []).append(sql)
+            elif sql_type == 'table':
+                table_sqls.append((table_name.lower(), sql))
+
+        for table_name, sql in table_sqls:
+            yield ';\n'.join([sql] + index_sqls.get(table_name, []))
 
     def _add_table(self, table):
         assert isinstance(table, SQLTable)
@@ -973,6 +1441,9 @@ class DatabaseMixin(object):
         assert any(name.lower() == table_name for name in self.__master_table_names), "tried to _add_table a table not in the sql database."
 
         self.__tables.append(table)
+        self.invalidate_sql_cache()
+        if table_name == 'vars':
+            self.invalidate_vars()
 
         setattr(self, table.table_name.lower(), table)
 
@@ -987,6 +1458,35 @@ class DatabaseMixin(object):
         delattr(self, table_name.lower())
         self.__tables = [atable for atable in self.__tables 
                          if not table.table_name.lower() == atable.table_name.lower()]
+        self.invalidate_sql_cache()
+        if table_name == 'vars':
+            self.invalidate_vars()
+
+    __sql_cache = None
+    sql_cache_hits = 0
+    sql_cache_misses = 0
+
+    @property
+    def sql_cache(self):
+        """The sql text of previous statements, keyed by their shape."""
+        if self.__sql_cache is None:
+            self.__sql_cache = {}
+        return self.__sql_cache
+
+    def invalidate_sql_cache(self):
+        self.sql_cache.clear()
+
+    def cached_sql(self, key, build_sql):
+        """Return the sql cached under key, calling build_sql to create it if needed."""
+        sql_cache = self.sql_cache
+        try:
+            sql = sql_cache[key]
+        except KeyError:
+            self.sql_cache_misses += 1
+            sql = sql_cache[key] = build_sql()
+        else:
+            self.sql_cache_hits += 1
+        return sql
 
     def __init__(self, dbname, *args, **kwargs):
 
@@ -997,15 +1497,48 @@ class DatabaseMixin(object):
 
         create = self.__open_sql_db(dbname, create)
 
+        # Apply the profile before anything is written, so that it
+        # also governs the creation of the tables.
+        profile = kwargs.get('profile')
+        if profile is not None:
+            self.apply_connection_profile(profile)
+
         for sql in self.__master_sql_table:
             new_table = self._add_table(parse_table(sql, ref_tables=self.tables))
 
+        if profile is None and self.has_table('vars'):
+            stored_profile = self.get_var('connection_profile')
+            if stored_profile is not None:
+                self.apply_connection_profile(stored_profile)
+
         if create:
             with self.session():
                 self.create_tables(*args, **kwargs)
 
         self.__last_checkpoint = time.time()
 
+        if profile is not None:
+            with self.session():
+                self.set_var('connection_profile', profile)
+
+    def apply_connection_profile(self, profile):
+        """Set the PRAGMAs of the named connection profile on the open connection."""
+        try:
+            pragmas = connection_profiles[profile]
+        except KeyError:
+            raise ConnectionProfileError("Unknown connection profile '%s'; expected one of %s" % (profile, ', '.join(sorted(connection_profiles))))
+
+        for name, value in pragmas:
+            list(self.execute('PRAGMA %s=%s' % (name, value)))
+        self.connection_profile = profile
+
+    def set_connection_profile(self, profile):
+        """Apply the connection profile and record it in Vars, so that later opens reapply it."""
+        self.apply_connection_profile(profile)
+        self.set_var('connection_profile', profile)
+
+    connection_profile = None
+
     def has_table(self, table_name):
         table_name = table_name.lower()
         for table in self.tables:
@@ -1049,11 +1582,15 @@ class DatabaseMixin(object):
     def create_tables(self, *args, **kwargs):
         self.new_table(Vars())
 
+    # Number of rows inserted between checks of the checkpoint time.
+    checkpoint_rows = 1000
+
     def checkpoint(self, check_time=5*60.):
         current_checkpoint = time.time()
         delta = current_checkpoint - self.__last_checkpoint
         if delta > check_time:
             self.sql_db.commit()
+            self.write_pending = False
             self.__last_checkpoint = current_checkpoint
 
     @cl.contextmanager
@@ -1065,16 +1602,43 @@ class DatabaseMixin(object):
                 self.set_modification_time()
 
             self.sql_db.commit()
+            self.write_pending = False
         except:
             self.sql_db.rollback()
+            self.write_pending = False
+            self.invalidate_vars()
             raise
 
+    @cl.contextmanager
+    def bulk_writer(self, batch_rows=50000, verbose=False, session=True):
+        """Context of a BulkWriter, whose rows are all inserted in a single session.
+
+        If anything fails, none of the rows are inserted.  With
+        session=False the rows are inserted in the caller's
+        transaction, which is neither committed nor rolled back.
+
+        """
+        writer = BulkWriter(self, batch_rows=batch_rows)
+        if session:
+            with self.session():
+                yield writer
+                writer.finish()
+        else:
+            yield writer
+            writer.finish()
+        if verbose:
+            print writer.report()
+
     def close(self):
+        with self.__read_connections_lock:
+            for sql_db in self.__read_connections:
+                sql_db.close()
+            self.__read_connections = []
         self.sql_db.close()
 
     @cl.contextmanager
     def cursor(self):
-        c = self.sql_db.cursor()
+        c = self.connection.cursor()
         try:
             yield c
         finally:
@@ -1082,6 +1646,8 @@ class DatabaseMixin(object):
 
     def execute(self, sql, args=tuple()):
         global debug_sql
+        if self.is_owner_thread():
+            self.track_transaction(sql)
         with self.cursor() as c:
             if debug_sql=='ALL':
                 print sql, args
@@ -1096,16 +1662,39 @@ class DatabaseMixin(object):
                 yield c.lastrowid
 
 
+    def execute_blocks(self, sql, args=tuple(), block=10000):
+        """Yield the rows of the result of sql in lists of at most block rows."""
+        global debug_sql
+        with self.cursor() as c:
+            if debug_sql=='ALL':
+                print sql, args
+            try:
+                c.execute(sql, args)
+                while True:
+                    rows = c.fetchmany(block)
+                    if not rows:
+                        break
+                    yield rows
+            except GeneratorExit:
+                raise
+            except:
+                if debug_sql:
+                    print 'Exception when executing "%s" with args "%s"' % (sql, args)
+                raise
+
     def executemany(self, sql, args=tuple(), checkpoint=False):
         global debug_sql
 
         if checkpoint:
             def checkpointed_args(args):
-                for arg in args:
-                    self.checkpoint()
+                for idx, arg in enumerate(args):
+                    if idx % self.checkpoint_rows == 0:
+                        self.checkpoint()
                     yield arg
             args = checkpointed_args(args)
 
+        if self.is_owner_thread():
+            self.track_transaction(sql)
         with self.cursor() as c:
             if debug_sql=='ALL':
                 print sql, args
@@ -1120,6 +1709,9 @@ class DatabaseMixin(object):
 
     def executescript(self, sql):
         global debug_sql
+        if self.is_owner_thread():
+            # executescript commits first, and runs the script without a transaction.
+            self.write_pending = False
         with self.cursor() as c:
             if debug_sql=='ALL':
                 print sql
@@ -1133,71 +1725,213 @@ class DatabaseMixin(object):
 
     def insert(self, table, values=[], checkpoint=False):
 
+        no_values = values == []
+        sql = self.cached_sql(('insert', table.table_name, no_values), lambda: self.insert_sql(table, no_values))
+
+        if no_values:
+            for lastrowid in self.execute(sql):
+                return lastrowid
+        else:
+            self.executemany(sql, values, checkpoint=checkpoint)
+
+    def insert_sql(self, table, no_values=False):
         table_name = table.table_name
         column_objs = table.columns
         columns = 'DEFAULT'
         qs = ''
         num_columns = len(column_objs)
-        if (num_columns > 1) or (num_columns > 0 and values != []):
+        if (num_columns > 1) or (num_columns > 0 and not no_values):
             columns = '(%s)' % (', '.join(column_obj.unqualified_name for column_obj in column_objs))
             qs = ' (%s)' % (', '.join('?' for column_obj in column_objs))            
 
-        sql = "INSERT OR REPLACE INTO %(table_name)s %(columns)s VALUES%(qs)s" % locals()
+        return "INSERT OR REPLACE INTO %(table_name)s %(columns)s VALUES%(qs)s" % locals()
 
-        if values == []:
-            for lastrowid in self.execute(sql):
-                return lastrowid
-        else:
-            self.executemany(sql, values, checkpoint=checkpoint)
+    def select_sql(self, columns, where=None, order_by=None, group_by=None, limit=None, offset=None):
+        """Return the sql and args of the select.
 
-    def select(self, columns, where=None):
+        The sql, including the join of the tables, only depends on the
+        expressions of the query and not on their values, so it is
+        built once for each shape of query.
 
-        select_expr = select(columns, where)
+        """
+        key = ('select',
+               tuple(column.expr for column in columns),
+               where.expr if where else None,
+               tuple(expr.expr for expr in as_list(order_by)),
+               tuple(expr.expr for expr in as_list(group_by)),
+               limit is not None, offset is not None)
+        sql = self.cached_sql(key, lambda: select(columns, where, order_by, group_by, limit, offset).expr)
+        return sql, select_args(columns, where, order_by, group_by, limit, offset)
 
-        sql, args = select_expr.expr, select_expr.args
+    def select(self, columns, where=None, order_by=None, group_by=None, limit=None, offset=None):
+
+        sql, args = self.select_sql(columns, where, order_by=order_by, group_by=group_by, limit=limit, offset=offset)
 
         for row in self.execute(sql, args):
             yield row
 
+    def iter_select_arrays(self, columns, where=None, order_by=None, group_by=None, limit=None, offset=None, block=10000):
+        """Yield a tuple of arrays of the values of each column, for blocks of at most block rows."""
+        sql, args = self.select_sql(columns, where, order_by=order_by, group_by=group_by, limit=limit, offset=offset)
+        dtypes = [expr_dtype(column) for column in columns]
+
+        for rows in self.execute_blocks(sql, args, block=block):
+            yield rows_arrays(rows, dtypes)
+
+    def select_arrays(self, columns, where=None, order_by=None, group_by=None, limit=None, offset=None, block=10000):
+        """Return a tuple of arrays of the values of each column.
+
+        The rows are fetched from sqlite block rows at a time.
+
+        """
+        blocks = list(self.iter_select_arrays(columns, where, order_by=order_by, group_by=group_by,
+                                              limit=limit, offset=offset, block=block))
+        if blocks == []:
+            return tuple(np.zeros(0, dtype=expr_dtype(column)) for column in columns)
+        return tuple(np.concatenate(arrays) for arrays in zip(*blocks))
+
+    def select_one(self, columns, where=None, order_by=None, group_by=None):
+        """Return the first row of the select, or None."""
+        rows = list(self.select(columns, where, order_by=order_by, group_by=group_by, limit=1))
+        if rows == []:
+            return None
+        return rows[0]
 
-    # TODO: create column modifiers so that sql functions of columns like MAX can be selected via regular db.select
-    def select_max(self, column):
-        column_name = column.unqualified_name
-        table_name = column.table.table_name
+    def select_max(self, column, where=None):
+        return self.select_one([column.max()], where=where)[0]
 
-        sql = 'SELECT MAX(%(column_name)s) FROM %(table_name)s' % locals()
-        for row in self.execute(sql):
-            return row[0]
+    def select_min(self, column, where=None):
+        return self.select_one([column.min()], where=where)[0]
+
+    def select_min_max(self, column, where=None):
+        return self.select_one([column.min(), column.max()], where=where)
+
+    def select_count(self, column, where=None):
+        return self.select_one([column.count()], where=where)[0]
+
+
+    __vars = None
+
+    @property
+    def vars_cache(self):
+        """The Vars table as a dict, read once and then kept up to date by set_var."""
+        if self.__vars is not None:
+            return self.__vars
 
+        if not self.has_table('vars'):
+            return {}
 
-    def select_min(self, column):
-        column_name = column.unqualified_name
-        table_name = column.table.table_name
+        self.__vars = dict(self.select([self.vars.name, self.vars.value]))
+        return self.__vars
 
-        sql = 'SELECT MIN(%(column_name)s) FROM %(table_name)s' % locals()
-        for row in self.execute(sql):
-            return row[0]
+    def invalidate_vars(self):
+        """Forget the cached Vars, so that values written by other connections are read."""
+        self.__vars = None
 
+    def new_key_set(self, keys):
+        """Return a KeySet holding the integer keys.
 
-    def select_min_max(self, column):
-        column_name = column.unqualified_name
-        table_name = column.table.table_name
+        The keys are bulk loaded into an indexed temporary table, so
+        column.is_in(key_set) is a lookup in that table rather than a
+        list of parameters.  The table is private to the connection of
+        the current thread, and holds the keys until drop_key_set is
+        called or the connection is closed.
 
-        sql = 'SELECT MIN(%(column_name)s), MAX(%(column_name)s) FROM %(table_name)s' % locals()
-        for row in self.execute(sql):
-            return row
+        The tables of dropped key sets are emptied and reused, so that
+        queries on key sets keep the same sql and hit the sql cache.
 
+        """
+        thread_local = self.thread_local
+        if not hasattr(thread_local, 'free_key_sets'):
+            thread_local.free_key_sets = []
+            thread_local.num_key_sets = 0
+
+        if thread_local.free_key_sets:
+            key_set = thread_local.free_key_sets.pop()
+        else:
+            thread_local.num_key_sets += 1
+            key_set = KeySet(name='keyset_%d' % thread_local.num_key_sets)
+            list(self.execute(key_set.sql_table()))
+
+        with self.temporary_transaction():
+            self.executemany('INSERT OR IGNORE INTO temp.%s (key) VALUES (?)' % key_set.table_name,
+                             ((int(key),) for key in keys))
+        return key_set
+
+    def drop_key_set(self, key_set):
+        """Empty the table of key_set, and keep it for a later key set."""
+        with self.temporary_transaction():
+            list(self.execute('DELETE FROM temp.%s' % key_set.table_name))
+        self.thread_local.free_key_sets.append(key_set)
+
+    @cl.contextmanager
+    def temporary_transaction(self):
+        """Context of writes to the temporary tables of the current thread.
+
+        The writes are committed on exit, so that they leave no
+        transaction open on the connection.  If the owner thread already
+        has uncommitted writes, the writes join that transaction instead,
+        and are committed or rolled back with it.
+
+        """
+        if self.is_owner_thread():
+            if self.write_pending:
+                yield
+                return
+
+            try:
+                yield
+            except:
+                self.sql_db.rollback()
+                self.write_pending = False
+                raise
+            self.sql_db.commit()
+            self.write_pending = False
+        else:
+            # The read connections are in autocommit mode, so the writes
+            # are grouped in an explicit transaction.
+            connection = self.connection
+            connection.execute('BEGIN')
+            try:
+                yield
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    @cl.contextmanager
+    def key_set(self, keys):
+        """Context of a KeySet holding the keys, dropped on exit."""
+        key_set = self.new_key_set(keys)
+        try:
+            yield key_set
+        finally:
+            self.drop_key_set(key_set)
 
     def set_var(self, name, value):
         self.insert(self.vars, [(name, value)])
+        if isinstance(value, basestring) and self.__vars is not None:
+            self.__vars[name] = value
+        else:
+            # Let sqlite convert other values to text.
+            self.invalidate_vars()
 
     def get_var(self, name):
-        results = list(self.select([self.vars.value], where=(self.vars.name==name)))
-        if len(results) > 1:
-            print 'WARNING: len(results) > 1'
-        if results == []:
+        return self.vars_cache.get(name)
+
+    def set_blob(self, name, value):
+        """Store the binary string value under name, creating the Blobs table if needed."""
+        if not self.has_table('blobs'):
+            self.new_table(Blobs())
+        self.insert(self.blobs, [(name, sqlite3.Binary(value))])
+
+    def get_blob(self, name):
+        """Return the binary string stored under name, or None."""
+        if not self.has_table('blobs'):
             return None
-        return results[-1][0]
+        for value, in self.select([self.blobs.value], where=(self.blobs.name==name)):
+            return str(value)
+        return None
 
     def ensure_var(self, name, default_value):
         assert isinstance(default_value, str)
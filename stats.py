@@ -0,0 +1,246 @@
+"""Streaming reductions over blocks of geometries.
+
+The accumulators update their running statistics a block at a time
+and can be merged, using the pairwise form of Welford's algorithm
+(Chan, Golub and LeVeque), so blocks can be reduced in any order and
+in separate processes without the cancellation of the naive sum of
+squares.
+
+"""
+
+
+import numpy as np
+
+import coord_math as cm
+import parallel
+import trajdb
+
+
+class StatsError(Exception):
+    pass
+
+
+class Moments(object):
+    """Running count, mean and second moment of vectors.
+
+    With covariance=True the full (ndof, ndof) second moment is kept,
+    otherwise only its diagonal.
+
+    """
+
+    def __init__(self, covariance=False):
+        self.covariance = covariance
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def block_moments(self, block):
+        block = np.asarray(block, dtype=float)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        mean = block.mean(axis=0)
+        d = block - mean
+        if self.covariance:
+            m2 = np.dot(d.T, d)
+        else:
+            m2 = (d * d).sum(axis=0)
+        return len(block), mean, m2
+
+    def update(self, block):
+        """Add the (M, ndof) block of vectors to the statistics."""
+        if len(block) > 0:
+            self.combine(*self.block_moments(block))
+        return self
+
+    def merge(self, other):
+        """Add the statistics accumulated by other."""
+        if other.covariance != self.covariance:
+            raise StatsError("Can not merge covariance and variance moments.")
+        if other.count > 0:
+            self.combine(other.count, other.mean, other.m2)
+        return self
+
+    def combine(self, count, mean, m2):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean.copy(), m2.copy()
+            return
+
+        if mean.shape != self.mean.shape:
+            raise StatsError("Vectors have a different number of dof: %s != %s" % (mean.shape, self.mean.shape))
+
+        total = self.count + count
+        delta = mean - self.mean
+        weight = float(self.count) * count / total
+        if self.covariance:
+            self.m2 += m2 + np.outer(delta, delta) * weight
+        else:
+            self.m2 += m2 + delta * delta * weight
+        self.mean += delta * (float(count) / total)
+        self.count = total
+
+    @property
+    def variance(self):
+        """The population variance of each dof."""
+        if self.count == 0:
+            raise StatsError("No samples have been accumulated.")
+        if self.covariance:
+            return np.diag(self.m2) / self.count
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def covariance_matrix(self):
+        """The population covariance of the dof."""
+        if not self.covariance:
+            raise StatsError("Covariance was not accumulated.")
+        if self.count == 0:
+            raise StatsError("No samples have been accumulated.")
+        return self.m2 / self.count
+
+
+def radius_of_gyration(xs, masses=None):
+    """Return the radius of gyration of a geometry or of each geometry in a block."""
+    xs = np.asarray(xs, dtype=float)
+    rows = xs.reshape(xs.shape[:-1] + (-1, 3))
+    if masses is None:
+        masses = np.ones(rows.shape[-2])
+    d = rows - cm.centers_of_mass(xs, masses)[..., np.newaxis, :]
+    return np.sqrt(np.dot((d * d).sum(axis=-1), masses) / np.sum(masses))
+
+
+def atom_rmsf(moments):
+    """Return the root mean square fluctuation of each atom from the Moments of its coordinates."""
+    return np.sqrt(moments.variance.reshape((-1, 3)).sum(axis=1))
+
+
+def transform_block(block, top=None, reference=None, masses=None):
+    """Select the coordinates of top in the block, and align them to reference if it is given."""
+    if top is not None:
+        block = top.get_coords(block)
+    if reference is not None:
+        if masses is None:
+            masses = np.ones(len(reference) // 3)
+        block = cm.weighted_align_frames(reference, block, masses)
+    return block
+
+
+def _moments_work(work):
+    block, covariance, top, reference, masses = work
+    return Moments(covariance).update(transform_block(block, top, reference, masses))
+
+def _rg_moments_work(work):
+    block, top, masses = work
+    return Moments().update(radius_of_gyration(transform_block(block, top), masses))
+
+
+def reduce_moments(func, work, processes=1):
+    """Merge the Moments returned by func for each of the work items.
+
+    With processes other than 1, func is applied in a process pool
+    through parallel.imap.
+
+    """
+    moments = None
+    for result in parallel.imap(func, work, processes=processes):
+        if moments is None:
+            moments = result
+        else:
+            moments.merge(result)
+
+    if moments is None:
+        raise StatsError("No blocks to reduce.")
+    return moments
+
+
+def block_moments(blocks, covariance=False, top=None, reference=None, masses=None, processes=1):
+    """Return the Moments of the coordinates in the blocks.
+
+    If top is given, only its coordinates are considered; if reference
+    is given, each geometry is first aligned to it (weighted by masses).
+
+    """
+    return reduce_moments(_moments_work,
+                          ((block, covariance, top, reference, masses) for block in blocks),
+                          processes=processes)
+
+
+def block_rmsf(blocks, top=None, reference=None, masses=None, processes=1):
+    """Return the rmsf of each atom over the geometries in the blocks."""
+    return atom_rmsf(block_moments(blocks, top=top, reference=reference, masses=masses, processes=processes))
+
+
+def block_rg_moments(blocks, top=None, masses=None, processes=1):
+    """Return the Moments of the radius of gyration over the geometries in the blocks."""
+    return reduce_moments(_rg_moments_work, ((block, top, masses) for block in blocks),
+                          processes=processes)
+
+
+def coordinate_blocks(db, chunk_size=1000, where=None):
+    """Yield the blocks of coordinates in the trajectory database."""
+    for samplekeys, block in db.iter_coordinate_chunks(chunk_size=chunk_size, where=where):
+        yield block
+
+
+class PCA(object):
+    """Principal components of the covariance accumulated in Moments.
+
+    Only the (ndof, ndof) covariance is held in memory, so the geometries
+    themselves may be streamed from disk.
+
+    """
+
+    def __init__(self, moments, num_components=None):
+        covariance = moments.covariance_matrix
+        variances, vectors = np.linalg.eigh(covariance)
+        order = np.argsort(variances)[::-1][:num_components]
+
+        self.mean = moments.mean
+        self.total_variance = np.trace(covariance)
+        self.variances = np.maximum(variances[order], 0.)
+        self.components = vectors[:, order].T
+
+    @property
+    def num_components(self):
+        return len(self.components)
+
+    @property
+    def explained_variance_ratio(self):
+        return self.variances / self.total_variance
+
+    def project(self, xs):
+        """Return the (M, num_components) projections of the block of vectors."""
+        return np.dot(np.asarray(xs, dtype=float) - self.mean, self.components.T)
+
+    def reconstruct(self, ys):
+        """Return the vectors with the (M, num_components) projections ys."""
+        return np.dot(ys, self.components) + self.mean
+
+
+def block_pca(blocks, num_components=None, top=None, reference=None, masses=None, processes=1):
+    """Return the PCA of the geometries in the blocks.
+
+    The blocks are prepared as in block_moments, and only their
+    covariance is accumulated.
+
+    """
+    moments = block_moments(blocks, covariance=True, top=top, reference=reference, masses=masses,
+                            processes=processes)
+    return PCA(moments, num_components)
+
+
+def write_projections(db, pca, vector_table_name, top=None, reference=None, masses=None,
+                      chunk_size=1000, overwrite=False, where=None):
+    """Write the projections of the coordinates of db onto the components of pca to a new vector table.
+
+    The geometries are prepared in the same way as when the pca was
+    computed, so top, reference and masses should match.
+
+    """
+    projections = db.new_vector_table(vector_table_name, pca.num_components, overwrite=overwrite)
+    for samplekeys, block in db.iter_coordinate_chunks(chunk_size=chunk_size, where=where):
+        ys = pca.project(transform_block(block, top, reference, masses))
+        trajdb.write_vector_rows(projections, samplekeys, ys)
+    return projections
@@ -313,5 +313,199 @@ class TestAlign(unittest.TestCase):
 
             self.assertAlmostEqual(cm.rmsd(x, y), cm.flat_rmsd(x, aligned_y), 5)
     
+class TestMassWeighted(unittest.TestCase):
+
+    masses = np.array([12.011, 1.008, 1.008, 1.008])
+
+    def weighted_flat_rmsd(self, x, y):
+        d = (x - y).reshape((-1, 3))
+        return math.sqrt(np.dot(self.masses, (d * d).sum(axis=1)) / self.masses.sum())
+
+    def test_com_uniform(self):
+        x = randomize_mol(methane)
+        self.assertTrue(np.allclose(cm.center_of_mass(x, np.ones(4)), cm.center_of_geometry(x)))
+
+    def test_com_methane(self):
+        com = cm.center_of_mass(methane, self.masses)
+        self.assertTrue(np.allclose(com, np.array([1.008] * 3) / self.masses.sum()))
+
+    def test_rmsd_uniform(self):
+        for count in xrange(20):
+            x = perturb(randomize_mol(methane))
+            y = perturb(randomize_mol(methane))
+            self.assertAlmostEqual(cm.weighted_rmsd(x, y, np.ones(4)), cm.rmsd(x, y), 5)
+
+    def test_rmsd_invariant(self):
+        for count in xrange(20):
+            x = perturb(randomize_mol(methane))
+            self.assertAlmostEqual(cm.weighted_rmsd(x, randomize_mol(x), self.masses), 0., 5)
+
+    def test_align_weighted_rmsd(self):
+        for count in xrange(20):
+            x = perturb(randomize_mol(methane))
+            y = perturb(randomize_mol(methane))
+
+            aligned_y = cm.weighted_align(x, y, self.masses)
+
+            self.assertAlmostEqual(cm.weighted_rmsd(x, y, self.masses),
+                                   self.weighted_flat_rmsd(x, aligned_y), 5)
+
+    def test_frames(self):
+        x = perturb(randomize_mol(methane))
+        ys = np.array([perturb(randomize_mol(methane)) for count in xrange(10)])
+
+        rmsds = cm.weighted_rmsd_frames(ys, x, self.masses)
+        aligned = cm.weighted_align_frames(x, ys, self.masses)
+
+        for y, rmsd, aligned_y in zip(ys, rmsds, aligned):
+            self.assertAlmostEqual(rmsd, cm.weighted_rmsd(y, x, self.masses), 5)
+            self.assertTrue(np.allclose(aligned_y, cm.weighted_align(x, y, self.masses)))
+
+        centers = cm.centers_of_mass(ys, self.masses)
+        self.assertTrue(np.allclose(centers, [cm.center_of_mass(y, self.masses) for y in ys]))
+
+    def test_mass_subalign(self):
+        import topology as t
+        top = t.Polymer('methanes', [t.Molecule('CH3', ['C', 'H1', 'H2', 'H3'])] * 2)
+        first = top.monomers[0]
+        x = np.concatenate([perturb(randomize_mol(methane)) for count in xrange(2)])
+        y = np.concatenate([perturb(randomize_mol(methane)) for count in xrange(2)])
+
+        aligned_y = cm.mass_subalign(first, x, y)
+
+        self.assertAlmostEqual(cm.weighted_rmsd(first.get_coords(x), first.get_coords(y), self.masses),
+                               self.weighted_flat_rmsd(first.get_coords(x), first.get_coords(aligned_y)), 5)
+
+
+class TestSegments(unittest.TestCase):
+
+    def make_top(self):
+        import topology as t
+        return t.Polymer('chain', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                                   t.Molecule('GLY', ['N', 'CA', 'C', 'O']),
+                                   t.Molecule('HOH', ['O'])])
+
+    def make_xs(self, top, num_frames=5):
+        return np.random.random((num_frames, 3 * top.num_atoms))
+
+    def test_centers(self):
+        top = self.make_top()
+        xs = self.make_xs(top)
+
+        centers = cm.residue_centers(top, xs)
+
+        self.assertEqual(centers.shape, (len(xs), top.num_monomers, 3))
+        for x, x_centers in zip(xs, centers):
+            for monomer, center in zip(top.monomers, x_centers):
+                self.assertTrue(np.allclose(center, cm.center_of_geometry(monomer.get_coords(x))))
+
+    def test_flat_rmsd(self):
+        top = self.make_top()
+        xs = self.make_xs(top)
+        y = xs[0]
+
+        rmsds = cm.residue_flat_rmsd(top, xs, y)
+
+        self.assertEqual(rmsds.shape, (len(xs), top.num_monomers))
+        self.assertTrue(np.allclose(rmsds[0], 0.))
+        for x, x_rmsds in zip(xs, rmsds):
+            for monomer, rmsd in zip(top.monomers, x_rmsds):
+                self.assertAlmostEqual(rmsd, cm.flat_rmsd(monomer.get_coords(x), monomer.get_coords(y)))
+
+    def test_rmsf(self):
+        top = self.make_top()
+        xs = self.make_xs(top)
+
+        rmsf = cm.residue_rmsf(top, xs)
+
+        for monomer, monomer_rmsf in zip(top.monomers, rmsf):
+            m_xs = monomer.get_coords(xs)
+            mean = m_xs.mean(axis=0)
+            expected = math.sqrt(np.mean([cm.flat_rmsd(x, mean) ** 2 for x in m_xs]))
+            self.assertAlmostEqual(monomer_rmsf, expected)
+
+    def test_empty_segments(self):
+        top = self.make_top()
+        cb = top.get_atoms('CB')
+        x = self.make_xs(top, 1)[0]
+
+        centers = cm.residue_centers(cb, x)
+
+        self.assertEqual(centers.shape, (3, 3))
+        self.assertTrue(np.allclose(centers[0], cb.get_coords(x)))
+        self.assertTrue(np.isnan(centers[1:]).all())
+
+
+class TestPBC(unittest.TestCase):
+
+    box = np.array([10., 12., 14.])
+
+    def make_top(self):
+        import topology as t
+        return t.Polymer('system', [t.Molecule('CH4', ['C', 'H1', 'H2', 'H3']),
+                                    t.Molecule('HOH', ['O', 'H1', 'H2'])])
+
+    def make_x(self):
+        x = np.concatenate([methane + 4.5, methane[:9] + 2.])
+        return x
+
+    def split(self, x):
+        """Move some of the atoms to other periodic images."""
+        rows = x.copy().reshape((-1, 3))
+        rows[1] += self.box * [1, 0, -1]
+        rows[3] -= self.box * [0, 2, 0]
+        rows[5] += self.box
+        return rows.reshape((-1,))
+
+    def test_box_formats(self):
+        self.assertEqual(list(cm.box_lengths([1., 2., 3.])), [1., 2., 3.])
+        self.assertEqual(list(cm.box_lengths([1., 2., 3., 90., 90., 90.])), [1., 2., 3.])
+        self.assertEqual(list(cm.box_lengths([1., 2., 3.] + [0.] * 6)), [1., 2., 3.])
+        self.assertRaises(cm.PBCError, cm.box_lengths, [1., 2., 3., 90., 60., 90.])
+
+    def test_minimum_image(self):
+        d = np.array([6., -7., 1., 21., 0., -13.])
+        self.assertTrue(np.allclose(cm.minimum_image(d, self.box), [-4., 5., 1., 1., 0., 1.]))
+
+    def test_pair_distances(self):
+        x = self.make_x()
+        split_x = self.split(x)
+        pairs = [(0, 1), (0, 3), (4, 5), (2, 6)]
+
+        distances = cm.pbc_pair_distances(split_x, pairs, self.box)
+
+        for (idx, jdx), distance in zip(pairs, distances):
+            self.assertAlmostEqual(distance, cm.atom_dist(x, idx + 1, jdx + 1))
+
+    def test_make_whole(self):
+        top = self.make_top()
+        x = self.make_x()
+
+        whole = cm.make_monomers_whole(top, self.split(x), self.box)
+
+        self.assertTrue(np.allclose(whole, x))
+
+    def test_block(self):
+        top = self.make_top()
+        xs = np.array([self.make_x() + delta for delta in [0., 0.5, 1.]])
+        boxes = np.array([self.box] * 3)
+
+        whole = cm.make_monomers_whole(top, np.array([self.split(x) for x in xs]), boxes)
+
+        self.assertTrue(np.allclose(whole, xs))
+
+    def test_image_monomers(self):
+        top = self.make_top()
+        x = self.make_x()
+
+        imaged = cm.image_monomers(top, self.split(x) + 3 * self.box[0], self.box,
+                                   center_top=top.monomers[0])
+
+        centers = cm.residue_centers(top, imaged)
+        self.assertTrue(np.allclose(centers[0], 0.5 * self.box))
+        self.assertTrue(((centers >= 0.) & (centers < self.box)).all())
+        self.assertAlmostEqual(cm.rmsd(top.monomers[1].get_coords(imaged), top.monomers[1].get_coords(x)), 0.)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,52 @@
+"""elements.py test suite."""
+
+import unittest
+
+import numpy as np
+
+import elements as e
+import topology as t
+
+
+class ElementTestCase(unittest.TestCase):
+
+    def test_first_letter(self):
+        self.assertEqual(e.element('CA'), 'C')
+        self.assertEqual(e.element('HB2'), 'H')
+        self.assertEqual(e.element('1HB'), 'H')
+        self.assertEqual(e.element('OW'), 'O')
+
+    def test_ions(self):
+        self.assertEqual(e.element('CA', 'CA'), 'CA')
+        self.assertEqual(e.element('NA', 'NA'), 'NA')
+        self.assertEqual(e.element('NA', 'HEM'), 'N')
+
+    def test_ion_names(self):
+        self.assertEqual(e.atom_mass('Na+', 'Na+'), e.masses['NA'])
+        self.assertEqual(e.atom_mass('Cl-', 'Cl-'), e.masses['CL'])
+        self.assertEqual(e.atom_mass('SOD', 'SOD'), e.masses['NA'])
+        self.assertEqual(e.atom_mass('CLA', 'CLA'), e.masses['CL'])
+        self.assertEqual(e.element('Na+'), 'NA')
+        self.assertRaises(e.ElementError, e.element, 'Ba2+', 'Ba2+')
+
+    def test_massless(self):
+        self.assertEqual(e.atom_mass('EPW', 'TIP'), 0.)
+
+    def test_unknown(self):
+        self.assertRaises(e.ElementError, e.element, 'XX')
+
+
+class TopologyMassesTestCase(unittest.TestCase):
+
+    def test_masses(self):
+        top = t.Polymer('system', [t.Molecule('GLY', ['N', 'CA', 'C', 'O']),
+                                   t.Molecule('CA', ['CA'])])
+
+        self.assertEqual(list(top.masses), [e.masses['N'], e.masses['C'], e.masses['C'], e.masses['O'],
+                                            e.masses['CA']])
+        self.assertTrue(top.masses is top.masses)
+        self.assertEqual(list(top.get_atoms('CA').masses), [e.masses['C'], e.masses['CA']])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""floatx.py test suite."""
+
+import unittest
+
+import numpy as np
+
+import floatx as fx
+
+
+class FloatxTestCase(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(fx.floatx('   1.500'), 1.5)
+
+    def test_missing_exponent(self):
+        self.assertEqual(fx.floatx(' 1.0-100'), 1e-100)
+        self.assertEqual(fx.floatx('  2.5+02'), 250.)
+
+    def test_overflow(self):
+        self.assertEqual(fx.floatx('********'), fx.overflow_value)
+
+
+class FloatxArrayTestCase(unittest.TestCase):
+
+    fields = ['   1.500', ' -2.2500', ' 1.0-100', '********', '  2.5+02', '  -1e-03', '********']
+
+    def test_matches_floatx(self):
+        values, num_overflows = fx.convert_floatx_array(np.array(self.fields))
+
+        self.assertEqual(list(values), [fx.repair_floatx(field)[0] if field.startswith('*') else fx.floatx(field)
+                                        for field in self.fields])
+
+    def test_overflow_count(self):
+        values, num_overflows = fx.convert_floatx_array(np.array(self.fields))
+
+        self.assertEqual(num_overflows, 2)
+
+    def test_well_formed(self):
+        values, num_overflows = fx.convert_floatx_array(np.array(self.fields[:2]))
+
+        self.assertEqual(list(values), [1.5, -2.25])
+        self.assertEqual(num_overflows, 0)
+
+    def test_fixed_width_fields(self):
+        lines = ['   1.500 -2.2500\n', ' 1.0-100\n']
+        fields = fx.fixed_width_fields(lines, 8, 2, 3)
+
+        self.assertEqual(list(fields), ['   1.500', ' -2.2500', ' 1.0-100'])
+
+    def test_unconvertable(self):
+        self.assertRaises(Exception, fx.convert_floatx_array, np.array(['  abc   ', '   1.000']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+"""neighbors.py test suite."""
+
+import unittest
+
+import numpy as np
+
+import neighbors as n
+import coord_math as cm
+import topology as t
+
+
+def brute_force_pairs(x, cutoff, box=None):
+    rows = x.reshape((-1, 3))
+    pairs = []
+    for idx in range(len(rows)):
+        for jdx in range(idx + 1, len(rows)):
+            d = rows[jdx] - rows[idx]
+            if box is not None:
+                d = cm.minimum_image(d, box)
+            if np.dot(d, d) <= cutoff * cutoff:
+                pairs.append((idx, jdx))
+    return pairs
+
+
+class NeighborPairsTestCase(unittest.TestCase):
+
+    num_atoms = 300
+    cutoff = 2.5
+    box = np.array([10., 12., 14.])
+
+    def make_x(self):
+        return (np.random.random((self.num_atoms, 3)) * self.box).reshape((-1,))
+
+    def test_open(self):
+        x = self.make_x()
+
+        pairs, distances = n.neighbor_pairs(x, self.cutoff)
+
+        self.assertEqual(pairs.tolist(), [list(pair) for pair in brute_force_pairs(x, self.cutoff)])
+        for (idx, jdx), distance in zip(pairs, distances):
+            self.assertAlmostEqual(distance, cm.atom_dist(x, idx + 1, jdx + 1))
+
+    def test_periodic(self):
+        x = self.make_x()
+        x[:30] += 3 * self.box[0]
+
+        pairs, distances = n.neighbor_pairs(x, self.cutoff, self.box)
+
+        self.assertEqual(pairs.tolist(), [list(pair) for pair in brute_force_pairs(x, self.cutoff, self.box)])
+        self.assertTrue(np.allclose(distances, cm.pbc_pair_distances(x, pairs, self.box)))
+
+    def test_small_chunks(self):
+        x = self.make_x()
+        chunk_size = n.chunk_size
+        n.chunk_size = 50
+        try:
+            pairs, distances = n.neighbor_pairs(x, self.cutoff, self.box)
+        finally:
+            n.chunk_size = chunk_size
+
+        self.assertEqual(pairs.tolist(), n.neighbor_pairs(x, self.cutoff, self.box)[0].tolist())
+
+    def test_sparse(self):
+        for count in range(20):
+            x = self.make_x()[:3 * 20]
+
+            for box in [None, self.box]:
+                pairs, distances = n.neighbor_pairs(x, self.cutoff, box)
+                self.assertEqual(pairs.tolist(), [list(pair) for pair in brute_force_pairs(x, self.cutoff, box)])
+
+    def test_cutoff_too_large(self):
+        self.assertRaises(n.NeighborError, n.neighbor_pairs, self.make_x(), 6., self.box)
+
+    def test_no_atoms(self):
+        pairs, distances = n.neighbor_pairs(np.zeros(0), self.cutoff)
+        self.assertEqual(pairs.shape, (0, 2))
+
+
+class ContactMapTestCase(unittest.TestCase):
+
+    def make_top(self):
+        return t.Polymer('chain', [t.Molecule('GLY', ['N', 'CA', 'C', 'O'])] * 3)
+
+    def make_x(self):
+        x = np.zeros((12, 3))
+        x[:4, 0] = [0., 1., 2., 3.]
+        x[4:8, 0] = [6., 7., 8., 9.]
+        x[8:, 0] = [20., 21., 22., 23.]
+        return x.reshape((-1,))
+
+    def test_residue_contacts(self):
+        top = self.make_top()
+
+        self.assertEqual(n.residue_contacts(top, self.make_x(), 3.5).tolist(), [[0, 1]])
+        self.assertEqual(n.residue_contacts(top, self.make_x(), 2.5).tolist(), [])
+
+    def test_periodic_contacts(self):
+        top = self.make_top()
+
+        contacts = n.residue_contacts(top, self.make_x(), 3.5, box=[25., 25., 25.])
+
+        self.assertEqual(contacts.tolist(), [[0, 1], [0, 2]])
+
+    def test_frequencies(self):
+        top = self.make_top()
+        x = self.make_x()
+        far = x.copy()
+        far[12:24] += 10.
+
+        pairs, frequencies = n.contact_frequencies(top, np.array([x, far]), 3.5)
+
+        self.assertEqual(pairs.tolist(), [[0, 1]])
+        self.assertEqual(list(frequencies), [0.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
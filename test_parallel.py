@@ -0,0 +1,61 @@
+"""parallel.py test suite."""
+
+import time
+import unittest
+
+import parallel
+
+
+class ParallelError(Exception):
+    pass
+
+def square(x):
+    return x * x
+
+def slow_square(x):
+    if x == 0:
+        raise ParallelError("first item")
+    time.sleep(0.2)
+    return x * x
+
+
+class IMapTestCase(unittest.TestCase):
+
+    def test_serial(self):
+        self.assertEqual(list(parallel.imap(square, range(10))), [x * x for x in range(10)])
+
+    def test_processes(self):
+        self.assertEqual(list(parallel.imap(square, range(50), processes=2)), [x * x for x in range(50)])
+
+    def test_threads(self):
+        self.assertEqual(list(parallel.imap(square, range(50), processes=2, threads=True)), [x * x for x in range(50)])
+
+    def test_bounded(self):
+        drawn = []
+
+        def work():
+            for x in range(100):
+                drawn.append(x)
+                yield x
+
+        results = parallel.imap(square, work(), processes=2)
+        results.next()
+        self.assertTrue(len(drawn) <= 5, drawn)
+        results.close()
+
+    def test_failure(self):
+        # The rest of the work is not run before the error surfaces.
+        start = time.time()
+        self.assertRaises(ParallelError, list, parallel.imap(slow_square, range(100), processes=2))
+        self.assertTrue(time.time() - start < 2.)
+
+    def test_abandoned(self):
+        start = time.time()
+        results = parallel.imap(slow_square, range(1, 100), processes=2)
+        self.assertEqual(results.next(), 1)
+        results.close()
+        self.assertTrue(time.time() - start < 2.)
+
+
+if __name__ == "__main__":
+    unittest.main()
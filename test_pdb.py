@@ -3,8 +3,11 @@ import unittest
 
 import os
 
+import numpy as np
+
 import aminoacids as aa
 import static_files
+import topology as t
 
 import pdb as p
 
@@ -141,6 +144,20 @@ class ReadWriteCoordsTestCase(unittest.TestCase):
         for idx, (read_coords, expected_coords) in enumerate(zip(p.read_coords('test.pdb'), p.read_coords(self.initial_pdb_file))):
             self.assertEqual(list(expected_coords), list(read_coords))
 
+    def test_template_coords_to_pdb(self):
+        top = p.read_topology(self.initial_pdb_file, name='pyp')
+        template = p.pdb_template(top)
+
+        for coords in p.read_coords(self.initial_pdb_file):
+            self.assertEqual(p.coords_to_pdb(top, coords, template=template),
+                             p.multi_chain_coords_to_pdb(top, coords))
+
+    def test_wrong_num_coords(self):
+        top = p.read_topology(self.initial_pdb_file, name='pyp')
+        coords = p.read_coords(self.initial_pdb_file).next()
+
+        self.assertRaises(p.PDBError, p.coords_to_pdb, top, coords[:-3])
+
         
 
 
@@ -176,6 +193,32 @@ class TwoChainTopologyTestCase(unittest.TestCase):
         self.assertEqual(monomer_names, residue_names)
     
 
+class MultiChainOffsetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # the first chain holds the last two atoms of the geometry
+        first = t.Polymer('A', [t.Molecule('ALA', ['N', 'CA'], atom_offsets=np.arange(6, 12))],
+                          fixed_monomers=True)
+        second = t.Polymer('B', [t.Molecule('GLY', ['N', 'CA'], atom_offsets=np.arange(0, 6))],
+                           fixed_monomers=True)
+        self.top = t.Polymer('swapped', [first, second], fixed_monomers=True)
+        self.coords = np.arange(12, dtype=float)
+
+    def test_chain_offsets(self):
+        lines = p.coords_to_pdb(self.top, self.coords).split('\n')
+        self.assertEqual(['ATOM      1  N   ALA     1      6.000   7.000   8.000',
+                          'ATOM      2  CA  ALA     1      9.000  10.000  11.000',
+                          'TER',
+                          'ATOM      1  N   GLY     1      0.000   1.000   2.000',
+                          'ATOM      2  CA  GLY     1      3.000   4.000   5.000'],
+                         lines)
+
+    def test_template(self):
+        template = p.pdb_template(self.top)
+        self.assertEqual(p.coords_to_pdb(self.top, self.coords, template=template),
+                         p.multi_chain_coords_to_pdb(self.top, self.coords))
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -99,6 +99,51 @@ class WriteReadTestCase(unittest.TestCase):
                         self.assertAlmostEqual(expected, crd, 3)
 
 
+class BatchWriteReadTestCase(unittest.TestCase):
+    """Test reading sets of rst files written by write_rsts."""
+
+    num_files = 5
+
+    def test_read_crds(self):
+        num_atoms = random.randint(1,100)
+        crds = np.array([random_crds(num_atoms) for count in xrange(self.num_files)])
+
+        with tfu.TempfileSession() as tfs:
+            file_names = [tfs.temp_file_name('.rst') for count in xrange(self.num_files)]
+
+            rst.write_rsts(file_names, crds, processes=1)
+
+            read_crds = rst.read_rsts(file_names, threads=True)
+
+        self.assertEqual(read_crds.shape, crds.shape)
+        self.assertTrue(np.allclose(read_crds, crds, atol=1e-5))
+
+    def test_read_dynamics_box(self):
+        num_atoms = random.randint(1,100)
+        crds = np.array([random_crds(num_atoms) for count in xrange(self.num_files)])
+        vels = np.array([random_crds(num_atoms) for count in xrange(self.num_files)])
+        boxes = np.array([random_crds(2) for count in xrange(self.num_files)])
+
+        with tfu.TempfileSession() as tfs:
+            file_names = [tfs.temp_file_name('.rst') for count in xrange(self.num_files)]
+
+            rst.write_rsts(file_names, (crds, vels, boxes), dynamics=True, box=True)
+
+            read_crds, read_vels, read_boxes = rst.read_rsts(file_names, dynamics=True, box=True)
+
+        for expected, read in [(crds, read_crds), (vels, read_vels), (boxes, read_boxes)]:
+            self.assertEqual(read.shape, expected.shape)
+            self.assertTrue(np.allclose(read, expected, atol=1e-5))
+
+    def test_mismatched_atoms(self):
+        with tfu.TempfileSession() as tfs:
+            file_names = [tfs.temp_file_name('.rst') for count in xrange(2)]
+
+            rst.write_rst(file_names[0], random_crds(3))
+            rst.write_rst(file_names[1], random_crds(4))
+
+            self.assertRaises(rst.RSTError, rst.read_rsts, file_names, processes=1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,10 @@
 
+import os
+import threading
 import unittest
 
+import numpy as np
+
 from sql_table import *
 
 
@@ -670,6 +674,545 @@ class ParseTableTestCase(unittest.TestCase):
         self.assertRaises(SQLSyntaxError, parse_table, table.sql_table())
 
 
+    def test_oroubus_index(self):
+
+        class ExampleTable(SQLTable):
+            a = Integer()
+            b = Real()
+            c = Real()
+            primary_key(a)
+            index(b)
+            index(b, c)
+
+        self.assertOuroboros(ExampleTable())
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def test_sql_index(self):
+
+        class ExampleTable(SQLTable):
+            a = Integer()
+            b = Real()
+            index(b)
+
+        table = ExampleTable(name='example', b_name='value')
+
+        self.assertEqual([concrete_index.columns for concrete_index in table.indexes], [(table.value,)])
+        self.assertTrue('CREATE INDEX IF NOT EXISTS idx_example_value ON example (value);' in table.sql_table())
+
+    def test_no_columns(self):
+        self.assertRaises(SQLDeclarationError, index)
+
+    def test_reopen(self):
+
+        class ExampleTable(SQLTable):
+            a = Integer()
+            b = Real()
+            index(b)
+
+        class ExampleDatabase(DatabaseMixin):
+
+            def create_tables(self, *args, **kwargs):
+                super(ExampleDatabase, self).create_tables(*args, **kwargs)
+                self.new_table(ExampleTable())
+
+        db_name = 'test_index.db'
+        try:
+            db = ExampleDatabase(db_name, create=True)
+            db.close()
+
+            db = ExampleDatabase(db_name)
+            self.assertEqual(db.exampletable, ExampleTable())
+            plan = ' '.join(str(row[-1]) for row in db.execute('EXPLAIN QUERY PLAN SELECT a FROM exampletable WHERE b > 1'))
+            self.assertTrue('idx_exampletable_b' in plan)
+            db.close()
+        finally:
+            if os.path.exists(db_name):
+                os.remove(db_name)
+
+
+class Samples(SQLTable):
+    key = Integer()
+    value = Real()
+    primary_key(key)
+
+
+class SampleDatabase(DatabaseMixin):
+
+    def create_tables(self, *args, **kwargs):
+        super(SampleDatabase, self).create_tables(*args, **kwargs)
+        self.new_table(Samples())
+
+
+class TempDatabaseCase(object):
+
+    temp_db_name = 'test_sql_table.db'
+
+    def remove_db(self):
+        if os.path.exists(self.temp_db_name):
+            os.remove(self.temp_db_name)
+
+    def setUp(self):
+        super(TempDatabaseCase, self).setUp()
+        self.remove_db()
+        self.db = SampleDatabase(self.temp_db_name, create=True)
+        with self.db.session():
+            self.db.insert(self.db.samples, [(key, 0.5 * key) for key in range(10)])
+
+    def tearDown(self):
+        super(TempDatabaseCase, self).tearDown()
+        self.db.close()
+        self.remove_db()
+
+
+class ConnectionProfileTestCase(unittest.TestCase):
+
+    temp_db_name = 'test_profile.db'
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.temp_db_name + suffix):
+                os.remove(self.temp_db_name + suffix)
+
+    def test_applied_before_create(self):
+        pragmas = []
+
+        class ProfiledDatabase(SampleDatabase):
+
+            def create_tables(self, *args, **kwargs):
+                for name in ('journal_mode', 'synchronous'):
+                    for value, in self.execute('PRAGMA %s' % name):
+                        pragmas.append(value)
+                super(ProfiledDatabase, self).create_tables(*args, **kwargs)
+
+        db = ProfiledDatabase(self.temp_db_name, create=True, profile='bulk-load')
+        self.assertEqual(pragmas, ['wal', 0])
+        self.assertEqual(db.get_var('connection_profile'), 'bulk-load')
+        db.close()
+
+
+class SQLCacheTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def test_select_hits(self):
+        db = self.db
+        hits, misses = db.sql_cache_hits, db.sql_cache_misses
+
+        for key in range(5):
+            self.assertEqual(list(db.select([db.samples.value], where=(db.samples.key==key))), [(0.5 * key,)])
+
+        self.assertEqual(db.sql_cache_misses, misses + 1)
+        self.assertEqual(db.sql_cache_hits, hits + 4)
+
+    def test_different_shapes(self):
+        db = self.db
+        misses = db.sql_cache_misses
+
+        self.assertEqual(len(list(db.select([db.samples.value], where=(db.samples.key < 5)))), 5)
+        self.assertEqual(len(list(db.select([db.samples.value], where=(db.samples.key > 5)))), 4)
+        self.assertEqual(len(list(db.select([db.samples.key]))), 10)
+
+        self.assertEqual(db.sql_cache_misses, misses + 3)
+
+    def test_insert(self):
+        db = self.db
+        with db.session():
+            db.insert(db.samples, [(10, 5.)])
+        hits = db.sql_cache_hits
+        with db.session():
+            db.insert(db.samples, [(11, 5.5)])
+
+        self.assertEqual(db.sql_cache_hits, hits + 2)
+        self.assertEqual(len(list(db.select([db.samples.key]))), 12)
+
+    def test_invalidated(self):
+        db = self.db
+        list(db.select([db.samples.value]))
+
+        class OtherSamples(SQLTable):
+            key = Integer()
+            other = Real()
+
+        with db.session():
+            db.new_table(OtherSamples(name='samples'), overwrite=True)
+            db.insert(db.samples, [(1, 2.)])
+
+        self.assertEqual(list(db.select([db.samples.other])), [(2.,)])
+        self.assertRaises(sqlite3.OperationalError, list, db.select([Samples().value]))
+
+
+class SelectTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def test_aggregates(self):
+        db = self.db
+        samples = db.samples
+
+        self.assertEqual(list(db.select([samples.key.min(), samples.key.max(), samples.key.count()])), [(0, 9, 10)])
+        self.assertEqual(list(db.select([samples.value.sum(), samples.value.avg()], where=(samples.key < 4))), [(3., 0.75)])
+
+    def test_select_min_max(self):
+        db = self.db
+
+        self.assertEqual(db.select_max(db.samples.key), 9)
+        self.assertEqual(db.select_min(db.samples.value), 0.)
+        self.assertEqual(db.select_min_max(db.samples.key, where=(db.samples.value > 1.)), (3, 9))
+        self.assertEqual(db.select_count(db.samples.key, where=(db.samples.key > 7)), 2)
+        self.assertEqual(db.select_max(db.samples.key, where=(db.samples.key > 10)), None)
+
+    def test_order_limit_offset(self):
+        db = self.db
+        samples = db.samples
+
+        self.assertEqual(list(db.select([samples.key], order_by=samples.key.desc(), limit=3)), [(9,), (8,), (7,)])
+        self.assertEqual(list(db.select([samples.key], order_by=[samples.key], limit=2, offset=4)), [(4,), (5,)])
+        self.assertEqual(list(db.select([samples.key], order_by=samples.key, offset=8)), [(8,), (9,)])
+        self.assertEqual(db.select_one([samples.key], where=(samples.value > 2.), order_by=samples.key), (5,))
+        self.assertEqual(db.select_one([samples.key], where=(samples.value > 20.)), None)
+
+    def test_group_by(self):
+        db = self.db
+
+        class Groups(SQLTable):
+            samples = ForeignTable()
+            key = samples.Integer('key')
+            group = Integer()
+            primary_key(key)
+
+        with db.session():
+            db.new_table(Groups(name='groups', group_name='parity', samples=db.samples))
+            db.insert(db.groups, [(key, key % 2) for key in range(10)])
+
+        rows = list(db.select([db.groups.parity, db.samples.value.sum(), db.samples.key.count()],
+                              group_by=db.groups.parity, order_by=db.groups.parity))
+        self.assertEqual(rows, [(0, 10., 5), (1, 12.5, 5)])
+
+
+class SelectArraysTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def test_select_arrays(self):
+        db = self.db
+        keys, values = db.select_arrays([db.samples.key, db.samples.value], order_by=db.samples.key, block=3)
+
+        self.assertEqual(keys.dtype, np.dtype(int))
+        self.assertEqual(values.dtype, np.dtype(float))
+        self.assertTrue(np.all(keys == np.arange(10)))
+        self.assertTrue(np.allclose(values, 0.5 * np.arange(10)))
+
+    def test_blocks(self):
+        db = self.db
+        blocks = list(db.iter_select_arrays([db.samples.key], where=(db.samples.key > 2), order_by=db.samples.key, block=3))
+
+        self.assertEqual([list(keys) for keys, in blocks], [[3, 4, 5], [6, 7, 8], [9]])
+
+    def test_empty(self):
+        db = self.db
+        keys, count = db.select_arrays([db.samples.key, db.samples.key.count()], where=(db.samples.key > 20),
+                                       group_by=db.samples.key)
+
+        self.assertEqual((keys.shape, keys.dtype), ((0,), np.dtype(int)))
+        self.assertEqual((count.shape, count.dtype), ((0,), np.dtype(int)))
+
+    def test_nulls(self):
+        db = self.db
+        with db.session():
+            db.set_var('a', '1')
+            db.insert(db.samples, [(20, None)])
+
+        names, = db.select_arrays([db.vars.name])
+        self.assertEqual(names.dtype, np.dtype(object))
+
+        values, = db.select_arrays([db.samples.value], where=(db.samples.key > 8), order_by=db.samples.key)
+        self.assertEqual(values[0], 4.5)
+        self.assertTrue(np.isnan(values[1]))
+
+
+class KeySetTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def test_is_in(self):
+        db = self.db
+        key_set = db.new_key_set([7, 2, 2, 5])
+
+        self.assertTrue(key_set.temporary)
+        self.assertEqual(list(db.select([db.samples.key], where=db.samples.key.is_in(key_set), order_by=db.samples.key)),
+                         [(2,), (5,), (7,)])
+        self.assertEqual(db.select_count(db.samples.key, where=db.samples.key.not_in(key_set)), 7)
+        db.drop_key_set(key_set)
+
+    def test_many_keys(self):
+        db = self.db
+        with db.key_set(xrange(0, 200000, 3)) as key_set:
+            self.assertEqual(db.select_count(db.samples.key, where=db.samples.key.is_in(key_set)), 4)
+            self.assertEqual(db.select_count(key_set.key), 66667)
+
+    def test_reused(self):
+        db = self.db
+        with db.key_set([1]) as key_set:
+            pass
+
+        self.assertEqual(db.select_count(key_set.key), 0)
+        self.assertFalse(db.has_table(key_set.table_name))
+
+        misses = db.sql_cache_misses
+        for key in range(5):
+            with db.key_set([key, key + 1]) as other_key_set:
+                self.assertEqual(other_key_set.table_name, key_set.table_name)
+                self.assertEqual(list(db.select([db.samples.key], where=db.samples.key.is_in(other_key_set),
+                                                order_by=db.samples.key)), [(key,), (key + 1,)])
+        self.assertEqual(db.sql_cache_misses, misses + 1)
+
+        with db.key_set([1]) as first:
+            with db.key_set([2]) as second:
+                self.assertNotEqual(first.table_name, second.table_name)
+
+    def test_not_persistent(self):
+        db = self.db
+        key_set = db.new_key_set([1, 2])
+        db.close()
+
+        self.db = SampleDatabase(self.temp_db_name)
+        self.assertEqual(set(table.table_name for table in self.db.tables), set(['vars', 'samples']))
+        self.assertRaises(sqlite3.OperationalError, list, self.db.select([key_set.key]))
+
+    def test_parse_temporary(self):
+        self.assertTrue(parse_table(KeySet().sql_table()).temporary)
+
+
+class BulkWriterTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def test_batches(self):
+        db = self.db
+        inserts = []
+        insert = db.insert
+        db.insert = lambda table, values=[], checkpoint=False: (inserts.append(len(values)), insert(table, values))
+
+        with db.bulk_writer(batch_rows=4) as writer:
+            writer.insert(db.samples, [(key, 1.) for key in range(10, 20)])
+            writer.insert(db.samples, [(20, 1.)])
+            self.assertEqual(writer.num_rows, 8)
+
+        self.assertEqual(inserts[:3], [4, 4, 3])
+        self.assertEqual(writer.num_rows, 11)
+        self.assertTrue(writer.rows_per_second > 0)
+        self.assertEqual(db.select_count(db.samples.key), 21)
+
+    def test_order(self):
+        db = self.db
+        with db.bulk_writer(batch_rows=3) as writer:
+            writer.insert(db.vars, [(str(key), 'a') for key in range(10)])
+
+        names, = db.select_arrays([db.vars.name], where=(db.vars.value == 'a'))
+        self.assertEqual(list(names), [str(key) for key in range(10)])
+
+    def test_no_session(self):
+        db = self.db
+        with db.bulk_writer(batch_rows=4, session=False) as writer:
+            writer.insert(db.samples, [(key, 1.) for key in range(10, 15)])
+        self.assertEqual(db.select_count(db.samples.key), 15)
+
+        db.sql_db.rollback()
+        self.assertEqual(db.select_count(db.samples.key), 10)
+
+    def test_rollback(self):
+        db = self.db
+
+        def failed_write():
+            with db.bulk_writer(batch_rows=2) as writer:
+                writer.insert(db.samples, [(key, 1.) for key in range(10, 15)])
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed_write)
+        self.assertEqual(db.select_count(db.samples.key), 10)
+
+
+class ThreadTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def run_threads(self, func, num_threads=4):
+        results = [None] * num_threads
+
+        def run(idx):
+            try:
+                results[idx] = func()
+            except Exception as e:
+                results[idx] = e
+
+        threads = [threading.Thread(target=run, args=(idx,)) for idx in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_readers(self):
+        db = self.db
+
+        def read():
+            keys, values = db.select_arrays([db.samples.key, db.samples.value], order_by=db.samples.key)
+            return db.connection is not db.sql_db, db.connection is db.read_connection(), list(keys)
+
+        self.assertEqual(self.run_threads(read), [(True, True, range(10))] * 4)
+        self.assertTrue(db.connection is db.sql_db)
+
+    def test_single_writer(self):
+        db = self.db
+
+        def write():
+            db.insert(db.samples, [(20, 1.)])
+
+        def write_sql(sql):
+            return lambda: list(db.execute(sql))
+
+        master = list(db.execute("SELECT name FROM sqlite_master"))
+
+        for func in (write, write_sql('DELETE FROM samples'), write_sql('DROP TABLE samples'),
+                     write_sql('CREATE TABLE other (a INTEGER)'), write_sql('CREATE INDEX idx ON samples (value)')):
+            for result in self.run_threads(func, num_threads=2):
+                self.assertTrue(isinstance(result, sqlite3.DatabaseError), result)
+        self.assertEqual(db.select_count(db.samples.key), 10)
+        self.assertEqual(list(db.execute("SELECT name FROM sqlite_master")), master)
+
+    def test_pending_writes(self):
+        db = self.db
+        count = lambda: db.select_count(db.samples.key)
+
+        with db.session():
+            db.insert(db.samples, [(20, 1.)])
+            for result in self.run_threads(count, num_threads=2):
+                self.assertTrue(isinstance(result, PendingWriteError), result)
+
+            # The key sets of the owner thread are not pending writes.
+        with db.session():
+            with db.key_set([1, 2]) as key_set:
+                self.assertEqual(self.run_threads(count, num_threads=2), [11, 11])
+
+    def test_reader_sees_commits(self):
+        db = self.db
+        count = lambda: db.select_count(db.samples.key)
+
+        with db.session():
+            db.insert(db.samples, [(20, 1.)])
+        self.assertEqual(self.run_threads(count), [11] * 4)
+
+    def test_key_sets(self):
+        db = self.db
+
+        def read():
+            with db.key_set([1, 3, 30]) as key_set:
+                return db.select_count(db.samples.key, where=db.samples.key.is_in(key_set))
+
+        self.assertEqual(self.run_threads(read), [2] * 4)
+
+    def check_key_sets_then_commit(self, db):
+        counts = []
+        loaded = threading.Event()
+        committed = threading.Event()
+
+        def read():
+            with db.key_set([1, 3, 30]) as key_set:
+                counts.append(db.select_count(db.samples.key, where=db.samples.key.is_in(key_set)))
+            loaded.set()
+            committed.wait()
+            counts.append(db.select_count(db.samples.key))
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        loaded.wait()
+        try:
+            # The key set of the reader leaves no transaction open to
+            # block this commit or pin the reader to an old snapshot.
+            with db.session():
+                db.insert(db.samples, [(20, 1.)])
+        finally:
+            committed.set()
+            thread.join()
+        self.assertEqual(counts, [2, 11])
+
+    def test_key_sets_then_commit(self):
+        self.check_key_sets_then_commit(self.db)
+
+    def test_key_sets_then_commit_wal(self):
+        self.db.close()
+        self.remove_db()
+        self.db = SampleDatabase(self.temp_db_name, create=True, profile='read-mostly')
+        with self.db.session():
+            self.db.insert(self.db.samples, [(key, 0.5 * key) for key in range(10)])
+        self.check_key_sets_then_commit(self.db)
+
+    def test_owner_key_sets(self):
+        db = self.db
+        key_set = db.new_key_set([1, 3, 30])
+        self.assertFalse(db.write_pending)
+        # The keys are committed rather than left in an open transaction.
+        db.sql_db.rollback()
+        self.assertEqual(db.select_count(db.samples.key, where=db.samples.key.is_in(key_set)), 2)
+        db.drop_key_set(key_set)
+        self.assertFalse(db.write_pending)
+        db.sql_db.rollback()
+        self.assertEqual(list(db.execute('SELECT COUNT(*) FROM temp.%s' % key_set.table_name)), [(0,)])
+
+        # Key sets loaded during a session join its transaction.
+        with db.session():
+            db.insert(db.samples, [(20, 1.)])
+            with db.key_set([1, 20]) as key_set:
+                self.assertTrue(db.write_pending)
+                self.assertEqual(db.select_count(db.samples.key, where=db.samples.key.is_in(key_set)), 2)
+        self.assertFalse(db.write_pending)
+        self.assertEqual(self.run_threads(lambda: db.select_count(db.samples.key), num_threads=2), [11, 11])
+
+
+class VarsCacheTestCase(TempDatabaseCase, unittest.TestCase):
+
+    def test_read_once(self):
+        db = self.db
+        db.set_var('a', '1')
+        db.get_var('a')
+        hits, misses = db.sql_cache_hits, db.sql_cache_misses
+
+        for i in range(5):
+            self.assertEqual(db.get_var('a'), '1')
+            self.assertEqual(db.get_var('b'), None)
+
+        self.assertEqual((db.sql_cache_hits, db.sql_cache_misses), (hits, misses))
+
+    def test_write_through(self):
+        db = self.db
+        with db.session():
+            db.set_var('a', '1')
+            db.set_var('a', '2')
+            db.set_var('b', 3)
+
+        self.assertEqual(db.get_var('a'), '2')
+        self.assertEqual(db.get_var('b'), '3')
+
+        db.invalidate_vars()
+        self.assertEqual(db.get_var('a'), '2')
+
+    def test_rollback(self):
+        db = self.db
+        with db.session():
+            db.set_var('a', '1')
+
+        def failed_session():
+            with db.session():
+                db.set_var('a', '2')
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed_session)
+        self.assertEqual(db.get_var('a'), '1')
+
+    def test_other_connection(self):
+        db = self.db
+        self.assertEqual(db.get_var('a'), None)
+
+        other_db = SampleDatabase(self.temp_db_name)
+        with other_db.session():
+            other_db.set_var('a', '1')
+        other_db.close()
+
+        self.assertEqual(db.get_var('a'), None)
+        db.invalidate_vars()
+        self.assertEqual(db.get_var('a'), '1')
+
+
 if __name__ == "__main__":
     unittest.main()
         
@@ -0,0 +1,178 @@
+"""stats.py test suite."""
+
+import os
+import unittest
+
+import numpy as np
+
+import stats as s
+import coord_math as cm
+import topology as t
+import trajdb
+
+
+class MomentsTestCase(unittest.TestCase):
+
+    def make_xs(self, num_frames=100, ndof=12):
+        return 1e6 + np.random.random((num_frames, ndof))
+
+    def test_variance(self):
+        xs = self.make_xs()
+
+        moments = s.Moments()
+        for block in np.array_split(xs, 7):
+            moments.update(block)
+
+        self.assertEqual(moments.count, len(xs))
+        self.assertTrue(np.allclose(moments.mean, xs.mean(axis=0)))
+        self.assertTrue(np.allclose(moments.variance, xs.var(axis=0)))
+
+    def test_covariance(self):
+        xs = self.make_xs()
+
+        moments = s.Moments(covariance=True)
+        for block in np.array_split(xs, 3):
+            moments.update(block)
+
+        self.assertTrue(np.allclose(moments.covariance_matrix, np.cov(xs.T, bias=True)))
+        self.assertTrue(np.allclose(moments.variance, xs.var(axis=0)))
+
+    def test_merge(self):
+        xs = self.make_xs()
+
+        first = s.Moments().update(xs[:30])
+        second = s.Moments().update(xs[30:])
+        merged = s.Moments().merge(first).merge(second)
+
+        self.assertTrue(np.allclose(merged.variance, s.Moments().update(xs).variance))
+
+    def test_merge_mismatch(self):
+        self.assertRaises(s.StatsError, s.Moments().merge, s.Moments(covariance=True))
+
+    def test_empty(self):
+        self.assertRaises(s.StatsError, lambda: s.Moments().variance)
+
+
+class ReductionTestCase(unittest.TestCase):
+
+    def make_top(self):
+        return t.Polymer('chain', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                                   t.Molecule('GLY', ['N', 'CA', 'C', 'O'])])
+
+    def make_xs(self, top, num_frames=50):
+        return np.random.random((num_frames, 3 * top.num_atoms))
+
+    def test_rg(self):
+        x = np.array([1., 0., 0., -1., 0., 0., 0., 2., 0., 0., -2., 0.])
+
+        self.assertAlmostEqual(s.radius_of_gyration(x), np.sqrt(2.5))
+        self.assertEqual(s.radius_of_gyration(np.array([x, 2 * x])).tolist(), [np.sqrt(2.5), 2 * np.sqrt(2.5)])
+
+    def test_rmsf(self):
+        top = self.make_top()
+        xs = self.make_xs(top)
+
+        rmsf = s.block_rmsf(np.array_split(xs, 4))
+
+        d = (xs - xs.mean(axis=0)).reshape((len(xs), -1, 3))
+        self.assertTrue(np.allclose(rmsf, np.sqrt((d * d).sum(axis=2).mean(axis=0))))
+
+    def test_aligned_rmsf(self):
+        top = self.make_top()
+        xs = self.make_xs(top)
+        ca = top.get_atoms('CA')
+        reference = ca.get_coords(xs[0])
+
+        moments = s.block_moments(np.array_split(xs, 4), top=ca, reference=reference)
+
+        aligned = np.array([cm.align(reference, x) for x in ca.get_coords(xs)])
+        self.assertTrue(np.allclose(moments.mean, aligned.mean(axis=0)))
+
+    def test_parallel(self):
+        top = self.make_top()
+        xs = self.make_xs(top)
+        blocks = np.array_split(xs, 5)
+
+        serial = s.block_moments(blocks, top=top, covariance=True)
+        parallel = s.block_moments(blocks, top=top, covariance=True, processes=2)
+
+        self.assertTrue(np.allclose(serial.covariance_matrix, parallel.covariance_matrix))
+
+        rg = s.block_rg_moments(blocks, top=top, masses=top.masses, processes=2)
+        self.assertTrue(np.allclose(rg.mean, s.radius_of_gyration(xs, top.masses).mean()))
+
+
+class DatabaseReductionTestCase(unittest.TestCase):
+
+    temp_db_name = 'test_stats.db'
+
+    def remove_db(self):
+        for file_name in (self.temp_db_name, 'test_stats.hdf5'):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def setUp(self):
+        self.remove_db()
+        self.xs = np.random.random((50, 12))
+        self.db = trajdb.open_trajectory_database(self.temp_db_name, ndof=12, create=True)
+
+    def tearDown(self):
+        self.db.close()
+        self.remove_db()
+
+    def add_samples(self):
+        for x in self.xs:
+            self.db.new_sample(x)
+
+    def test_parallel_committed(self):
+        with self.db.session():
+            self.add_samples()
+
+        moments = s.block_moments(s.coordinate_blocks(self.db, chunk_size=7), processes=2)
+        self.assertEqual(moments.count, 50)
+        self.assertTrue(np.allclose(moments.variance, self.xs.var(axis=0)))
+
+    def test_parallel_uncommitted(self):
+        with self.db.session():
+            self.add_samples()
+            moments = s.block_moments(s.coordinate_blocks(self.db, chunk_size=7), processes=2)
+
+        self.assertEqual(moments.count, 50)
+        self.assertTrue(np.allclose(moments.mean, self.xs.mean(axis=0)))
+
+    def test_parallel_pca(self):
+        with self.db.session():
+            self.add_samples()
+
+        serial = s.block_pca(s.coordinate_blocks(self.db, chunk_size=7), num_components=3)
+        parallel = s.block_pca(s.coordinate_blocks(self.db, chunk_size=7), num_components=3, processes=2)
+        self.assertTrue(np.allclose(serial.variances, parallel.variances))
+
+
+class PCATestCase(unittest.TestCase):
+
+    def make_xs(self, num_frames=200):
+        components = np.array([[3., 0., 0., 1.], [0., 1., 1., 0.]])
+        return np.dot(np.random.normal(size=(num_frames, 2)), components) + [1., 2., 3., 4.]
+
+    def test_components(self):
+        xs = self.make_xs()
+
+        pca = s.block_pca(np.array_split(xs, 5), num_components=2)
+
+        d = xs - xs.mean(axis=0)
+        variances, vectors = np.linalg.eigh(np.dot(d.T, d) / len(xs))
+        self.assertTrue(np.allclose(pca.variances, variances[::-1][:2]))
+        self.assertTrue(np.allclose(np.abs(np.dot(pca.components, vectors[:, ::-1][:, :2])), np.eye(2)))
+        self.assertAlmostEqual(pca.explained_variance_ratio.sum(), 1.)
+
+    def test_reconstruct(self):
+        xs = self.make_xs()
+
+        pca = s.block_pca([xs], num_components=2)
+
+        self.assertTrue(np.allclose(pca.reconstruct(pca.project(xs)), xs))
+
+
+if __name__ == "__main__":
+    unittest.main()
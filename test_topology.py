@@ -1,5 +1,6 @@
 """topology.py test suite."""
 
+import os
 import unittest
 
 import numpy as np
@@ -525,6 +526,36 @@ class PolymerLiftTestCase(unittest.TestCase):
 
         self.assertEqual(first_lift_n_liftcoords.shape, first_coords.shape)
 
+    def test_repeated_residues(self):
+        first_monomers = t.Monomers([t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O'])])
+        second_monomers = t.Monomers([t.Molecule('ALA', ['N', 'CA', 'C', 'O', 'CB'])])
+
+        first_polymer = t.Polymer('firstpoly', first_monomers.sequence(['ALA'] * 3))
+        second_polymer = t.Polymer('secondpoly', second_monomers.sequence(['ALA'] * 3))
+
+        second_coords = np.arange(3 * 15)
+        first_coords = first_polymer.lift_topology(second_polymer).lift_coords(second_coords)
+
+        for monomer, other_monomer in zip(first_polymer.monomers, second_polymer.monomers):
+            self.assertEqual(list(monomer.get_atoms('CB').get_coords(first_coords)),
+                             list(other_monomer.get_atoms('CB').get_coords(second_coords)))
+
+        self.assertEqual(first_monomers.name_index('ALA')['CB'], 2)
+        self.assertEqual(second_monomers.name_index('ALA')['CB'], 4)
+
+        # the repeated residues share the name table of their residue type
+        for monomer in first_polymer.monomers:
+            self.assertTrue(monomer.name_index is first_monomers.name_index('ALA'))
+
+        # the repeated residues share one reorder index held by the polymer
+        self.assertEqual(len(first_polymer.lift_indices), 1)
+        self.assertEqual(second_polymer.lift_indices, {})
+
+    def test_missing_atoms(self):
+        first_polymer, second_polymer = self.make_tops()
+
+        self.assertRaises(t.TopologyError, second_polymer.lift_topology, first_polymer.get_atoms('CA'), reorder=True)
+
 
 class MoleculeChangeNDOFTestCase(unittest.TestCase):
 
@@ -574,5 +605,290 @@ class MoleculeChangeNDOFTestCase(unittest.TestCase):
         self.assertEqual(list(expected_o_x), list(o_x))
 
 
+def make_system():
+    ala = t.Molecule('ALA12', ['N', 'CA', 'CB', 'C', 'O'])
+    gly = t.Molecule('GLY13', ['N', 'CA', 'C', 'O'])
+    water = t.Molecule('HOH', ['H', 'O', 'H'])
+    return t.Polymer('system', [t.Polymer('chain', [ala, gly]), t.Polymer('solvent', [water, water])])
+
+class AtomIndexTestCase(unittest.TestCase):
+
+    def make_top(self):
+        return make_system()
+
+    def test_arrays(self):
+        index = self.make_top().atom_index
+
+        self.assertEqual(list(index.resnames), ['ALA'] * 5 + ['GLY'] * 4 + ['HOH'] * 6)
+        self.assertEqual(list(index.resids), [12] * 5 + [13] * 4 + [1] * 3 + [2] * 3)
+        self.assertEqual(list(index.chainids), [0] * 9 + [1] * 6)
+        self.assertEqual(list(index.residue_starts), [0, 5, 9, 12])
+
+    def test_offsets_match_get_atoms(self):
+        top = self.make_top()
+        index = top.atom_index
+
+        for query in ['CA', 'O', 'H', 'XX']:
+            self.assertEqual(list(index.atom_offsets(index.get_atoms(query))),
+                             list(top.get_atoms(query).atom_offsets))
+
+        self.assertEqual(list(index.atom_offsets(index.regex_get_atoms('^(N|O)$'))),
+                         list(top.regex_get_atoms('^(N|O)$').atom_offsets))
+        self.assertEqual(list(index.atom_offsets(index.get_not_atomset(['CA', 'H']))),
+                         list(top.get_not_atomset(['CA', 'H']).atom_offsets))
+
+    def test_residue_selections(self):
+        index = self.make_top().atom_index
+
+        self.assertEqual(list(index.get_resnames(['GLY'])), range(5, 9))
+        self.assertEqual(list(index.get_chains([1])), range(9, 15))
+        self.assertEqual(list(index.get_resid_range(13, 13)), range(5, 9))
+
+    def test_memoized(self):
+        index = self.make_top().atom_index
+
+        self.assertTrue(index.get_atomset(['N', 'CA']) is index.get_atomset(['CA', 'N']))
+        self.assertTrue(self.make_top().atom_index is not index)
+
+    def test_topology(self):
+        top = self.make_top()
+        index = top.atom_index
+
+        ca_top = index.topology(index.get_atoms('CA'))
+
+        x = np.array(range(3 * top.num_atoms))
+
+        self.assertEqual(ca_top.num_monomers, 2)
+        self.assertEqual(ca_top.sequence, ['ALA12', 'GLY13'])
+        self.assertEqual(list(ca_top.get_coords(x)), list(top.get_atoms('CA').get_coords(x)))
+
+
+class SelectionTestCase(unittest.TestCase):
+
+    def make_top(self):
+        return make_system()
+
+    def test_select(self):
+        top = self.make_top()
+
+        selection = top.select('chain 0 and resname ALA GLY and name CA CB and resid 12-13')
+
+        self.assertEqual(list(selection.atom_indices), [1, 2, 6])
+        self.assertEqual(list(selection.atom_offsets), range(3, 9) + range(18, 21))
+
+    def test_boolean_operators(self):
+        top = self.make_top()
+
+        self.assertEqual(list(top.select('name N or resname HOH').atom_indices), [0, 5] + range(9, 15))
+        self.assertEqual(list(top.select('not (chain 0 or name H)').atom_indices), [10, 13])
+        self.assertEqual(len(top.select('all')), top.num_atoms)
+
+    def test_cached(self):
+        top = self.make_top()
+
+        self.assertTrue(top.select('name CA') is top.select('name CA'))
+
+    def test_topology(self):
+        top = self.make_top()
+
+        x = np.array(range(3 * top.num_atoms))
+        selection = top.select('resname HOH and name O')
+
+        self.assertEqual(selection.topology.sequence, ['HOH', 'HOH'])
+        self.assertEqual(list(selection.topology.get_coords(x)), list(selection.get_coords(x)))
+
+    def test_syntax_errors(self):
+        top = self.make_top()
+
+        for query in ['name', 'bogus CA', 'name CA and', '(name CA', 'chain A', 'resid 1-B', 'name CA )']:
+            self.assertRaises(t.SelectionError, top.select, query)
+
+
+class BlockCoordsTestCase(unittest.TestCase):
+
+    num_frames = 4
+
+    def make_top(self):
+        return make_system()
+
+    def make_block(self, top):
+        return np.arange(self.num_frames * 3 * top.num_atoms, dtype=float).reshape((self.num_frames, -1))
+
+    def test_contiguous_index(self):
+        top = self.make_top()
+
+        self.assertEqual(top.monomers[1].offsets_index, slice(27, 45))
+        self.assertFalse(isinstance(top.get_atoms('CA').offsets_index, slice))
+
+    def test_get_coords(self):
+        top = self.make_top()
+        xs = self.make_block(top)
+
+        for sub_top in [top.get_atoms('CA'), top.monomers[1]]:
+            block = sub_top.get_coords(xs)
+            self.assertEqual(block.tolist(), [list(sub_top.get_coords(x)) for x in xs])
+
+            out = np.empty(block.shape)
+            self.assertTrue(sub_top.get_coords(xs, out=out) is out)
+            self.assertEqual(out.tolist(), block.tolist())
+
+    def test_get_coords_copies(self):
+        top = self.make_top()
+        xs = self.make_block(top)
+
+        block = top.monomers[1].get_coords(xs)
+        block[:] = -1.
+
+        self.assertTrue((xs >= 0.).all())
+
+    def test_set_coords(self):
+        top = self.make_top()
+        xs = self.make_block(top)
+        ca = top.get_atoms('CA')
+
+        ca.set_coords(xs, -ca.get_coords(xs))
+
+        self.assertTrue((ca.get_coords(xs) <= 0.).all())
+        self.assertEqual((xs < 0).sum(), self.num_frames * 3 * 2)
+
+    def test_lift_coords(self):
+        top = t.Polymer('chain', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                                  t.Molecule('GLY', ['N', 'CA', 'C', 'O'])])
+        ca = top.get_atoms('CA')
+        lift = top.lift_topology(ca.get_contiguous_topology())
+        ca_xs = ca.get_coords(self.make_block(top))
+
+        block = lift.lift_coords(ca_xs)
+
+        self.assertEqual(block.shape, (self.num_frames, 3 * top.num_atoms))
+        self.assertEqual(block.tolist(), [list(lift.lift_coords(x)) for x in ca_xs])
+
+        out = np.ones(block.shape)
+        lift.lift_coords(ca_xs, out=out)
+        self.assertEqual(out.tolist(), block.tolist())
+
+
+class BuildTopologyTestCase(unittest.TestCase):
+
+    def make_chains(self):
+        return t.Polymer('system', [t.Polymer('A', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                                                    t.Molecule('GLY', ['N', 'CA', 'C', 'O'])]),
+                                    t.Polymer('B', [t.Molecule('SER', ['N', 'CA', 'CB', 'OG', 'C', 'O'])])])
+
+    def build_chains(self):
+        return t.build_topology('system',
+                                ['N', 'CA', 'CB', 'C', 'O', 'N', 'CA', 'C', 'O', 'N', 'CA', 'CB', 'OG', 'C', 'O'],
+                                ['ALA', 'GLY', 'SER'], [0, 5, 9],
+                                chain_names=['A', 'B'], chain_starts=[0, 2])
+
+    def assertSameTopology(self, top, expected):
+        self.assertEqual(top.name, expected.name)
+        self.assertEqual(list(top.atom_offsets), list(expected.atom_offsets))
+        self.assertEqual(list(top.target_offsets), list(expected.target_offsets))
+        self.assertEqual(top.num_atoms, expected.num_atoms)
+        self.assertEqual(len(top), len(expected))
+        if isinstance(expected, t.Polymer):
+            for monomer, expected_monomer in zip(top.monomers, expected.monomers):
+                self.assertSameTopology(monomer, expected_monomer)
+        else:
+            self.assertEqual(top.atom_names, expected.atom_names)
+
+    def test_flat(self):
+        top = t.build_topology('chain', ['N', 'CA', 'CB', 'C', 'O', 'N', 'CA', 'C', 'O'],
+                               ['ALA', 'GLY'], [0, 5])
+
+        self.assertSameTopology(top, t.Polymer(
+            'chain', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                      t.Molecule('GLY', ['N', 'CA', 'C', 'O'])]))
+
+    def test_chains(self):
+        self.assertSameTopology(self.build_chains(), self.make_chains())
+
+    def test_shared_offsets(self):
+        top = self.build_chains()
+
+        for chain in top.monomers:
+            self.assertTrue(np.may_share_memory(chain.atom_offsets, top.atom_offsets))
+            for monomer in chain.monomers:
+                self.assertTrue(np.may_share_memory(monomer.atom_offsets, top.atom_offsets))
+                self.assertEqual(monomer.shape, top.shape)
+
+    def test_coords(self):
+        top = self.build_chains()
+        x = np.arange(3 * top.num_atoms, dtype=float)
+
+        ser = top.monomers[1].monomers[0]
+        self.assertEqual(list(ser.get_coords(x)), range(27, 45))
+
+    def test_atoms_copy(self):
+        top = self.build_chains().monomers[0]
+
+        top.atoms.append('X')
+        self.assertEqual(len(top.atoms), 9)
+
+
+class SerializationTestCase(unittest.TestCase):
+
+    def walk(self, top):
+        nodes = [(top.__class__, top.name, list(top.atom_offsets), list(top.target_offsets), top.shape, top.ndof)]
+        if isinstance(top, t.Polymer):
+            for monomer in top.monomers:
+                nodes.extend(self.walk(monomer))
+        else:
+            nodes.append(top.atoms)
+        return nodes
+
+    def assertRoundTrip(self, top):
+        self.assertEqual(self.walk(t.loads_topology(t.dumps_topology(top))), self.walk(top))
+
+    def test_molecule(self):
+        self.assertRoundTrip(t.Molecule('water', ['H', 'O', 'H']))
+
+    def test_chains(self):
+        self.assertRoundTrip(BuildTopologyTestCase('test_chains').build_chains())
+
+    def test_lifted(self):
+        top = t.Polymer('chain', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                                  t.Molecule('GLY', ['N', 'CA', 'C', 'O'])])
+        ca = top.get_atoms('CA')
+        self.assertRoundTrip(top.lift_topology(ca.get_contiguous_topology()))
+
+    def test_ndof(self):
+        self.assertRoundTrip(make_system().change_ndof(1))
+
+    def test_cache(self):
+        import shutil
+        import tempfile
+
+        import gro
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            top = gro.read_topology('test_data/water.gro', cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            cached = gro.read_topology('test_data/water.gro', cache_dir=cache_dir)
+            self.assertEqual(self.walk(cached), self.walk(top))
+            self.assertEqual(self.walk(cached), self.walk(gro.read_topology('test_data/water.gro')))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_cache_failure(self):
+        import shutil
+        import tempfile
+
+        def read_topology(file_name, name=None):
+            # Not a topology, so writing the cache entry fails.
+            return object()
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(AttributeError, t.cached_topology, cache_dir, 'test_data/water.gro', 'water',
+                              read_topology)
+            self.assertEqual(os.listdir(cache_dir), [])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,12 +1,14 @@
 """trajdb.py test suite."""
 
 import os
+import threading
 import unittest
 import itertools as it
 
 import numpy as np
 
 import trajdb
+import topology as t
 
 
 class TempDBCase(object):
@@ -79,5 +81,285 @@ class AddSamplesTestCase(TempDBCase, unittest.TestCase):
 
     
         
+class ChunkTestCase(TempDBCase, unittest.TestCase):
+
+    def test_coordinate_chunks(self):
+        db = self.new_db()
+        xs = np.random.random((25, self.ndof))
+        for x in xs:
+            db.new_sample(x)
+
+        chunks = list(db.iter_coordinate_chunks(chunk_size=10))
+
+        self.assertEqual([len(samplekeys) for samplekeys, block in chunks], [10, 10, 5])
+        self.assertEqual(list(np.concatenate([samplekeys for samplekeys, block in chunks])), range(25))
+        self.assertTrue(np.allclose(np.concatenate([block for samplekeys, block in chunks]), xs))
+
+    def test_where_chunks(self):
+        db = self.new_db()
+        xs = np.random.random((25, self.ndof))
+        for x in xs:
+            db.new_sample(x)
+
+        chunks = list(db.iter_coordinate_chunks(chunk_size=4, where=(db.samplekeys.samplekey > 20)
+                                                | (db.samplekeys.samplekey < 2)))
+
+        self.assertEqual([len(samplekeys) for samplekeys, block in chunks], [4, 2])
+        self.assertEqual(sorted(np.concatenate([samplekeys for samplekeys, block in chunks])), [0, 1, 21, 22, 23, 24])
+        for samplekeys, block in chunks:
+            self.assertTrue(np.allclose(block, xs[samplekeys]))
+
+
+class KeysTestCase(TempDBCase, unittest.TestCase):
+
+    def test_keys(self):
+        db = self.new_db()
+        xs = np.random.random((30, self.ndof))
+        with db.session():
+            for x in xs:
+                db.new_sample(x)
+
+        keys = [25, 3, 4, 12, 100]
+        self.assertEqual([samplekey for samplekey, x in db.iter_coordinates(keys=keys)], [3, 4, 12, 25])
+
+        samplekeys, block = db.iter_coordinate_chunks(keys=keys, where=(db.samplekeys.samplekey > 3)).next()
+        self.assertEqual(list(samplekeys), [4, 12, 25])
+        self.assertTrue(np.allclose(block, xs[[4, 12, 25]]))
+
+        with db.key_set(range(10)) as key_set:
+            self.assertEqual(len(list(db.iter_coordinates(keys=key_set))), 10)
+
+        # Abandoning the iteration releases the temporary key set.
+        samplekeys = db.iter_vector_samplekeys(keys=keys)
+        samplekeys.next()
+        samplekeys.close()
+        self.assertEqual(list(db.execute("SELECT name FROM sqlite_temp_master WHERE type='table'")), [('keyset_1',)])
+        self.assertEqual(list(db.execute("SELECT COUNT(*) FROM temp.keyset_1")), [(0,)])
+
+
+class ThreadTestCase(TempDBCase, unittest.TestCase):
+
+    def test_read_samples(self):
+        db = self.new_db()
+        xs = np.random.random((20, self.ndof))
+        with db.session():
+            for x in xs:
+                db.new_sample(x)
+
+        results = {}
+
+        def read(idx):
+            try:
+                results[idx] = (np.array([db.get_sample(samplekey) for samplekey in range(idx, 20, 4)]),
+                                db.vector_file is db.read_vector_file(),
+                                db.vector_file.id.id)
+            except Exception as e:
+                results[idx] = e
+
+        threads = [threading.Thread(target=read, args=(idx,)) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        file_ids = set([db.vector_file.id.id])
+        for idx in range(4):
+            samples, is_read_file, file_id = results[idx]
+            self.assertTrue(np.allclose(samples, xs[idx::4]))
+            self.assertTrue(is_read_file)
+            file_ids.add(file_id)
+
+        self.assertEqual(len(file_ids), 5)
+        db.close()
+        self.assertFalse(db.coordinates)
+
+    def test_keys_then_commit(self):
+        db = self.new_db()
+        with db.session():
+            for x in np.random.random((10, self.ndof)):
+                db.new_sample(x)
+
+        counts = []
+        loaded = threading.Event()
+        committed = threading.Event()
+
+        def read():
+            counts.append(len(list(db.iter_coordinates(keys=[1, 2, 3]))))
+            loaded.set()
+            committed.wait()
+            counts.append(db.select_count(db.samplekeys.samplekey))
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        loaded.wait()
+        try:
+            with db.session():
+                db.new_sample(np.random.random(self.ndof))
+        finally:
+            committed.set()
+            thread.join()
+        self.assertEqual(counts, [3, 11])
+        db.close()
+
+
+class ProjectionTestCase(TempDBCase, unittest.TestCase):
+
+    def test_write_projections(self):
+        import stats
+
+        db = self.new_db()
+        xs = np.random.random((30, self.ndof))
+        for x in xs:
+            db.new_sample(x)
+
+        pca = stats.block_pca(stats.coordinate_blocks(db, chunk_size=7), num_components=3)
+        projections = stats.write_projections(db, pca, 'pca', chunk_size=7)
+
+        self.assertEqual(projections.shape, (30, 3))
+        # Vector tables are stored in single precision.
+        self.assertTrue(np.allclose(projections[:], pca.project(xs), atol=1e-5))
+        self.assertTrue(np.allclose(db.get_vector_table('pca', 3)[:], pca.project(xs), atol=1e-5))
+
+
+def coordinate_sums(xs):
+    return xs.sum(axis=1)
+
+def coordinate_halves(xs):
+    return 0.5 * xs
+
+
+class ComputeTestCase(TempDBCase, unittest.TestCase):
+
+    def new_samples(self, db, num_samples=25):
+        xs = np.random.random((num_samples, self.ndof))
+        for x in xs:
+            db.new_sample(x)
+        return xs
+
+    def test_compute_vector_table(self):
+        db = self.new_db()
+        xs = self.new_samples(db)
+
+        vectors = db.compute_vector_table('halves', coordinate_halves, self.ndof, chunk_size=10)
+
+        self.assertTrue(np.allclose(vectors[:], 0.5 * xs))
+        self.assertEqual(len(list(db.select([db.halves_keys.samplekey]))), 25)
+
+    def test_compute_sample_table(self):
+        db = self.new_db()
+        xs = self.new_samples(db)
+
+        table = db.compute_sample_table('sums', coordinate_sums, chunk_size=10, processes=2)
+
+        sums = dict(db.select(table.columns))
+        self.assertEqual(sorted(sums), range(25))
+        self.assertTrue(np.allclose([sums[samplekey] for samplekey in range(25)], xs.sum(axis=1)))
+
+    def test_resume(self):
+        db = self.new_db()
+        xs = self.new_samples(db)
+
+        calls = []
+        def interrupted(block):
+            calls.append(len(block))
+            if len(calls) > 1:
+                raise KeyboardInterrupt
+            return 0.5 * block
+
+        self.assertRaises(KeyboardInterrupt, db.compute_vector_table, 'halves', interrupted, self.ndof, chunk_size=10)
+        self.assertEqual(len(list(db.select([db.halves_keys.samplekey]))), 10)
+
+        xs = np.concatenate([xs, self.new_samples(db, 5)])
+        calls = []
+        def resumed(block):
+            calls.append(len(block))
+            return 0.5 * block
+
+        vectors = db.compute_vector_table('halves', resumed, self.ndof, chunk_size=10)
+
+        self.assertEqual(calls, [10, 10])
+        self.assertTrue(np.allclose(vectors[:], 0.5 * xs))
+
+
+class ConnectionProfileTestCase(TempDBCase, unittest.TestCase):
+
+    def pragma(self, db, name):
+        for value, in db.execute('PRAGMA %s' % name):
+            return value
+
+    def test_default(self):
+        db = self.new_db()
+
+        self.assertEqual(db.connection_profile, None)
+        self.assertEqual(self.pragma(db, 'journal_mode'), 'delete')
+
+    def test_reapplied(self):
+        db = trajdb.open_trajectory_database(self.temp_db_name, ndof=self.ndof, create=True, profile='bulk-load')
+
+        self.assertEqual(self.pragma(db, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(db, 'synchronous'), 0)
+        db.close()
+
+        db = trajdb.open_trajectory_database(self.temp_db_name)
+        self.assertEqual(db.connection_profile, 'bulk-load')
+        self.assertEqual(self.pragma(db, 'synchronous'), 0)
+        self.assertEqual(self.pragma(db, 'temp_store'), 2)
+        db.close()
+
+        db = trajdb.open_trajectory_database(self.temp_db_name, profile='safe')
+        self.assertEqual(self.pragma(db, 'journal_mode'), 'delete')
+        self.assertEqual(self.pragma(db, 'synchronous'), 2)
+        db.close()
+
+    def test_unknown(self):
+        self.assertRaises(trajdb.ConnectionProfileError, trajdb.open_trajectory_database,
+                          self.temp_db_name, ndof=self.ndof, create=True, profile='fast')
+
+
+class IndexTestCase(TempDBCase, unittest.TestCase):
+
+    def index_names(self, db):
+        return set(name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"))
+
+    def test_default_indexes(self):
+        db = self.new_db()
+        with db.session():
+            db.add_sample_table('energy')
+        db.close()
+
+        db = trajdb.open_trajectory_database(self.temp_db_name)
+        self.assertEqual(self.index_names(db), set(['idx_times_time', 'idx_trajectories_trajectorykey', 'idx_energy_value']))
+        self.assertEqual(len(db.energy.indexes), 1)
+        db.close()
+
+
+class TopologyTestCase(TempDBCase, unittest.TestCase):
+
+    ndof = 3 * 9
+
+    def make_top(self):
+        return t.Polymer('chain', [t.Molecule('ALA', ['N', 'CA', 'CB', 'C', 'O']),
+                                   t.Molecule('GLY', ['N', 'CA', 'C', 'O'])])
+
+    def test_no_topology(self):
+        db = self.new_db()
+
+        self.assertEqual(db.get_topology(), None)
+
+    def test_reopen_topology(self):
+        db = self.new_db()
+        with db.session():
+            db.set_topology(self.make_top())
+        db.close()
+
+        db = trajdb.open_trajectory_database(self.temp_db_name)
+        top = db.get_topology()
+
+        self.assertEqual(top.name, 'chain')
+        self.assertEqual([monomer.atoms for monomer in top.monomers],
+                         [monomer.atoms for monomer in self.make_top().monomers])
+        self.assertEqual(list(top.atom_offsets), range(3 * 9))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,14 @@
 
+import os
 import re
+import hashlib
+import tempfile
+from cStringIO import StringIO
 
 import numpy as np
 
+import elements
+
 def get_atoms_adapter(monomer, arg):
     return monomer.get_atoms(arg)
 
@@ -37,13 +43,15 @@ def filter_not_atomset(s):
 
 
 def filter_regex(regex):
+    match = re.compile(regex).match
     def filter_condition(atom_name):
-        return re.match(regex, atom_name)
+        return match(atom_name)
     return filter_condition
 
 def filter_not_regex(regex):
+    match = re.compile(regex).match
     def filter_condition(atom_name):
-        return not re.match(regex, atom_name)
+        return not match(atom_name)
     return filter_condition
 
 
@@ -64,10 +72,42 @@ def change_by_atom_ndof(offsets_by_atom, new_ndof):
 
     return new_offsets_by_atom
 
+
+def offsets_index(offsets):
+    """Return the index equivalent to offsets, a slice if they are contiguous."""
+    offsets = np.asarray(offsets)
+    if len(offsets) == 0:
+        return slice(0, 0)
+    if (offsets[-1] - offsets[0] == len(offsets) - 1
+        and (np.diff(offsets) == 1).all()):
+        return slice(int(offsets[0]), int(offsets[-1]) + 1)
+    return offsets
+
+
+def take_coords(x, index, out=None):
+    """Return a copy of x[..., index] for a geometry or a block of geometries."""
+    if not isinstance(x, np.ndarray):
+        x = np.asarray(x)
+
+    if out is not None and not isinstance(index, slice):
+        return np.take(x, index, axis=-1, out=out)
+
+    coords = x[..., index]
+
+    if out is not None:
+        out[...] = coords
+        return out
+    elif isinstance(index, slice):
+        return np.array(coords)
+    return coords
+
         
 class TopologyError(Exception):
     pass
 
+class SelectionError(TopologyError):
+    pass
+
 class Topology(object):
 
     def __init__(self, name, atom_offsets=None, start=0, shape=None, target_offsets=None, ndof=3):
@@ -87,11 +127,11 @@ class Topology(object):
         #     pass
 
         if atom_offsets is None:
-            atom_offsets = np.array(range(start, start + ndof * self.num_atoms))
+            atom_offsets = np.arange(start, start + ndof * self.num_atoms)
         elif len(atom_offsets) % ndof != 0:
             raise TopologyError("Bad offset length: len(%s) = %s with ndof %s" % (atom_offsets, len(atom_offsets), ndof))
 
-        self.atom_offsets = np.array(atom_offsets)
+        self.atom_offsets = np.asarray(atom_offsets)
 
         if shape is None:
             self.shape = self.atom_offsets.shape
@@ -106,6 +146,9 @@ class Topology(object):
         if self.target_offsets.shape != self.atom_offsets.shape:
             raise TopologyError("atom and target offsets do not have the same shape")
 
+        self.offsets_index = offsets_index(self.atom_offsets)
+        self.targets_index = offsets_index(self.target_offsets)
+
 
     def indent_str(self, level):
         name = self.name
@@ -144,27 +187,110 @@ class Topology(object):
             raise Exception("can't resize %s" % self.target_offsets)
 
 
-    def get_coords(self, x):
-        try:
-            return x[self.atom_offsets]
-        except TypeError:
-            x = np.array(x)
-            return x[self.atom_offsets]
+    def get_coords(self, x, out=None):
+        """Return the coordinates of the atoms of the topology in x.
+
+        x may be a single flat geometry or an (M, ndof*N) block of
+        geometries.  The result is copied into out when it is given.
+
+        """
+        return take_coords(x, self.offsets_index, out=out)
 
 
     def set_coords(self, x, new_x):
-        x[self.atom_offsets] = new_x
+        x[..., self.offsets_index] = new_x
 
     def transfer_coords(self, y, x):
-        y[self.target_offsets] = x[self.atom_offsets]
+        if not isinstance(x, np.ndarray):
+            x = np.asarray(x)
+        y[..., self.targets_index] = x[..., self.offsets_index]
         return y
 
 
-    def lift_coords(self, x):
-        y = np.zeros(self.shape)
+    def lift_coords(self, x, out=None):
+        x = np.asarray(x)
+        shape = x.shape[:-1] + tuple(self.shape)
+        if out is None:
+            y = np.zeros(shape)
+        else:
+            if out.shape != shape:
+                raise TopologyError("out has the wrong shape: %s != %s" % (out.shape, shape))
+            y = out
+            y[...] = 0.
         self.transfer_coords(y, x)
         return y
 
+    __atom_index = None
+
+    @property
+    def atom_index(self):
+        """The AtomIndex of this topology, built on first use."""
+        if self.__atom_index is None:
+            self.__atom_index = AtomIndex(self)
+        return self.__atom_index
+
+    def select(self, query):
+        """Return the Selection for a query such as 'resname ALA GLY and name CA'."""
+        return self.atom_index.select(query)
+
+    @property
+    def residue_starts(self):
+        """The index of the first atom of each residue in the atoms of the topology."""
+        return self.atom_index.residue_starts
+
+    __masses = None
+
+    @property
+    def masses(self):
+        """The masses of the atoms of the topology, guessed from the atom names."""
+        if self.__masses is None:
+            index = self.atom_index
+            masses = elements.atom_masses(index.atom_names.tolist(), index.resnames.tolist())
+            masses.flags.writeable = False
+            self.__masses = masses
+        return self.__masses
+
+def name_index(atoms):
+    """Return a dictionary mapping each of the atom names to its index."""
+    return dict((atom_name, idx) for idx, atom_name in enumerate(atoms))
+
+
+def lift_index(topology, other_topology, other_atom_names, reorder, lift_indices=None):
+    """Return the indices of the atoms of topology in the order of other_atom_names.
+
+    The atoms are looked up in the name table of topology, which the
+    residues of a sequence share.  The indices only depend on the atom
+    names; when lift_indices is given, they are kept in it under the
+    atom names, so a polymer maps each residue type and name convention
+    once.
+
+    """
+    key = (tuple(topology.atoms), tuple(other_atom_names), reorder)
+    if lift_indices is not None:
+        try:
+            return lift_indices[key]
+        except KeyError:
+            pass
+
+    atoms, other_atom_names = key[:2]
+    index = topology.name_index
+
+    if len(index) != len(atoms):
+        raise TopologyError("Can not reorder atoms in a molecule with redundant atom names.")
+
+    if ((reorder and (set(atoms) != set(other_atom_names)))
+        or any(atom_name not in index for atom_name in other_atom_names)):
+        first = '\n'.join(set(atoms) - set(other_atom_names))
+        second = '\n'.join(set(other_atom_names) - set(atoms))
+        raise TopologyError("Can not reorder topology %s to %s because the set of atom names do not match.\nIn first but not second: %s\nsecond but not first: %s" % (topology.name, other_topology.name, first, second))
+
+    idx = np.array([index[atom_name] for atom_name in other_atom_names], dtype=int)
+    idx.flags.writeable = False
+    if lift_indices is not None:
+        lift_indices[key] = idx
+    return idx
+
+
 class Molecule(Topology):
 
     def __init__(self, name, atoms, atom_offsets=None, start=0, shape=None, target_offsets=None, ndof=3):
@@ -174,11 +300,23 @@ class Molecule(Topology):
                           ndof=ndof)
 
     def copy(self):
-        return Molecule(self.name, self.atoms[:],
-                        atom_offsets=self.atom_offsets.copy(),
-                        shape=self.shape,
-                        target_offsets=self.target_offsets.copy(),
-                        ndof=self.ndof)
+        molecule = Molecule(self.name, self.atoms[:],
+                            atom_offsets=self.atom_offsets.copy(),
+                            shape=self.shape,
+                            target_offsets=self.target_offsets.copy(),
+                            ndof=self.ndof)
+        # The copies of a residue share its name table.
+        molecule.__name_index = self.name_index
+        return molecule
+
+    __name_index = None
+
+    @property
+    def name_index(self):
+        """The dictionary mapping each of the atom names to its index."""
+        if self.__name_index is None:
+            self.__name_index = name_index(self.atoms)
+        return self.__name_index
 
 
     @property
@@ -189,6 +327,11 @@ class Molecule(Topology):
     def atom_names(self):
         return self.atoms
 
+    @property
+    def monomer_starts(self):
+        """A molecule is a single monomer starting at its first atom."""
+        return np.zeros(1, dtype=int)
+
 
     def __len__(self):
         return len(self.atoms)
@@ -231,7 +374,7 @@ class Molecule(Topology):
         return self._get(filter_not_regex(query))
 
     def lift_topology(self, other_topology, namemap=None,
-                      reorder=False):
+                      reorder=False, lift_indices=None):
 
         if self.ndof != other_topology.ndof:
             raise TopologyError("Can not raise a topology with %s dof to %s dof." % (other_topology.ndof, self.ndof))
@@ -241,35 +384,18 @@ class Molecule(Topology):
         else:
             other_atom_names = other_topology.atoms
 
-        if len(set(self.atoms)) != len(self.atoms):
-            raise TopologyError("Can not reorder atoms in a molecule with redundant atom names.")
-
-        if ((reorder and (set(self.atoms) != set(other_atom_names)))
-            or len(set(other_atom_names) - set(self.atoms)) > 0):
-            first = '\n'.join(set(self.atoms) - set(other_atom_names))
-            second = '\n'.join(set(other_atom_names) - set(self.atoms))
-            raise TopologyError("Can not reorder topology %s to %s because the set of atom names do not match.\nIn first but not second: %s\nsecond but not first: %s" % (self.name, other_topology.name, first, second))
-        
-        offsets_by_atom = self.offsets_by_atom
-        other_offsets_by_atom = other_topology.offsets_by_atom
+        idx = lift_index(self, other_topology, other_atom_names, reorder,
+                         lift_indices=lift_indices)
 
-        atom_offsets = []
-        target_offsets = []
-
-        for jdx, atom_name in enumerate(other_atom_names):
-            idx = self.atoms.index(atom_name)
-            
-            atom_offsets.extend(list(other_offsets_by_atom[jdx]))
-            target_offsets.extend(list(offsets_by_atom[idx]))
-
-        atom_offsets = np.array(atom_offsets)
-        target_offsets = np.array(target_offsets)
+        atom_offsets = other_topology.offsets_by_atom.reshape(-1)
+        target_offsets = self.offsets_by_atom[idx].reshape(-1)
 
         return Molecule(self.name, 
                         other_atom_names, 
                         atom_offsets=atom_offsets, 
                         shape=self.shape, 
-                        target_offsets=target_offsets)
+                        target_offsets=target_offsets,
+                        ndof=self.ndof)
 
     def change_ndof(self, new_ndof):
         new_offsets_by_atom = change_by_atom_ndof(self.offsets_by_atom, new_ndof)
@@ -291,23 +417,21 @@ class Molecule(Topology):
 
 
     def get_contiguous_topology(self, start=0):
-        return self.__class__(atoms=self.atoms, start=start, ndof=self.ndof, name=self.name)
+        molecule = self.__class__(atoms=self.atoms, start=start, ndof=self.ndof, name=self.name)
+        molecule.__name_index = self.name_index
+        return molecule
         
 
 def monomers_offset_vector(monomers):
-    atom_offsets = []
-    for monomer in monomers:
-        atom_offsets.extend(list(monomer.atom_offsets))
-
-    return np.array(atom_offsets)
+    if not monomers:
+        return np.zeros(0, dtype=int)
+    return np.concatenate([monomer.atom_offsets for monomer in monomers])
 
 
 def monomers_target_vector(monomers):
-    target_offsets = []
-    for monomer in monomers:
-        target_offsets.extend(list(monomer.target_offsets))
-
-    return np.array(target_offsets)
+    if not monomers:
+        return np.zeros(0, dtype=int)
+    return np.concatenate([monomer.target_offsets for monomer in monomers])
         
 
 class Polymer(Topology):
@@ -373,23 +497,33 @@ class Polymer(Topology):
     def sequence(self):
         return [monomer.name for monomer in self.monomers]
 
+    __atoms = None
+
     @property
     def atoms(self):
-        atom_names = []
-        for monomer in self.monomers:
-            atom_names.extend(monomer.atom_names)
-        return atom_names
+        if self.__atoms is None:
+            atom_names = []
+            for monomer in self.monomers:
+                atom_names.extend(monomer.atom_names)
+            self.__atoms = atom_names
+        return list(self.__atoms)
     
     @property
     def num_monomers(self):
         return len(self.monomers)
 
+    @property
+    def monomer_starts(self):
+        """The index of the first atom of each monomer in the atoms of the polymer."""
+        num_atoms = [monomer.num_atoms for monomer in self.monomers]
+        return np.cumsum([0] + num_atoms[:-1])
+
     @property
     def num_atoms(self):
-        return sum(monomer.num_atoms for monomer in self.monomers)
+        return len(self.atom_offsets) // self.ndof
 
     def __len__(self):
-        return sum(len(monomer) for monomer in self.monomers)
+        return self.num_atoms
 
     def get_monomer(self, query):
         concrete_monomers = [monomer for monomer in self.monomers if monomer.name == query]
@@ -421,12 +555,23 @@ class Polymer(Topology):
     def regex_get_other_atoms(self, query):
         return self._get(regex_get_other_atoms_adapter, query)
 
+    __lift_indices = None
+
+    @property
+    def lift_indices(self):
+        """The reorder indices of the monomers computed by lift_topology, by atom names."""
+        if self.__lift_indices is None:
+            self.__lift_indices = {}
+        return self.__lift_indices
+
     def lift_topology(self, other_topology, namemap=None,
-                      reorder=False):
+                      reorder=False, lift_indices=None):
 
         if self.ndof != other_topology.ndof:
             raise TopologyError("Can not raise a topology with %s dof to %s dof." % (other_topology.ndof, self.ndof))
         
+        if lift_indices is None:
+            lift_indices = self.lift_indices
 
 
         if self.num_monomers != other_topology.num_monomers:
@@ -436,7 +581,8 @@ class Polymer(Topology):
 
         for monomer, other_monomer in zip(self.monomers, other_topology.monomers):
             concrete_monomers.append(monomer.lift_topology(other_monomer, namemap=namemap,
-                                                           reorder=reorder))
+                                                           reorder=reorder,
+                                                           lift_indices=lift_indices))
 
         return Polymer(self.name, concrete_monomers, fixed_monomers=True, shape=self.shape, ndof=self.ndof)
 
@@ -468,6 +614,407 @@ class Polymer(Topology):
         return Polymer(self.name, concrete_monomers, fixed_monomers=True, ndof=self.ndof)
 
 
+def build_topology(name, atom_names, residue_names, residue_starts,
+                   chain_names=None, chain_starts=None, ndof=3):
+    """Build a Polymer from flat per-atom and per-residue arrays.
+
+    residue_starts holds the index of the first atom of each residue.
+    When chain_names is given, chain_starts holds the index of the first
+    residue of each chain and the result is a Polymer of chain Polymers.
+
+    All of the monomers hold views of a single offsets array rather than
+    their own copies, so large systems are built without re-copying
+    offsets at each level of the tree.
+
+    """
+    atom_names = list(atom_names)
+    num_atoms = len(atom_names)
+    offsets = np.arange(ndof * num_atoms)
+    shape = offsets.shape
+
+    atom_bounds = list(residue_starts) + [num_atoms]
+
+    residues = []
+    for resname, start, stop in zip(residue_names, atom_bounds[:-1], atom_bounds[1:]):
+        residues.append(Molecule(resname, atom_names[start:stop],
+                                 atom_offsets=offsets[ndof * start:ndof * stop],
+                                 shape=shape, ndof=ndof))
+
+    if chain_names is None:
+        monomers = residues
+    else:
+        residue_bounds = list(chain_starts) + [len(residues)]
+        monomers = []
+        for chain_name, first, last in zip(chain_names, residue_bounds[:-1], residue_bounds[1:]):
+            start = atom_bounds[first]
+            stop = atom_bounds[last]
+            chain_offsets = offsets[ndof * start:ndof * stop]
+            monomers.append(Polymer(chain_name, residues[first:last], fixed_monomers=True,
+                                    atom_offsets=chain_offsets, target_offsets=chain_offsets,
+                                    shape=shape, ndof=ndof))
+
+    return Polymer(name, monomers, fixed_monomers=True,
+                   atom_offsets=offsets, target_offsets=offsets,
+                   shape=shape, ndof=ndof)
+
+
+residue_number_re = re.compile(r'^(.*?[^\d-])(-?\d+)$')
+
+def split_residue_name(name):
+    """Split a monomer name like 'ALA12' into its residue name and number.
+
+    The number is None when the name does not end in one.
+
+    """
+    name = name.strip()
+    match = residue_number_re.match(name)
+    if match:
+        return match.group(1), int(match.group(2))
+    return name, None
+
+
+def iter_residues(top):
+    """Yield (chain index, residue) for each Molecule in the topology tree.
+
+    Chains are the top level monomers of a polymer of polymers; all the
+    residues of any other topology are in chain 0.
+
+    """
+    if isinstance(top, Molecule):
+        yield 0, top
+    elif any(isinstance(monomer, Polymer) for monomer in top.monomers):
+        for chain, monomer in enumerate(top.monomers):
+            for ignored_chain, residue in iter_residues(monomer):
+                yield chain, residue
+    else:
+        for monomer in top.monomers:
+            for ignored_chain, residue in iter_residues(monomer):
+                yield 0, residue
+
+
+def group_indices(values):
+    """Return a dict from each distinct value to the sorted indices holding it."""
+    if len(values) == 0:
+        return {}
+    keys, inverse = np.unique(values, return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+    return dict(zip(keys.tolist(), np.split(order, bounds)))
+
+
+class AtomIndex(object):
+    """Flat per-atom arrays of a topology, indexed by atom and residue name.
+
+    Selections return sorted arrays of flat atom indices (positions in
+    top.atoms) and are memoized, so repeating a query is a dictionary
+    lookup.  The offsets of a selection are obtained with
+    atom_offsets, and a Topology is only built when asked for with
+    topology.
+
+    """
+
+    def __init__(self, top):
+        self.top = top
+        self.ndof = top.ndof
+
+        residues = []
+        atom_names = []
+        resnames = []
+        resids = []
+        residue_indices = []
+        chainids = []
+        residue_starts = []
+        offsets = []
+        targets = []
+
+        last_chain = None
+        for residue_index, (chain, residue) in enumerate(iter_residues(top)):
+            if chain != last_chain:
+                position = 0
+                last_chain = chain
+            position += 1
+
+            resname, resid = split_residue_name(residue.name)
+            if resid is None:
+                resid = position
+
+            num_atoms = residue.num_atoms
+            residues.append(residue)
+            residue_starts.append(len(atom_names))
+            atom_names.extend(residue.atoms)
+            resnames.extend([resname] * num_atoms)
+            resids.extend([resid] * num_atoms)
+            residue_indices.extend([residue_index] * num_atoms)
+            chainids.extend([chain] * num_atoms)
+            offsets.append(residue.offsets_by_atom)
+            targets.append(residue.targets_by_atom)
+
+        self.residues = residues
+        self.atom_names = np.array(atom_names, dtype=str)
+        self.resnames = np.array(resnames, dtype=str)
+        self.resids = np.array(resids, dtype=int)
+        self.residue_indices = np.array(residue_indices, dtype=int)
+        self.chainids = np.array(chainids, dtype=int)
+        self.residue_starts = np.array(residue_starts, dtype=int)
+
+        if offsets:
+            self.offsets_by_atom = np.concatenate(offsets)
+            self.targets_by_atom = np.concatenate(targets)
+        else:
+            self.offsets_by_atom = np.zeros((0, self.ndof), dtype=int)
+            self.targets_by_atom = np.zeros((0, self.ndof), dtype=int)
+
+        self.atom_name_index = group_indices(self.atom_names)
+        self.resname_index = group_indices(self.resnames)
+
+        self.__selections = {}
+        self.__queries = {}
+
+    @property
+    def num_atoms(self):
+        return len(self.atom_names)
+
+    def memoize(self, key, compute):
+        try:
+            return self.__selections[key]
+        except KeyError:
+            pass
+        selection = np.asarray(compute(), dtype=int)
+        selection.flags.writeable = False
+        self.__selections[key] = selection
+        return selection
+
+    def union(self, index, names):
+        empty = np.zeros(0, dtype=int)
+        groups = [index.get(name, empty) for name in names]
+        if not groups:
+            return empty
+        return np.sort(np.concatenate(groups))
+
+    def complement(self, selection):
+        mask = np.ones(self.num_atoms, dtype=bool)
+        mask[selection] = False
+        return np.flatnonzero(mask)
+
+    def get_atoms(self, query):
+        return self.get_atomset([query])
+
+    def get_atomset(self, query):
+        query = frozenset(query)
+        return self.memoize(('atomset', query),
+                            lambda: self.union(self.atom_name_index, query))
+
+    def get_not_atomset(self, query):
+        query = frozenset(query)
+        return self.memoize(('not_atomset', query),
+                            lambda: self.complement(self.get_atomset(query)))
+
+    def regex_get_atoms(self, query):
+        def compute():
+            match = re.compile(query).match
+            return self.union(self.atom_name_index, 
+                              [name for name in self.atom_name_index if match(name)])
+        return self.memoize(('regex', query), compute)
+
+    def regex_get_other_atoms(self, query):
+        return self.memoize(('not_regex', query),
+                            lambda: self.complement(self.regex_get_atoms(query)))
+
+    def get_resnames(self, query):
+        query = frozenset(query)
+        return self.memoize(('resnames', query),
+                            lambda: self.union(self.resname_index, query))
+
+    def get_chains(self, query):
+        query = frozenset(query)
+        return self.memoize(('chains', query),
+                            lambda: np.flatnonzero(np.in1d(self.chainids, list(query))))
+
+    def get_resid_range(self, first, last):
+        """Select the atoms with first <= resid <= last."""
+        return self.memoize(('resids', first, last),
+                            lambda: np.flatnonzero((self.resids >= first) & (self.resids <= last)))
+
+    def select(self, query):
+        """Compile the selection query, caching the result by query string."""
+        try:
+            return self.__queries[query]
+        except KeyError:
+            pass
+        selection = Selection(self, query, self.memoize(('query', query),
+                                                        lambda: parse_selection(self, query)))
+        self.__queries[query] = selection
+        return selection
+
+    def atom_offsets(self, selection):
+        return self.offsets_by_atom[selection].reshape((-1,))
+
+    def target_offsets(self, selection):
+        return self.targets_by_atom[selection].reshape((-1,))
+
+    def topology(self, selection, name=None):
+        """Return a flat Polymer of the residues holding the selected atoms."""
+        if name is None:
+            name = self.top.name
+
+        selection = np.asarray(selection, dtype=int)
+        residue_indices = self.residue_indices[selection]
+        bounds = np.flatnonzero(np.diff(residue_indices)) + 1
+
+        shape = self.top.shape
+        monomers = []
+        for atoms in np.split(selection, bounds):
+            if len(atoms) == 0:
+                continue
+            residue = self.residues[self.residue_indices[atoms[0]]]
+            monomers.append(Molecule(residue.name, self.atom_names[atoms].tolist(),
+                                     atom_offsets=self.atom_offsets(atoms),
+                                     target_offsets=self.target_offsets(atoms),
+                                     shape=shape,
+                                     ndof=self.ndof))
+
+        return Polymer(name, monomers, fixed_monomers=True,
+                       atom_offsets=self.atom_offsets(selection),
+                       target_offsets=self.target_offsets(selection),
+                       shape=shape,
+                       ndof=self.ndof)
+
+
+selection_token_re = re.compile(r'\(|\)|[^\s()]+')
+resid_range_re = re.compile(r'^(-?\d+)(?:-(-?\d+))?$')
+
+selection_operators = set(['and', 'or', 'not', '(', ')'])
+
+
+def parse_selection(index, query):
+    """Evaluate a selection query against an AtomIndex.
+
+    The grammar is
+
+        expr := term ('or' term)*
+        term := factor ('and' factor)*
+        factor := 'not' factor | '(' expr ')' | 'all'
+                | 'name' NAME+ | 'resname' RESNAME+ 
+                | 'resid' (N | N-M)+ | 'chain' N+
+
+    for example 'chain 0 and resname ALA GLY and name CA CB and resid 10-50'.
+
+    """
+    tokens = selection_token_re.findall(query)
+    tokens.reverse()
+
+    def peek():
+        if tokens:
+            return tokens[-1].lower()
+        return None
+
+    def arguments(keyword):
+        args = []
+        while tokens and peek() not in selection_operators:
+            args.append(tokens.pop())
+        if not args:
+            raise SelectionError("Expected arguments to '%s' in '%s'" % (keyword, query))
+        return args
+
+    def integers(keyword, args):
+        try:
+            return [int(arg) for arg in args]
+        except ValueError:
+            raise SelectionError("Expected integer arguments to '%s' in '%s'" % (keyword, query))
+
+    def resid_ranges(args):
+        selections = []
+        for arg in args:
+            match = resid_range_re.match(arg)
+            if not match:
+                raise SelectionError("Bad resid range '%s' in '%s'" % (arg, query))
+            first = int(match.group(1))
+            last = first if match.group(2) is None else int(match.group(2))
+            selections.append(index.get_resid_range(first, last))
+        return reduce(np.union1d, selections)
+
+    def parse_factor():
+        if not tokens:
+            raise SelectionError("Unexpected end of selection '%s'" % query)
+
+        token = tokens.pop()
+        keyword = token.lower()
+
+        if keyword == 'not':
+            return index.complement(parse_factor())
+        elif keyword == '(':
+            selection = parse_expr()
+            if peek() != ')':
+                raise SelectionError("Unbalanced parenthesis in '%s'" % query)
+            tokens.pop()
+            return selection
+        elif keyword == 'all':
+            return np.arange(index.num_atoms)
+        elif keyword == 'name':
+            return index.get_atomset(arguments(keyword))
+        elif keyword == 'resname':
+            return index.get_resnames(arguments(keyword))
+        elif keyword == 'resid':
+            return resid_ranges(arguments(keyword))
+        elif keyword == 'chain':
+            return index.get_chains(integers(keyword, arguments(keyword)))
+        else:
+            raise SelectionError("Unknown selection keyword '%s' in '%s'" % (token, query))
+
+    def parse_term():
+        selection = parse_factor()
+        while peek() == 'and':
+            tokens.pop()
+            selection = np.intersect1d(selection, parse_factor())
+        return selection
+
+    def parse_expr():
+        selection = parse_term()
+        while peek() == 'or':
+            tokens.pop()
+            selection = np.union1d(selection, parse_term())
+        return selection
+
+    selection = parse_expr()
+    if tokens:
+        raise SelectionError("Unexpected '%s' in '%s'" % (tokens[-1], query))
+    return selection
+
+
+class Selection(object):
+    """A compiled selection: the atom indices of a query and their offsets.
+
+    The Topology of the selection is built the first time it is used.
+
+    """
+
+    def __init__(self, index, query, atom_indices):
+        self.index = index
+        self.query = query
+        self.atom_indices = atom_indices
+        self.atom_offsets = index.atom_offsets(atom_indices)
+        self.target_offsets = index.target_offsets(atom_indices)
+        self.offsets_index = offsets_index(self.atom_offsets)
+
+    @property
+    def num_atoms(self):
+        return len(self.atom_indices)
+
+    def __len__(self):
+        return len(self.atom_indices)
+
+    __topology = None
+
+    @property
+    def topology(self):
+        if self.__topology is None:
+            self.__topology = self.index.topology(self.atom_indices)
+        return self.__topology
+
+    def get_coords(self, x, out=None):
+        return take_coords(x, self.offsets_index, out=out)
+
+
 def namedict(d):
     """reorder namemap using the dict."""
 
@@ -486,7 +1033,174 @@ class Monomers(object):
     def __init__(self, monomers):
         self.monomer_dict = dict((monomer.name, monomer) for monomer in monomers)
 
+    def name_index(self, resname):
+        """Return the atom name to index dictionary of the monomer resname.
+
+        The residues of a sequence share this table, which lift_topology
+        uses to reorder their atoms.
+
+        """
+        return self.monomer_dict[resname].name_index
+
     def sequence(self, resseq):
         monomer_dict = self.monomer_dict
         return [monomer_dict[resname].copy() for resname in resseq]
     
+
+
+# Serialization
+
+def topology_arrays(top):
+    """Return a dictionary of the arrays describing the topology tree.
+
+    The nodes of the tree are listed in preorder with the index of
+    their parent.  Only the molecules store atom names and offsets; the
+    polymers are rebuilt from their monomers.
+
+    """
+    node_kinds = []
+    node_names = []
+    node_parents = []
+    node_sizes = []
+    node_ndofs = []
+    node_num_atoms = []
+    atom_names = []
+    atom_offsets = []
+    target_offsets = []
+
+    stack = [(top, -1)]
+    while stack:
+        node, parent = stack.pop()
+        if len(node.shape) != 1:
+            raise TopologyError("Can only serialize topologies of flat geometries: %s" % (node.shape,))
+        idx = len(node_kinds)
+        node_names.append(node.name)
+        node_parents.append(parent)
+        node_sizes.append(node.shape[0])
+        node_ndofs.append(node.ndof)
+        if isinstance(node, Polymer):
+            node_kinds.append(1)
+            node_num_atoms.append(0)
+            stack.extend((monomer, idx) for monomer in reversed(node.monomers))
+        else:
+            node_kinds.append(0)
+            node_num_atoms.append(node.num_atoms)
+            atom_names.extend(node.atoms)
+            atom_offsets.append(node.atom_offsets)
+            target_offsets.append(node.target_offsets)
+
+    if atom_offsets:
+        atom_offsets = np.concatenate(atom_offsets)
+        target_offsets = np.concatenate(target_offsets)
+
+    return dict(node_kinds=np.array(node_kinds, dtype=np.int8),
+                node_names=np.array(node_names, dtype=str),
+                node_parents=np.array(node_parents, dtype=int),
+                node_sizes=np.array(node_sizes, dtype=int),
+                node_ndofs=np.array(node_ndofs, dtype=int),
+                node_num_atoms=np.array(node_num_atoms, dtype=int),
+                atom_names=np.array(atom_names, dtype=str),
+                atom_offsets=np.array(atom_offsets, dtype=int),
+                target_offsets=np.array(target_offsets, dtype=int))
+
+
+def arrays_topology(arrays):
+    """Rebuild the topology tree described by the arrays of topology_arrays."""
+    node_kinds = arrays['node_kinds']
+    node_names = arrays['node_names'].tolist()
+    node_parents = arrays['node_parents']
+    node_sizes = arrays['node_sizes']
+    node_ndofs = arrays['node_ndofs']
+    node_num_atoms = arrays['node_num_atoms']
+    atom_names = arrays['atom_names'].tolist()
+    atom_offsets = arrays['atom_offsets']
+    target_offsets = arrays['target_offsets']
+
+    if len(node_kinds) == 0:
+        raise TopologyError("No topology in serialized data.")
+
+    children = [[] for kind in node_kinds]
+    for idx, parent in enumerate(node_parents):
+        if parent >= 0:
+            children[parent].append(idx)
+
+    atom_starts = np.concatenate([[0], np.cumsum(node_num_atoms)])
+
+    nodes = [None] * len(node_kinds)
+    for idx in reversed(range(len(node_kinds))):
+        ndof = int(node_ndofs[idx])
+        shape = (int(node_sizes[idx]),)
+        if node_kinds[idx] == 1:
+            nodes[idx] = Polymer(node_names[idx], [nodes[jdx] for jdx in children[idx]],
+                                 fixed_monomers=True, shape=shape, ndof=ndof)
+        else:
+            start, stop = atom_starts[idx], atom_starts[idx + 1]
+            nodes[idx] = Molecule(node_names[idx], atom_names[start:stop],
+                                  atom_offsets=atom_offsets[ndof * start:ndof * stop],
+                                  target_offsets=target_offsets[ndof * start:ndof * stop],
+                                  shape=shape, ndof=ndof)
+
+    # Polymer overwrites the shapes of its monomers, so restore the
+    # shapes that were serialized.
+    for node, size in zip(nodes, node_sizes):
+        node.shape = (int(size),)
+
+    return nodes[0]
+
+
+def dumps_topology(top):
+    """Return the topology serialized as a string."""
+    f = StringIO()
+    np.savez(f, **topology_arrays(top))
+    return f.getvalue()
+
+def loads_topology(data):
+    """Return the topology serialized in the string data."""
+    with np.load(StringIO(data)) as arrays:
+        return arrays_topology(arrays)
+
+def save_topology(top, file_name):
+    """Write the serialized topology to file_name."""
+    with open(file_name, 'wb') as f:
+        f.write(dumps_topology(top))
+
+def load_topology(file_name):
+    """Return the topology serialized in file_name."""
+    with open(file_name, 'rb') as f:
+        return loads_topology(f.read())
+
+
+def topology_cache_name(cache_dir, file_name, name):
+    """Return the name of the cache file for the topology of file_name.
+
+    The cache is keyed by the absolute path, modification time and size
+    of the file, so that it is ignored once the file changes.
+
+    """
+    stat = os.stat(file_name)
+    key = repr((os.path.abspath(file_name), stat.st_mtime, stat.st_size, name))
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.top.npz')
+
+
+def cached_topology(cache_dir, file_name, name, read_topology):
+    """Return the topology of file_name from the cache, reading it with read_topology on a miss."""
+    cache_name = topology_cache_name(cache_dir, file_name, name)
+    if os.path.exists(cache_name):
+        return load_topology(cache_name)
+
+    top = read_topology(file_name, name=name)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first so that concurrent readers never
+    # see a partial cache entry.
+    fd, temp_name = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(dumps_topology(top))
+        os.rename(temp_name, cache_name)
+    except:
+        os.remove(temp_name)
+        raise
+
+    return top
@@ -1,6 +1,12 @@
 import os
+import itertools as it
+import threading
+
+import numpy as np
 
 from sql_table import *
+import topology as t
+import parallel
 
 class TrajectoryKeys(SQLTable):
     trajectorykey = Integer()
@@ -24,6 +30,7 @@ class Times(SQLTable):
     samplekey = samplekeys.Integer('samplekey')
     time = Real()
     primary_key(samplekey)
+    index(time)
 
 class Trajectories(SQLTable):
     samplekeys = ForeignTable()
@@ -31,6 +38,7 @@ class Trajectories(SQLTable):
     trajectorykeys = ForeignTable()
     trajectorykey = trajectorykeys.Integer('trajectorykey')
     primary_key(samplekey)
+    index(trajectorykey)
 
 
 class VectorFileError(DatabaseError):
@@ -53,7 +61,25 @@ def open_vector_file(file_name, create=None):
 
 class TrajectoryDatabaseError(DatabaseError):
     pass
-        
+
+
+def vector_rows_index(samplekeys):
+    """Return a slice for consecutive sorted samplekeys, otherwise a list."""
+    first, last = samplekeys[0], samplekeys[-1]
+    if last - first + 1 == len(samplekeys):
+        return slice(first, last + 1)
+    return samplekeys.tolist()
+
+def read_vector_rows(vectors, samplekeys):
+    """Return the sorted samplekeys and the corresponding rows of the vector table."""
+    samplekeys = np.sort(np.array(samplekeys, dtype=int))
+    return samplekeys, vectors[vector_rows_index(samplekeys)]
+
+def write_vector_rows(vectors, samplekeys, rows):
+    """Write the rows for the sorted samplekeys to the vector table."""
+    vectors[vector_rows_index(samplekeys)] = rows
+
+
 class TrajectoryDatabase(DatabaseMixin):
     """MD coordinate trajectory database.    """
 
@@ -91,6 +117,8 @@ class TrajectoryDatabase(DatabaseMixin):
                     os.mkdir(dbname)
             dbname = os.path.join(dbname, os.path.basename(dbname) + '.db')
 
+        self.__read_vector_files = []
+        self.__read_vector_files_lock = threading.Lock()
         
         super(TrajectoryDatabase, self).__init__(dbname, *args, **kwargs)
 
@@ -127,9 +155,8 @@ class TrajectoryDatabase(DatabaseMixin):
                     setattr(self, vtable_name, self.get_vector_table(vtable_name, ndof))
 
 
-        try:
-            self.first_key = self.keys().next()
-        except StopIteration:
+        self.first_key = self.select_min(self.samplekeys.samplekey)
+        if self.first_key is None:
             self.first_key = -1
 
 
@@ -140,17 +167,50 @@ class TrajectoryDatabase(DatabaseMixin):
 
             self.vector_file.close()
 
+        with self.__read_vector_files_lock:
+            for vector_file in self.__read_vector_files:
+                vector_file.close()
+            self.__read_vector_files = []
+
         DatabaseMixin.close(self)
 
     __vector_file = None
 
     @property
     def vector_file(self):
+        if not self.is_owner_thread():
+            return self.read_vector_file()
+
         if self.__vector_file:
             return self.__vector_file
 
         return self.open_vector_file()
 
+    def read_vector_file(self):
+        """Return the handle of the vector file of the current thread, opening it if needed.
+
+        HDF5 shares the open file between the handles of a process, so
+        the handles of other threads see the rows written by the owner
+        thread.  For the same reason, while the owner thread has the
+        file open for writing the handle is only read only by
+        convention, and h5py still serializes the reads of all threads.
+
+        """
+        try:
+            return self.thread_local.vector_file
+        except AttributeError:
+            pass
+
+        import h5py
+
+        vector_file = False
+        if os.path.exists(self.vector_file_name):
+            vector_file = h5py.File(self.vector_file_name, 'r')
+            with self.__read_vector_files_lock:
+                self.__read_vector_files.append(vector_file)
+        self.thread_local.vector_file = vector_file
+        return vector_file
+
     def open_vector_file(self, create=False):
         dbname_woext = os.path.splitext(self.dbname)[0]
         dbname_whdf5 = dbname_woext + '.hdf5'
@@ -251,6 +311,7 @@ class TrajectoryDatabase(DatabaseMixin):
             samplekey = samplekeys.Integer('samplekey')
             property = Real()
             primary_key(samplekey)
+            index(property)
 
 
         table = SampleTable(name=table_name, property_name=property_name, samplekeys=self.samplekeys)
@@ -266,6 +327,84 @@ class TrajectoryDatabase(DatabaseMixin):
         return table
 
 
+    def add_samplekey_table(self, table_name, overwrite=False):
+        """Return a table holding a set of samplekeys, creating it if needed."""
+        class SampleKeyTable(SQLTable):
+            samplekeys = ForeignTable()
+            samplekey = samplekeys.Integer('samplekey')
+            primary_key(samplekey)
+
+        if not overwrite:
+            old_table = self.has_table(table_name)
+            if old_table:
+                return old_table
+
+        return self.new_table(SampleKeyTable(name=table_name, samplekeys=self.samplekeys), overwrite=overwrite)
+
+    def missing_samplekey_chunks(self, missing, chunk_size):
+        """Return the sorted samplekeys not in the missing table, split into chunks.
+
+        The samplekeys are read up front, so that results can be
+        written to the database while the coordinates are being read.
+
+        """
+        samplekeys, = self.select_arrays([self.samplekeys.samplekey], where=self.samplekey_constraint(missing),
+                                         order_by=self.samplekeys.samplekey)
+        return [samplekeys[idx:idx + chunk_size] for idx in xrange(0, len(samplekeys), chunk_size)]
+
+    def map_missing_chunks(self, missing, func, chunk_size, processes):
+        """Yield the samplekeys and func of the coordinates of each chunk of samples not in missing."""
+        key_chunks = self.missing_samplekey_chunks(missing, chunk_size)
+        coordinates = self.coordinates
+        blocks = (read_vector_rows(coordinates, samplekeys)[1] for samplekeys in key_chunks)
+        return it.izip(key_chunks, parallel.imap(func, blocks, processes=processes))
+
+    def compute_vector_table(self, vector_table_name, func, ndof, chunk_size=1000, processes=1, overwrite=False):
+        """Fill a vector table with func applied to the coordinates of each sample.
+
+        func maps an (M, ndof) block of coordinates to an (M, ndof)
+        block of vectors; to run in a process pool (processes other
+        than 1) it must be a module level function.  The samplekeys
+        done so far are recorded in the table '<vector_table_name>_keys',
+        so that an interrupted computation resumes with the samples
+        still missing.
+
+        """
+        if overwrite or not self.has_vector_table(vector_table_name, ndof):
+            self.new_vector_table(vector_table_name, ndof, overwrite=overwrite)
+            overwrite = True
+        vectors = self.get_vector_table(vector_table_name, ndof)
+        vectors.resize(self.vector_table_shape(ndof))
+
+        with self.session():
+            done = self.add_samplekey_table(vector_table_name + '_keys', overwrite=overwrite)
+
+        for samplekeys, result in self.map_missing_chunks(done, func, chunk_size, processes):
+            with self.session():
+                write_vector_rows(vectors, samplekeys, result)
+                self.insert(done, [(samplekey,) for samplekey in samplekeys.tolist()])
+                # The vectors reach the disk before the samplekeys are
+                # committed as done.
+                vectors.file.flush()
+
+        return vectors
+
+    def compute_sample_table(self, table_name, func, property_name='value', chunk_size=1000, processes=1, overwrite=False):
+        """Fill a sample table with func applied to the coordinates of each sample.
+
+        func maps an (M, ndof) block of coordinates to M values.  Only
+        the samples missing from the table are computed.
+
+        """
+        with self.session():
+            table = self.add_sample_table(table_name, property_name=property_name, overwrite=overwrite)
+
+        for samplekeys, result in self.map_missing_chunks(table, func, chunk_size, processes):
+            with self.session():
+                self.insert(table, zip(samplekeys.tolist(), np.asarray(result, dtype=float).tolist()))
+
+        return table
+
     def get_sample_property_column(self, name):
         table = self.get_table(name)
         if len(table.columns) != 2:
@@ -288,7 +427,7 @@ class TrajectoryDatabase(DatabaseMixin):
         return self.__last_samplekey
 
     def keys(self):
-        for key, in self.select(self.samplekeys.columns):
+        for key, in self.select(self.samplekeys.columns, order_by=self.samplekeys.samplekey):
             yield key
 
     @property
@@ -315,6 +454,7 @@ class TrajectoryDatabase(DatabaseMixin):
             
         self.insert(self.samplekeys, [(key+1,)])
         key = self.__current_samplekey = key+1            
+        self.__last_samplekey = key
 
 
         coordinates = self.coordinates
@@ -330,7 +470,10 @@ class TrajectoryDatabase(DatabaseMixin):
         return key
 
     def get_sample(self, samplekey):
-        coordinates = self.coordinates
+        if self.is_owner_thread():
+            coordinates = self.coordinates
+        else:
+            coordinates = self.get_vector_table('coordinates', self.ndof)
         return coordinates[samplekey]
 
 
@@ -353,10 +496,9 @@ class TrajectoryDatabase(DatabaseMixin):
         current_samplekey = self.current_samplekey
 
         trajectorykey = None
-        try:
-            trajectorykey, = self.select([self.trajectories.trajectorykey], where=(self.samplekeys.samplekey==current_samplekey)).next()
-        except StopIteration:
-            trajectorykey = None
+        row = self.select_one([self.trajectories.trajectorykey], where=(self.samplekeys.samplekey==current_samplekey))
+        if row is not None:
+            trajectorykey, = row
 
         if trajectorykey is None:
             self.__current_trajectorykey = -1
@@ -402,10 +544,37 @@ class TrajectoryDatabase(DatabaseMixin):
     def step_time(self, step):
         self.__current_time += step
 
-    def iter_vectors(self, vector_table_name, ndof, missing=None, where=None):
+    __topology = None
+
+    def set_topology(self, top):
+        """Store the topology of the coordinates in the database."""
+        self.set_blob('topology', t.dumps_topology(top))
+        self.__topology = top
+
+    def get_topology(self):
+        """Return the topology stored in the database, or None."""
+        if self.__topology is None:
+            data = self.get_blob('topology')
+            if data is not None:
+                self.__topology = t.loads_topology(data)
+        return self.__topology
+
+    def iter_vectors(self, vector_table_name, ndof, missing=None, where=None, keys=None):
 
         vectors = self.get_vector_table(vector_table_name, ndof)
 
+        for samplekey, in self.iter_vector_samplekeys(missing=missing, where=where, keys=keys):
+            yield samplekey, vectors[samplekey]
+
+    def samplekey_constraint(self, missing=None, where=None, keys=None):
+        """Return where restricted to the samplekeys not in the missing table and in the KeySet keys."""
+        if keys is not None:
+            keys_constraint = self.samplekeys.samplekey.is_in(keys)
+            if where:
+                where = where & keys_constraint
+            else:
+                where = keys_constraint
+
         if missing:
             assert isinstance(missing, SQLTable)
             assert missing.samplekey.is_primary_key()
@@ -417,18 +586,61 @@ class TrajectoryDatabase(DatabaseMixin):
             else:
                 where = samplekey_constraint
 
-        for row in self.select([self.samplekeys.samplekey], where=where):
-            samplekey = row[0]
-            yield samplekey, vectors[samplekey]
+        return where
+
+    def iter_samplekey_blocks(self, missing=None, where=None, keys=None, block=10000):
+        """Yield sorted arrays of at most block samplekeys, restricted as in samplekey_constraint.
+
+        keys is a KeySet or a sequence of samplekeys, which is loaded
+        into a KeySet for the duration of the iteration.
+
+        """
+        if keys is not None and not isinstance(keys, KeySet):
+            with self.key_set(keys) as key_set:
+                blocks = self.iter_samplekey_blocks(missing=missing, where=where, keys=key_set, block=block)
+                try:
+                    for samplekeys in blocks:
+                        yield samplekeys
+                finally:
+                    # Finish the select before its key set is dropped.
+                    blocks.close()
+            return
 
+        samplekey = self.samplekeys.samplekey
+        for samplekeys, in self.iter_select_arrays([samplekey], where=self.samplekey_constraint(missing, where, keys),
+                                                   order_by=samplekey, block=block):
+            yield samplekeys
 
-    def iter_coordinates(self, missing=None, where=None):
-        for row in self.iter_vectors('coordinates', self.ndof, missing=missing, where=where):
+    def iter_vector_samplekeys(self, missing=None, where=None, keys=None):
+        for samplekeys in self.iter_samplekey_blocks(missing=missing, where=where, keys=keys):
+            for samplekey in samplekeys.tolist():
+                yield samplekey,
+
+
+    def iter_coordinates(self, missing=None, where=None, keys=None):
+        for row in self.iter_vectors('coordinates', self.ndof, missing=missing, where=where, keys=keys):
             yield row
 
 
+    def iter_vector_chunks(self, vector_table_name, ndof, chunk_size=1000, missing=None, where=None, keys=None):
+        """Yield (samplekeys, vectors) blocks of at most chunk_size samples.
+
+        Runs of consecutive samplekeys are read from the vector table
+        with a single slice.
+
+        """
+        vectors = self.get_vector_table(vector_table_name, ndof)
+
+        for samplekeys in self.iter_samplekey_blocks(missing=missing, where=where, keys=keys, block=chunk_size):
+            yield read_vector_rows(vectors, samplekeys)
+
+    def iter_coordinate_chunks(self, chunk_size=1000, missing=None, where=None, keys=None):
+        for chunk in self.iter_vector_chunks('coordinates', self.ndof, chunk_size=chunk_size,
+                                             missing=missing, where=where, keys=keys):
+            yield chunk
+
     def iter_samplekeys(self):
-        for key, in self.select([self.samplekeys.samplekey]):
+        for key, in self.select([self.samplekeys.samplekey], order_by=self.samplekeys.samplekey):
             yield key
 
 